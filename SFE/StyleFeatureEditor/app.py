@@ -1,13 +1,7 @@
 import gradio as gr
-import os
-import tempfile
-import threading
-import time
-import sys
-import io
-from contextlib import redirect_stdout, redirect_stderr
-from PIL import Image
+import queue
 from runners.simple_runner import SimpleRunner
+from runners.serving import EditingService
 
 
 print("Loading SFE model...")
@@ -19,224 +13,106 @@ print("Model loaded successfully!")
 EDITING_TYPES = ['age', 'fs_glasses', 'fs_smiling', 'angry', 'curly_hair', 'head_angle_up', 'rotation', 'grey hair', 'sideburns', 'sslipstick']
 
 
-current_result = None
-current_status = "Ready"
-processing_lock = threading.Lock()
-console_output = ""
-is_processing = False
-
-class ConsoleCapture:
-    def __init__(self):
-        self.buffer = []
-        self.lock = threading.Lock()
-    
-    def write(self, text):
-        with self.lock:
-            self.buffer.append(text)
-            
-            if len(self.buffer) > 100:
-                self.buffer = self.buffer[-100:]
-        
-        if hasattr(sys, '__stdout__') and sys.__stdout__ is not None:
-            sys.__stdout__.write(text)
-            sys.__stdout__.flush()
-        elif hasattr(sys, 'stdout') and sys.stdout is not None:
-            sys.stdout.write(text)
-            sys.stdout.flush()
-    
-    def flush(self):
-        pass
-    
-    def get_output(self):
-        with self.lock:
-            return ''.join(self.buffer)
+service = EditingService(runner, max_queue_size=32, max_batch_size=8, max_wait=0.1)
 
+JOB_STATUSES = {
+    "queued": "⏳ Waiting in queue...",
+    "processing": "🔄 Processing image...",
+    "done": "✅ COMPLETE! Click 'Get Results' to see the image.",
+}
 
-console_capture = ConsoleCapture()
 
-def process_image_background(image, editing_type, power, align_face, use_mask, mask_threshold, is_styleclip=False, neutral_prompt="", target_prompt="", disentanglement=0.14):
-    """Background processing function"""
-    global current_result, current_status, console_output, is_processing
-    
+def submit_job(image, editing_name, power, align_face, use_mask, mask_threshold):
     try:
-        with processing_lock:
-            current_status = "🚀 Starting processing..."
-            current_result = None
-            is_processing = True
-            console_output = "🚀 Processing started...\n"
-        
-        
-        old_stdout = sys.stdout
-        old_stderr = sys.stderr
-        sys.stdout = console_capture
-        sys.stderr = console_capture
-        
-        
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_input:
-            image.save(temp_input.name)
-            temp_input_path = temp_input.name
-        
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_output:
-            temp_output_path = temp_output.name
-        
-        print("📁 Image files created, starting processing...")
-        
-        with processing_lock:
-            current_status = "🔄 Processing image..."
-        
-        
-        # Determine editing name based on type
-        if is_styleclip:
-            editing_name = f"styleclip_global_{neutral_prompt}_{target_prompt}_{disentanglement}"
-            print(f"🎨 StyleCLIP editing: {neutral_prompt} -> {target_prompt} (disentanglement: {disentanglement})")
-        else:
-            editing_name = editing_type
-            print(f"✨ Standard editing: {editing_type}")
-        
-        runner.edit(
-            orig_img_pth=temp_input_path,
-            editing_name=editing_name,
-            edited_power=power,
-            save_pth=temp_output_path,
+        job_id = service.submit(
+            image,
+            editing_name,
+            power,
             align=align_face,
-            save_inversion=False,
             use_mask=use_mask,
-            mask_trashold=mask_threshold
+            mask_trashold=mask_threshold,
+            return_unaligned=False
         )
-        
-        print("🎯 Processing completed, loading result...")
-        
-        
-        sys.stdout = old_stdout
-        sys.stderr = old_stderr
-        
-        with processing_lock:
-            current_status = "📥 Finalizing..."
-        
-        
-        if os.path.exists(temp_output_path):
-            edited_image = Image.open(temp_output_path)
-            
-            
-            os.unlink(temp_input_path)
-            os.unlink(temp_output_path)
-            
-            with processing_lock:
-                current_result = edited_image
-                current_status = "✅ COMPLETE! Click 'Get Results' to see the image."
-                is_processing = False
-                
-            print("✅ Image processing finished successfully!")
-            print("📥 Click 'Get Results' button to see your edited image!")
-        else:
-            with processing_lock:
-                current_result = None
-                current_status = "❌ Failed to generate edited image"
-                is_processing = False
-            print("❌ Failed to generate edited image")
-            
-    except Exception as e:
-        
-        sys.stdout = old_stdout
-        sys.stderr = old_stderr
-        
-        with processing_lock:
-            current_result = None
-            current_status = f"❌ Error: {str(e)}"
-            is_processing = False
-        print(f"❌ Error occurred: {str(e)}")
+    except queue.Full:
+        return None, "❌ Server is busy, please try again later", None
+    return None, f"🚀 Processing started (job {job_id[:8]})... Click 'Refresh Status' to see progress!", job_id
+
 
 def start_processing_standard(image, editing_type, power, align_face, use_mask, mask_threshold):
     """Start standard processing"""
-    global current_result, current_status, console_output, is_processing
-    
     if image is None:
-        return None, "Please upload an image first"
-    
-    
-    console_capture.buffer.clear()
+        return None, "Please upload an image first", None
     
-    with processing_lock:
-        current_status = "🚀 Starting..."
-        current_result = None
-        is_processing = True
-        console_output = "🚀 Processing started...\n"
-    
-    
-    thread = threading.Thread(
-        target=process_image_background,
-        args=(image, editing_type, power, align_face, use_mask, mask_threshold, False, "", "", 0.14)
-    )
-    thread.start()
-    
-    return None, "🚀 Processing started... Click 'Refresh Status' to see live output!"
+    return submit_job(image, editing_type, power, align_face, use_mask, mask_threshold)
 
 def start_processing_styleclip(image, neutral_prompt, target_prompt, disentanglement, power, align_face, use_mask, mask_threshold):
     """Start StyleCLIP processing"""
-    global current_result, current_status, console_output, is_processing
-    
     if image is None:
-        return None, "Please upload an image first"
+        return None, "Please upload an image first", None
     
     if not neutral_prompt.strip() or not target_prompt.strip():
-        return None, "Please provide both neutral and target prompts"
-    
-    console_capture.buffer.clear()
-    
-    with processing_lock:
-        current_status = "🚀 Starting StyleCLIP..."
-        current_result = None
-        is_processing = True
-        console_output = "🚀 StyleCLIP processing started...\n"
-    
-    thread = threading.Thread(
-        target=process_image_background,
-        args=(image, "", power, align_face, use_mask, mask_threshold, True, neutral_prompt.strip(), target_prompt.strip(), disentanglement)
-    )
-    thread.start()
-    
-    return None, f"🚀 StyleCLIP started: {neutral_prompt} -> {target_prompt}"
-
-def get_results():
-    """Get current results"""
-    global current_result, current_status
-    
-    with processing_lock:
-        if current_result is not None:
-            
-            result_image = current_result
-            current_result = None
-            current_status = "Ready for next image"
-            return result_image, "✅ Success! Image loaded."
-        else:
-            return None, current_status
-
-def get_live_status():
-    """Get live status with streaming console output"""
-    global current_status, is_processing
-    
-    live_output = console_capture.get_output()
-    
-    with processing_lock:
-        status_line = f"\n{'='*50}\nStatus: {current_status}\n{'='*50}"
-        
-        if is_processing:
-            status_line += f"\n🔄 Processing... (Click 'Refresh Status' for updates)"
-        elif current_result is not None:
-            status_line += f"\n✅ Ready! Click 'Get Results' to see image"
-        
-        return live_output + status_line
+        return None, "Please provide both neutral and target prompts", None
+    
+    neutral_prompt, target_prompt = neutral_prompt.strip(), target_prompt.strip()
+    editing_name = f"styleclip_global_{neutral_prompt}_{target_prompt}_{disentanglement}"
+    return submit_job(image, editing_name, power, align_face, use_mask, mask_threshold)
+
+def get_job_status(job):
+    if job.status == "failed":
+        return f"❌ Error: {str(job.error)}"
+    return JOB_STATUSES[job.status]
+
+def get_results(job_id):
+    """Get results of the session's job"""
+    if job_id is None:
+        return None, "Ready", None
+
+    job = service.pop_job(job_id)
+    if job is None:
+        return None, "Ready for next image", None
+    if job.status == "done":
+        return job.result["edited"], "✅ Success! Image loaded.", None
+    if job.status == "failed":
+        return None, get_job_status(job), None
+    return None, get_job_status(job), job_id
+
+def format_progress(job):
+    lines = []
+    for event in job.progress.history():
+        line = f"[{event.elapsed:6.2f}s] {event.percent:3d}% {event.stage}"
+        if event.message:
+            line += f": {event.message}"
+        lines.append(line)
+    return "\n".join(lines)
+
+def get_live_status(job_id):
+    """Get live status with the job's progress events"""
+    job = service.get_job(job_id) if job_id is not None else None
+    live_output = "" if job is None else format_progress(job)
+    status = "Ready" if job is None else get_job_status(job)
+
+    status_line = f"\n{'='*50}\nStatus: {status}\n{'='*50}"
+    if job is not None and not job.done.is_set():
+        status_line += f"\n🔄 Processing... (Click 'Refresh Status' for updates)"
+    elif job is not None and job.status == "done":
+        status_line += f"\n✅ Ready! Click 'Get Results' to see image"
+
+    return live_output + status_line
 
 
 with gr.Blocks(title="StyleFeatureEditor") as demo:
-    gr.Markdown("# StyleFeatureEditor - Live Console Output")
+    gr.Markdown("# StyleFeatureEditor - Live Progress")
     gr.Markdown("Choose between **Standard Editing** or **Custom StyleCLIP** editing")
     
+    # every browser session keeps the id of its last job
+    job_state1 = gr.State(None)
+    job_state2 = gr.State(None)
+
     with gr.Tabs():
         with gr.TabItem("Standard Editing"):
             gr.Markdown("**Instructions:**")
             gr.Markdown("1. Upload image and select editing type")
-            gr.Markdown("2. Click 'Start Processing' and watch console output")
+            gr.Markdown("2. Click 'Start Processing' and watch progress")
             gr.Markdown("3. Click 'Refresh Status' to see updates")
             gr.Markdown("4. When you see '✅ COMPLETE!' click 'Get Results'")
             
@@ -257,7 +133,7 @@ with gr.Blocks(title="StyleFeatureEditor") as demo:
                 with gr.Column():
                     image_output1 = gr.Image(type="pil", label="Output Image")
                     status_text1 = gr.Textbox(
-                        label="🔴 LIVE Console Output & Status", 
+                        label="🔴 LIVE Progress & Status", 
                         value="Ready - Upload an image to start", 
                         lines=15,
                         max_lines=20,
@@ -293,7 +169,7 @@ with gr.Blocks(title="StyleFeatureEditor") as demo:
                 with gr.Column():
                     image_output2 = gr.Image(type="pil", label="Output Image")
                     status_text2 = gr.Textbox(
-                        label="🔴 LIVE Console Output & Status", 
+                        label="🔴 LIVE Progress & Status", 
                         value="Ready - Upload an image to start", 
                         lines=15,
                         max_lines=20,
@@ -304,16 +180,18 @@ with gr.Blocks(title="StyleFeatureEditor") as demo:
     start_btn1.click(
         start_processing_standard,
         inputs=[image_input1, editing_dropdown, power_slider1, align_face1, use_mask1, mask_threshold1],
-        outputs=[image_output1, status_text1]
+        outputs=[image_output1, status_text1, job_state1]
     )
     
     get_results_btn1.click(
         get_results,
-        outputs=[image_output1, status_text1]
+        inputs=[job_state1],
+        outputs=[image_output1, status_text1, job_state1]
     )
     
     refresh_btn1.click(
         get_live_status,
+        inputs=[job_state1],
         outputs=[status_text1]
     )
     
@@ -321,16 +199,18 @@ with gr.Blocks(title="StyleFeatureEditor") as demo:
     start_btn2.click(
         start_processing_styleclip,
         inputs=[image_input2, neutral_prompt, target_prompt, disentanglement_slider, power_slider2, align_face2, use_mask2, mask_threshold2],
-        outputs=[image_output2, status_text2]
+        outputs=[image_output2, status_text2, job_state2]
     )
     
     get_results_btn2.click(
         get_results,
-        outputs=[image_output2, status_text2]
+        inputs=[job_state2],
+        outputs=[image_output2, status_text2, job_state2]
     )
     
     refresh_btn2.click(
         get_live_status,
+        inputs=[job_state2],
         outputs=[status_text2]
     )
 
@@ -37,6 +37,15 @@ class DataArgs:
 class InferenceArgs:
     inference_runner: str = "base_inference_runner"
     editings_data: Dict = field(default_factory=lambda: {})
+    share_e4e_decode: bool = True
+    editing_batch_size: int = 8  # max (image x degree) pairs per generator call
+    mappers_cache_size: int = 4  # number of StyleCLIP mappers kept on device
+    warmup_mappers: List[str] = field(default_factory=lambda: [])
+    streaming: bool = True  # invert and edit batch by batch instead of keeping the whole dataset
+    saving_workers: int = 4
+    max_pending_saves: int = 64  # images waiting for the saving threads
+    inversion_store: str = ""  # directory to keep inversion results in, resumes and reuses them if set
+    inversion_store_chunk: int = 256  # images per stored chunk
 
 
 @args.add_to_registry("model")
@@ -12,24 +12,28 @@ class LPIPS(nn.Module):
         net_type (str): the network type to compare the features:
                         'alex' | 'squeeze' | 'vgg'. Default: 'alex'.
         version (str): the version of LPIPS. Default: 0.1.
+        device (str): device of the networks. Default: cuda.
     """
 
-    def __init__(self, net_type: str = "vgg", version: str = "0.1"):
+    def __init__(self, net_type: str = "vgg", version: str = "0.1", device: str = "cuda"):
         assert version in ["0.1"], "v0.1 is only supported now"
 
         super(LPIPS, self).__init__()
 
         # pretrained network
-        self.net = get_network(net_type).to("cuda")
+        self.net = get_network(net_type).to(device)
 
         # linear layers
-        self.lin = LinLayers(self.net.n_channels_list).to("cuda")
+        self.lin = LinLayers(self.net.n_channels_list).to(device)
         self.lin.load_state_dict(get_state_dict(net_type, version))
 
-    def forward(self, x: torch.Tensor, y: torch.Tensor):
+    def forward(self, x: torch.Tensor, y: torch.Tensor, reduction: str = "mean"):
         feat_x, feat_y = self.net(x), self.net(y)
 
         diff = [(fx - fy) ** 2 for fx, fy in zip(feat_x, feat_y)]
         res = [l(d).mean((2, 3), True) for d, l in zip(diff, self.lin)]
 
+        if reduction == "none":
+            # per image scores
+            return torch.stack(res).sum(0).flatten()
         return torch.sum(torch.cat(res, 0)) / x.shape[0]
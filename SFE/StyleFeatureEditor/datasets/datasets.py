@@ -67,6 +67,9 @@ class FIDDataset(Dataset):
 
     def __getitem__(self, i):
         file = self.files[i]
+        if not isinstance(file, Image.Image):
+            # paths are opened lazily, so images are streamed from disk
+            file = Image.open(file)
         image = file.convert("RGB")
 
         if self.transforms is not None:
@@ -83,10 +86,10 @@ class MetricsPathsDataset(Dataset):
 
         for f in os.listdir(root_path):
             if f not in ignore:
-                self.names.append(f)
                 image_path = os.path.join(root_path, f)
                 gt_path = os.path.join(gt_dir, f)
                 if f.endswith(".jpg") or f.endswith(".png"):
+                    self.names.append(f)
                     self.pairs.append([image_path, gt_path.replace(".png", ".jpg"), None])
                     self.paths.append(image_path)
         self.transform = transform
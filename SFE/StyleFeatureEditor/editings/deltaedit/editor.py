@@ -24,7 +24,7 @@ def improved_ds(ds, select):
 
 
 class DeltaEditor:
-    def __init__(self):
+    def __init__(self, clip_model=None, preprocess=None):
         device = "cuda"
         self.fs3 = np.load("pretrained_models/fs3.npy")
         np.set_printoptions(suppress=True)
@@ -34,7 +34,9 @@ class DeltaEditor:
         self.net.load_state_dict(net_ckpt)
         self.net = self.net.to(device).eval()
 
-        self.clip_model, self.preprocess = clip.load("ViT-B/32", device=device)
+        if clip_model is None:
+            clip_model, preprocess = clip.load("ViT-B/32", device=device)
+        self.clip_model, self.preprocess = clip_model, preprocess
         self.avg_pool = torch.nn.AdaptiveAvgPool2d((224, 224))
         self.upsample = torch.nn.Upsample(scale_factor=7)
 
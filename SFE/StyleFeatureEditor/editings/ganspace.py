@@ -1,32 +1,25 @@
 import torch
 
 
-def edit(latents, pca, edit_directions):
-    edit_latents = []
-    for latent in latents:
-        for pca_idx, start, end, strength in edit_directions:
-            delta = get_delta(pca, latent, pca_idx, strength)
-            delta_padded = torch.zeros(latent.shape).to("cuda")
-            delta_padded[start:end] += delta.repeat(end - start, 1)
-            edit_latents.append(latent + delta_padded)
-    return torch.stack(edit_latents)
+def pca_to_device(pca, device):
+    return {key: value.to(device) if torch.is_tensor(value) else value for key, value in pca.items()}
 
 
-def get_delta(pca, latent, idx, strength):
-    w_centered = latent - pca["mean"].to("cuda")
-    lat_comp = pca["comp"].to("cuda")
-    lat_std = pca["std"].to("cuda")
-    w_coord = (
-        torch.sum(w_centered[0].reshape(-1) * lat_comp[idx].reshape(-1)) / lat_std[idx]
-    )
-    delta = (strength - w_coord) * lat_comp[idx] * lat_std[idx]
+def get_batch_delta(pca, latents, idx, strengths):
+    # latents: bs x n_latent x 512, strengths: n_strengths -> bs x n_strengths x 512
+    lat_comp = pca["comp"][idx].reshape(-1)
+    lat_std = pca["std"][idx]
+    w_centered = latents[:, 0] - pca["mean"].reshape(1, -1)
+    w_coord = torch.matmul(w_centered, lat_comp) / lat_std
+    delta = (strengths.view(1, -1) - w_coord.view(-1, 1)).unsqueeze(-1) * lat_comp * lat_std
     return delta
 
 
-def edit_latent(latent, pca, edit_direction):
-    pca_idx, start, end, strength = edit_direction
-    delta = get_delta(pca, latent, pca_idx, strength)
-    delta_padded = torch.zeros(latent.shape).to("cuda")
-    delta_padded[start:end] += delta.repeat(end - start, 1)
-    edit_latent = latent + delta_padded
-    return edit_latent
+def edit_batch(latents, pca, edit_direction, strengths):
+    # edits every latent with every strength at once -> bs x n_strengths x n_latent x 512
+    pca_idx, start, end, _ = edit_direction
+    strengths = torch.as_tensor(strengths, dtype=latents.dtype, device=latents.device)
+    delta = get_batch_delta(pca, latents, pca_idx, strengths)
+    edit_latents = latents.unsqueeze(1).repeat(1, len(strengths), 1, 1)
+    edit_latents[:, :, start:end] += delta.unsqueeze(2)
+    return edit_latents
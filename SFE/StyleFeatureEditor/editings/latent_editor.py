@@ -3,8 +3,11 @@ import sys
 import torch
 import pickle
 import argparse
+import threading
 import numpy as np
+import clip
 
+from collections import OrderedDict
 from editings import ganspace
 from editings.styleclip.mapper.styleclip_mapper import StyleCLIPMapper
 from editings.styleclip.mapper.gloabl_mapper import StyleCLIPGlobalDirection
@@ -42,22 +45,28 @@ STYLESPACE_IDX = [
 
 
 class LatentEditor:
-    def __init__(self, domain="human_faces"):
+    def __init__(self, domain="human_faces", mappers_cache_size=4, warmup_mappers=()):
 
         self.domain = domain
 
+        # editing backends are built on first use, see _get_backend
+        self._backends = {}
+        self._backends_lock = threading.RLock()
+
+        # LRU cache of ready-on-device StyleCLIP mappers, keyed by direction
+        self.styleclip_mappers = OrderedDict()
+        self.mappers_cache_size = mappers_cache_size
+        self.mappers_cache_hits = 0
+        self.mappers_cache_misses = 0
+
         if self.domain == "human_faces":
             self.interfacegan_directions = {
                 "age": "editings/interfacegan_directions/age.pt",
                 "smile": "editings/interfacegan_directions/smile.pt",
                 "rotation": "editings/interfacegan_directions/rotation.pt",
             }
-            self.interfacegan_tensors = {
-                name: torch.load(path).cuda()
-                for name, path in self.interfacegan_directions.items()
-            }
 
-            self.ganspace_pca = torch.load("editings/ganspace_pca/ffhq_pca.pt")
+            self.ganspace_pca_path = "editings/ganspace_pca/ffhq_pca.pt"
             self.ganspace_directions = {
                 "eye_openness": (54, 7, 8, 5),
                 "trimmed_beard": (58, 7, 9, 7),
@@ -85,7 +94,6 @@ class LatentEditor:
                 "trump": [False, False, False],
                 "zuckerberg": [False, False, False],
             }
-            self.styleclip_global_editor = self.load_styleclip_global()
 
             self.stylespace_directions = {
                 "black hair": [(12, 479)],
@@ -119,7 +127,8 @@ class LatentEditor:
                 "fs_makeup": "editings/bound/Heavy_Makeup_boundary.npy"
              }
 
-            self.deltaedit_editor = DeltaEditor()
+            for direction in warmup_mappers:
+                self.get_styleclip_mapper(direction)
 
         elif self.domain == "car":
 
@@ -136,7 +145,7 @@ class LatentEditor:
                 "wheel angle": [(8, 420)],
             }
 
-            self.ganspace_pca = torch.load("editings/ganspace_pca/cars_pca.pt")
+            self.ganspace_pca_path = "editings/ganspace_pca/cars_pca.pt"
             self.ganspace_directions = {
                 "pose_1": (0, 0, 5, 2),
                 "pose_2": (0, 0, 5, -2),
@@ -146,6 +155,51 @@ class LatentEditor:
             }
 
 
+    def _get_backend(self, name, load_fn):
+        # double-checked locking: concurrent requests build every backend only once
+        backend = self._backends.get(name)
+        if backend is None:
+            with self._backends_lock:
+                backend = self._backends.get(name)
+                if backend is None:
+                    backend = load_fn()
+                    self._backends[name] = backend
+        return backend
+
+    @property
+    def interfacegan_tensors(self):
+        return self._get_backend("interfacegan", lambda: {
+            name: torch.load(path).cuda()
+            for name, path in self.interfacegan_directions.items()
+        })
+
+    @property
+    def ganspace_pca(self):
+        return self._get_backend(
+            "ganspace", lambda: ganspace.pca_to_device(torch.load(self.ganspace_pca_path), "cuda")
+        )
+
+    @property
+    def fs_tensors(self):
+        return self._get_backend("fs", lambda: {
+            name: torch.from_numpy(np.load(path)).float().cuda()
+            for name, path in self.fs_directions.items()
+        })
+
+    @property
+    def clip_model(self):
+        # one CLIP copy shared by StyleCLIP global directions and DeltaEdit
+        return self._get_backend("clip", lambda: clip.load("ViT-B/32", device="cuda"))
+
+    @property
+    def styleclip_global_editor(self):
+        return self._get_backend("styleclip_global", self.load_styleclip_global)
+
+    @property
+    def deltaedit_editor(self):
+        return self._get_backend("deltaedit", lambda: DeltaEditor(*self.clip_model))
+
+
     def load_styleclip_global(self):
         delta_i_c = torch.from_numpy(np.load("editings/styleclip/global_mapper_data/delta_i_c.npy")).float().cuda()
         with open("editings/styleclip/global_mapper_data/S_mean_std", "rb") as channels_statistics:
@@ -153,12 +207,28 @@ class LatentEditor:
             s_std = [torch.from_numpy(s_i).float().cuda() for s_i in s_std]
         with open("editings/styleclip/global_mapper_data/templates.txt", "r") as templates:
             text_prompt_templates = templates.readlines()
-        global_direction_calculator = StyleCLIPGlobalDirection(delta_i_c, s_std, text_prompt_templates)
+        clip_model, _ = self.clip_model
+        global_direction_calculator = StyleCLIPGlobalDirection(delta_i_c, s_std, text_prompt_templates, clip_model=clip_model)
         return global_direction_calculator
 
 
-    def get_styleclip_mapper_edits(self, start_w, factors, direction):
-        latents_to_display = []
+    def get_styleclip_mapper(self, direction):
+        with self._backends_lock:
+            if direction in self.styleclip_mappers:
+                self.mappers_cache_hits += 1
+                self.styleclip_mappers.move_to_end(direction)
+                return self.styleclip_mappers[direction]
+
+            self.mappers_cache_misses += 1
+            style_clip_net = self.load_styleclip_mapper(direction)
+            if self.mappers_cache_size > 0:
+                self.styleclip_mappers[direction] = style_clip_net
+                if len(self.styleclip_mappers) > self.mappers_cache_size:
+                    self.styleclip_mappers.popitem(last=False)
+            return style_clip_net
+
+
+    def load_styleclip_mapper(self, direction):
         mapper_checkpoint_path = os.path.join(
             "pretrained_models/styleclip_mappers",
             f"{direction}.pt",
@@ -180,6 +250,12 @@ class LatentEditor:
         style_clip_net = StyleCLIPMapper(opts)
         style_clip_net.eval()
         style_clip_net.cuda()
+        return style_clip_net
+
+
+    def get_styleclip_mapper_edits(self, start_w, factors, direction):
+        latents_to_display = []
+        style_clip_net = self.get_styleclip_mapper(direction)
         direction = style_clip_net.mapper(start_w)
         for factor in factors:
             edited_latent = start_w + factor * direction
@@ -235,25 +311,17 @@ class LatentEditor:
 
 
     def get_ganspace_edits(self, start_w, factors, direction):
-        latents_to_display = []
-        for factor in factors:
-            ganspace_direction = self.ganspace_directions[direction]
-            edit_direction = list(ganspace_direction)
-            edit_direction[-1] = factor
-            edit_direction = tuple(edit_direction)
-
-            new_w = ganspace.edit(start_w, self.ganspace_pca, [edit_direction])
-            latents_to_display.append(new_w)
-        return latents_to_display
+        edited_latents = ganspace.edit_batch(
+            start_w, self.ganspace_pca, self.ganspace_directions[direction], factors
+        )  # bs x len(factors) x n_latent x 512
+        return list(edited_latents.transpose(0, 1))
 
 
     def get_interface_gan_edits(self, start_w, factors, direction):
-        latents_to_display = []
-        for factor in factors:
-            tensor_direction = self.interfacegan_tensors[direction]
-            edited_latent = start_w + factor / 2 * tensor_direction
-            latents_to_display.append(edited_latent)
-        return latents_to_display
+        tensor_direction = self.interfacegan_tensors[direction]
+        factors = torch.tensor(factors, dtype=start_w.dtype, device=start_w.device).view(-1, 1, 1, 1)
+        edited_latents = start_w.unsqueeze(0) + factors / 2 * tensor_direction  # len(factors) x bs x n_latent x 512
+        return list(edited_latents)
 
 
     def get_stylespace_edits(self, start_s, factors, direction):
@@ -277,14 +345,10 @@ class LatentEditor:
         
 
     def get_fs_edits(self, w, factors, direction):
-        path = self.fs_directions[direction]
-        boundary = np.load(path)
-        device = w.device
-        bs = w.size(0)
-        w_0 = w.cpu().numpy().reshape(bs, -1)
-        boundary = boundary.reshape(1, -1).repeat(bs, 0)
+        boundary = self.fs_tensors[direction].to(w.device).view(1, 1, -1, 512)
+        factors = torch.tensor(factors, dtype=w.dtype, device=w.device).view(-1, 1, 1, 1)
 
-        edits = [torch.tensor(w_0 + factor * boundary).view(bs, -1, 512).to(device) for factor in factors]
+        edits = w.unsqueeze(0) + factors * boundary  # len(factors) x bs x n_latent x 512
 
-        return edits
+        return list(edits)
 
@@ -0,0 +1,70 @@
+# Same module as SFE editings/styleclip/mapper/text_features_cache.py and StyleRes
+# editings/styleclip_directions/text_features_cache.py besides the model_fingerprint import,
+# keep the two in sync.
+import os
+import torch
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+from metrics.fid_stats import model_fingerprint
+
+
+class TextFeaturesCache:
+    """
+    Averaged CLIP text features stored on disk under a hash of (clip weights, templates, prompt),
+    so they survive restarts, with a bounded LRU in memory on top. The weights are hashed on the
+    first lookup, so features of another CLIP checkpoint are never reused.
+    """
+
+    def __init__(self, cache_dir, text_prompts_templates, clip_model, max_size=1024):
+        self.cache_dir = cache_dir
+        self.clip_model = clip_model
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.templates_hash = hashlib.sha1("".join(text_prompts_templates).encode("utf-8")).hexdigest()
+        self.key_prefix = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _key(self, text_prompt):
+        with self.lock:
+            if self.key_prefix is None:
+                self.key_prefix = f"{model_fingerprint(self.clip_model)}_{self.templates_hash}_"
+        return hashlib.sha1((self.key_prefix + text_prompt).encode("utf-8")).hexdigest()
+
+    def get(self, text_prompt, device="cpu"):
+        key = self._key(text_prompt)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        path = os.path.join(self.cache_dir, f"{key}.pt")
+        if not os.path.exists(path):
+            return None
+        text_features = torch.load(path, map_location=device)
+        self._remember(key, text_features)
+        return text_features
+
+    def put(self, text_prompt, text_features):
+        key = self._key(text_prompt)
+        path = os.path.join(self.cache_dir, f"{key}.pt")
+        # unique temp file for every writer, os.replace is atomic, so no writer leaves a broken file
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(text_features.cpu(), f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._remember(key, text_features)
+
+    def _remember(self, key, text_features):
+        with self.lock:
+            self.memory[key] = text_features
+            self.memory.move_to_end(key)
+            if len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
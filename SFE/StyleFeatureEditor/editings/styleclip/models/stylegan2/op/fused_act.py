@@ -22,7 +22,6 @@ class FusedLeakyReLU(nn.Module):
 
 def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2**0.5):
     rest_dim = [1] * (input.ndim - bias.ndim - 1)
-    input = input.cuda()
     if input.ndim == 3:
         return (
             F.leaky_relu(
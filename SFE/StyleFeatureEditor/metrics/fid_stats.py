@@ -0,0 +1,146 @@
+# Same module as SFE metrics/fid_stats.py and StyleRes evaluation/fid/fid_stats.py, keep the two in sync.
+import os
+import json
+import torch
+import hashlib
+import numpy as np
+
+
+def files_fingerprint(files):
+    """sha1 of the sorted file list with sizes and modification times"""
+    sha1 = hashlib.sha1()
+    for path in sorted(str(path) for path in files):
+        stat = os.stat(path)
+        sha1.update(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return sha1.hexdigest()
+
+
+def model_fingerprint(model):
+    """sha1 of the model weights"""
+    sha1 = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha1.update(name.encode())
+        sha1.update(tensor.detach().cpu().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+class FIDStatsCache:
+    """
+    Activation statistics of reference (real) image sets stored as .npz files, keyed by
+    the fingerprint of the file list. Statistics are reused only if the Inception weights
+    and the preprocessing config are the same as the stored ones.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._weights_hashes = {}
+
+    def _weights_hash(self, model):
+        # the same model is hashed once
+        if id(model) not in self._weights_hashes:
+            self._weights_hashes[id(model)] = model_fingerprint(model)
+        return self._weights_hashes[id(model)]
+
+    def _path(self, files):
+        return os.path.join(self.cache_dir, f"{files_fingerprint(files)}.npz")
+
+    def load(self, files, model, preprocessing):
+        """Returns (mu, sigma) or None if there are no valid statistics for these files"""
+        path = self._path(files)
+        if not os.path.isfile(path):
+            return None
+
+        stats = np.load(path)
+        if (
+            int(stats["n_samples"]) != len(files)
+            or str(stats["weights_hash"]) != self._weights_hash(model)
+            or str(stats["preprocessing"]) != json.dumps(preprocessing, sort_keys=True)
+        ):
+            return None
+        print(f"Using cached FID statistics from {path}")
+        return stats["mu"], stats["sigma"]
+
+    def save(self, files, model, preprocessing, mu, sigma):
+        path = self._path(files)
+        np.savez(
+            path + ".tmp.npz",
+            mu=mu,
+            sigma=sigma,
+            n_samples=len(files),
+            weights_hash=self._weights_hash(model),
+            preprocessing=json.dumps(preprocessing, sort_keys=True),
+        )
+        os.replace(path + ".tmp.npz", path)
+
+
+class ActivationStatistics:
+    """
+    Running count, sum and sum of outer products of activations, accumulated in float64
+    on the device. Memory does not depend on the number of images, and statistics of
+    disjoint image sets (e.g. computed by several workers) are merged by addition.
+    """
+    def __init__(self, dims=2048, device="cpu"):
+        self.n = 0
+        self.sum = torch.zeros(dims, dtype=torch.float64, device=device)
+        self.outer_sum = torch.zeros(dims, dims, dtype=torch.float64, device=device)
+
+    def update(self, activations):
+        """activations -- batch x dims"""
+        activations = activations.to(self.sum.device, torch.float64)
+        self.n += activations.size(0)
+        self.sum += activations.sum(dim=0)
+        self.outer_sum += activations.T @ activations
+
+    def merge(self, other):
+        self.n += other.n
+        self.sum += other.sum.to(self.sum.device)
+        self.outer_sum += other.outer_sum.to(self.outer_sum.device)
+        return self
+
+    def mean_cov(self):
+        """Mean and unbiased covariance as in np.cov, as float64 numpy arrays"""
+        assert self.n > 1, "At least two samples are needed for the covariance"
+        mu = self.sum / self.n
+        sigma = (self.outer_sum - self.n * torch.outer(mu, mu)) / (self.n - 1)
+        return mu.cpu().numpy(), sigma.cpu().numpy()
+
+    def save(self, path):
+        np.savez(path, n=self.n, sum=self.sum.cpu().numpy(), outer_sum=self.outer_sum.cpu().numpy())
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        data = np.load(path)
+        stats = cls(dims=data["sum"].shape[0], device=device)
+        stats.n = int(data["n"])
+        stats.sum = torch.from_numpy(data["sum"]).to(device)
+        stats.outer_sum = torch.from_numpy(data["outer_sum"]).to(device)
+        return stats
+
+
+def trace_sqrt_product(sigma1, sigma2, device=None):
+    """
+    tr(sqrtm(sigma1 @ sigma2)) for symmetric positive semidefinite matrices. sigma1 @ sigma2 is similar
+    to sqrt(sigma1) @ sigma2 @ sqrt(sigma1), which is symmetric, so two eigh calls replace the Schur based
+    sqrtm. Runs in float64 with torch.linalg on device if it is given, with numpy otherwise.
+    """
+    if device is None:
+        eigvals, eigvecs = np.linalg.eigh(sigma1)
+        sqrt_sigma1 = (eigvecs * np.sqrt(np.clip(eigvals, 0, None))) @ eigvecs.T
+        product = sqrt_sigma1 @ sigma2 @ sqrt_sigma1
+        eigvals = np.linalg.eigvalsh((product + product.T) / 2)
+        return float(np.sqrt(np.clip(eigvals, 0, None)).sum())
+
+    sigma1 = torch.as_tensor(sigma1, dtype=torch.float64, device=device)
+    sigma2 = torch.as_tensor(sigma2, dtype=torch.float64, device=device)
+    eigvals, eigvecs = torch.linalg.eigh(sigma1)
+    sqrt_sigma1 = (eigvecs * eigvals.clamp(min=0).sqrt()) @ eigvecs.T
+    product = sqrt_sigma1 @ sigma2 @ sqrt_sigma1
+    eigvals = torch.linalg.eigvalsh((product + product.T) / 2)
+    return eigvals.clamp(min=0).sqrt().sum().item()
+
+
+def frechet_distance_eigh(mu1, sigma1, mu2, sigma2, device=None):
+    """Frechet distance with trace_sqrt_product, matches the sqrtm version within numerical tolerance"""
+    diff = np.atleast_1d(mu1) - np.atleast_1d(mu2)
+    tr_covmean = trace_sqrt_product(np.atleast_2d(sigma1), np.atleast_2d(sigma2), device=device)
+    return float(diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2) - 2 * tr_covmean)
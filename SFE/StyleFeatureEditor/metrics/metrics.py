@@ -1,6 +1,7 @@
 import os
 import json
 import sys
+import logging
 from tqdm import tqdm
 import numpy as np
 import multiprocessing as mp
@@ -8,13 +9,14 @@ import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
-from pytorch_fid.fid_score import calculate_fid_given_paths
+from pytorch_fid.fid_score import IMAGE_EXTENSIONS
 from scipy import linalg
 from torch.nn.functional import adaptive_avg_pool2d
 from pytorch_fid.inception import InceptionV3
 from configs.paths import DefaultPaths
 
 import math
+import pathlib
 import time
 import piq
 
@@ -26,6 +28,7 @@ from criteria.id_vit_loss import IDVitLoss
 from criteria.id_loss import IDLoss
 from criteria.ms_ssim import MSSSIM
 from datasets.datasets import FIDDataset, MetricsPathsDataset, MetricsDataDataset
+from metrics.fid_stats import FIDStatsCache, ActivationStatistics, frechet_distance_eigh
 
 from models.mtcnn.mtcnn import MTCNN
 from models.psp.encoders.model_irse import IR_101
@@ -33,13 +36,76 @@ from models.psp.encoders.model_irse import IR_101
 
 metrics_registry = ClassRegistry()
 
+logger = logging.getLogger(__name__)
+
+LOSS_RESULT_FORMAT = "Average {name} loss is {mean:.3f}+-{std:.3f}"
+ID_RESULT_FORMAT = "New ID Average score is {mean:.3f}+-{std:.3f}"
+
+
+def report_scores(name, scores_dict, out_path=None, silent=False, result_format=LOSS_RESULT_FORMAT):
+    """
+    Prints mean and std of the per image scores unless silent, saves scores_dict to out_path
+    as json if it is set. Returns (scores_dict, mean, std) as the metrics do.
+    """
+    all_scores = list(scores_dict.values())
+    mean_score, std_score = np.mean(all_scores), np.std(all_scores)
+    if not silent:
+        print(result_format.format(name=name, mean=mean_score, std=std_score))
+
+    if out_path:
+        with open(out_path, "w") as f:
+            json.dump(scores_dict, f)
+    return scores_dict, mean_score, std_score
+
+
+def report_value(name, value, out_path=None, silent=False):
+    """report_scores for metrics with a single value over the dataset, e.g. FID"""
+    result_str = f"Average {name} loss is {value:.3f}\n"
+    if not silent:
+        print(result_str)
+
+    if out_path:
+        with open(out_path, "w") as f:
+            f.write(result_str)
+    return None, value, 0.0
+
+
+def compute_pair_scores(dataset, score_func, batch_size, n_workers, device="cuda", names=None):
+    """
+    Runs score_func(fake_batch, real_batch) -> per image scores once per batch of the pairs dataset.
+    Scores stay on the device until the end, so there is a single host sync.
+    Scores are keyed by names if given, by the basenames of dataset.paths otherwise.
+    """
+    device = torch.device(device)
+    dataloader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=n_workers,
+        drop_last=False,
+        pin_memory=device.type == "cuda",
+    )
+
+    batch_scores = []
+    with torch.no_grad():
+        for fake_batch, real_batch in tqdm(dataloader):
+            fake_batch = fake_batch.to(device, non_blocking=True)
+            real_batch = real_batch.to(device, non_blocking=True)
+            batch_scores.append(score_func(fake_batch, real_batch).flatten().float())
+    batch_scores = torch.cat(batch_scores).cpu().tolist()
+
+    if names is None:
+        names = [os.path.basename(img_path) for img_path in dataset.paths]
+    return dict(zip(names, batch_scores))
+
 
 @metrics_registry.add_to_registry(name="lpips")
 class LPIPSMetric:
-    def __init__(self, batch_size=4, n_workers=4):
-        self.loss_func = LPIPS(net_type="alex")
+    def __init__(self, batch_size=4, n_workers=4, device="cuda"):
+        self.loss_func = LPIPS(net_type="alex", device=device)
         self.batch_size = batch_size
         self.n_workers = n_workers
+        self.device = device
 
     def get_name(self):
         return "LPIPS"
@@ -82,39 +148,15 @@ class LPIPSMetric:
 
         assert self.batch_size > 0
 
-        dataloader = DataLoader(
+        scores_dict = compute_pair_scores(
             dataset,
-            batch_size=self.batch_size,
-            shuffle=False,
-            num_workers=self.n_workers,
-            drop_last=False,
+            lambda fake, real: self.loss_func(fake, real, reduction="none"),
+            self.batch_size,
+            self.n_workers,
+            self.device,
         )
-        scores_dict = {}
-        idx = 0
-        for fake_batch, real_batch in tqdm(dataloader):
-            for i in range(fake_batch.size(0)):
-                loss = float(
-                    self.loss_func(
-                        fake_batch[i : i + 1].cuda(), real_batch[i : i + 1].cuda()
-                    )
-                )
-                img_path = dataset.paths[idx]
-                scores_dict[os.path.basename(img_path)] = loss
-                idx += 1
-
-        all_losses = list(scores_dict.values())
-        mean_score = np.mean(all_losses)
-        std_score = np.std(all_losses)
-        if not silent:
-            result_str = (
-                f"Average {self.get_name()} loss is {mean_score:.3f}+-{std_score:.3f}"
-            )
-            print(result_str)
 
-        if out_path:
-            with open(out_path, "w") as f:
-                json.dump(scores_dict, f)
-        return scores_dict, mean_score, std_score
+        return report_scores(self.get_name(), scores_dict, out_path=out_path, silent=silent)
 
 
 @metrics_registry.add_to_registry(name="id_vit")
@@ -182,27 +224,20 @@ class ID_VITMetric:
                 scores_dict[os.path.basename(img_path)] = loss
                 idx += 1
 
-        all_losses = list(scores_dict.values())
-        mean_score = np.mean(all_losses)
-        std_score = np.std(all_losses)
-        if not silent:
-            result_str = (
-                f"Average {self.get_name()} loss is {mean_score:.3f}+-{std_score:.3f}"
-            )
-            print(result_str)
-
-        if out_path:
-            with open(out_path, "w") as f:
-                json.dump(scores_dict, f)
-        return scores_dict, mean_score, std_score
+        return report_scores(self.get_name(), scores_dict, out_path=out_path, silent=silent)
 
 
 @metrics_registry.add_to_registry(name="l2")
 class L2Metric:
-    def __init__(self, batch_size=4, n_workers=4):
-        self.loss_func = torch.nn.MSELoss()
+    def __init__(self, batch_size=4, n_workers=4, device="cuda"):
         self.batch_size = batch_size
         self.n_workers = n_workers
+        self.device = device
+
+    @staticmethod
+    def loss_func(fake_batch, real_batch):
+        # per image mse
+        return ((fake_batch - real_batch) ** 2).mean(dim=(1, 2, 3))
 
     def get_name(self):
         return "L2"
@@ -243,50 +278,24 @@ class L2Metric:
             )
             self.batch_size = len(dataset) 
 
-        dataloader = DataLoader(
-            dataset,
-            batch_size=self.batch_size,
-            shuffle=False,
-            num_workers=self.n_workers,
-            drop_last=False,
+        scores_dict = compute_pair_scores(
+            dataset, self.loss_func, self.batch_size, self.n_workers, self.device
         )
-        scores_dict = {}
-        idx = 0
-        for fake_batch, real_batch in tqdm(dataloader):
-            for i in range(fake_batch.size(0)):
-                loss = float(
-                    self.loss_func(
-                        fake_batch[i : i + 1].cuda(), real_batch[i : i + 1].cuda()
-                    )
-                )
-                img_path = dataset.paths[idx]
-                scores_dict[os.path.basename(img_path)] = loss
-                idx += 1
-
-        all_losses = list(scores_dict.values())
-        mean_score = np.mean(all_losses)
-        std_score = np.std(all_losses)
-
-        if not silent:
-            result_str = (
-                f"Average {self.get_name()} loss is {mean_score:.3f}+-{std_score:.3f}"
-            )
-            print(result_str)
-
-        if out_path:
-            with open(out_path, "w") as f:
-                json.dump(scores_dict, f)
 
-        return scores_dict, mean_score, std_score
+        return report_scores(self.get_name(), scores_dict, out_path=out_path, silent=silent)
 
 
 @metrics_registry.add_to_registry(name="fid")
 class FIDMetric:
-    def __init__(self, batch_size=64, device="cuda", dims=2048, n_workers=8):
+    def __init__(self, batch_size=64, device="cuda", dims=2048, n_workers=8, stats_cache_dir="", frechet="sqrtm"):
+        assert frechet in ("sqrtm", "eigh"), f"Unknown frechet distance implementation {frechet}"
         self.batch_size = batch_size
         self.device = device
         self.dims = dims
         self.n_workers = n_workers
+        self.frechet = frechet
+        # statistics of the real images are reused between calls if set
+        self.stats_cache = FIDStatsCache(stats_cache_dir) if stats_cache_dir else None
 
     def get_name(self):
         return "FID"
@@ -304,33 +313,87 @@ class FIDMetric:
                 from_data, self.batch_size, self.device, self.dims, self.n_workers
             )
         else:
-            fid_value = calculate_fid_given_paths(
-                [real_data_path, fake_data_path],
-                self.batch_size,
-                self.device,
-                self.dims,
-                self.n_workers,
-            )
-
-        if not silent:
-            result_str = f"Average {self.get_name()} loss is {fid_value:.3f}\n"
-            print(result_str)
+            fid_value = self.calculate_fid_given_paths([real_data_path, fake_data_path])
+
+        return report_value(self.get_name(), fid_value, out_path=out_path, silent=silent)
+
+    def cached_statistics(self, files, model, preprocessing, compute_func):
+        """Statistics of the reference files from the cache, compute_func() is called on a miss"""
+        if self.stats_cache is None:
+            return compute_func()
+
+        stats = self.stats_cache.load(files, model, preprocessing)
+        if stats is None:
+            stats = compute_func()
+            self.stats_cache.save(files, model, preprocessing, *stats)
+        return stats
+
+    def get_model(self):
+        block_idx = InceptionV3.BLOCK_INDEX_BY_DIM[self.dims]
+        return InceptionV3([block_idx]).to(self.device).eval()
+
+    def calculate_fid_given_paths(self, paths):
+        """
+        Same result as pytorch_fid calculate_fid_given_paths, images are streamed from disk.
+        Statistics of the first (real) path may come from the cache.
+        """
+        model = self.get_model()
+        (m1, s1), (m2, s2) = [self.path_statistics(path, model, cache=i == 0) for i, path in enumerate(paths)]
+        return self.calculate_frechet_distance(m1, s1, m2, s2)
+
+    def path_statistics(self, path, model, cache=False):
+        """(mu, sigma) of a pytorch_fid .npz file or of all images in the directory, cached if cache is set"""
+        if path.endswith(".npz"):
+            with np.load(path) as f:
+                return f["mu"][:], f["sigma"][:]
+
+        # same file list as in pytorch_fid
+        files = sorted(
+            file for ext in IMAGE_EXTENSIONS for file in pathlib.Path(path).glob(f"*.{ext}")
+        )
+        compute_func = lambda: self.calculate_activation_statistics(
+            files, model, self.batch_size, self.dims, self.device, self.n_workers
+        )
+        if not cache:
+            return compute_func()
+        return self.cached_statistics(files, model, {"loader": "pytorch_fid", "dims": self.dims}, compute_func)
+
+    def calculate_fid_given_datasets(self, real_dataset, fake_dataset, real_files=None, real_preprocessing=""):
+        """
+        FID between two datasets of 0..1 image tensors, streamed through the DataLoader.
+        If real_files are given, statistics of the real dataset are cached by them.
+        """
+        model = self.get_model()
+
+        compute_real_func = lambda: self.dataset_statistics(real_dataset, model).mean_cov()
+        if real_files:
+            preprocessing = {"source": real_preprocessing, "dims": self.dims}
+            m1, s1 = self.cached_statistics(real_files, model, preprocessing, compute_real_func)
+        else:
+            m1, s1 = compute_real_func()
+        m2, s2 = self.dataset_statistics(fake_dataset, model).mean_cov()
 
-        if out_path:
-            with open(out_path, "w") as f:
-                f.write(result_str)
-        return None, fid_value, 0.0
+        return self.calculate_frechet_distance(m1, s1, m2, s2)
 
     def calculate_fid_given_data(
         self, from_data, batch_size, device, dims, num_workers=1
     ):
+        model = self.get_model()
 
-        block_idx = InceptionV3.BLOCK_INDEX_BY_DIM[dims]
-        model = InceptionV3([block_idx]).to(device)
-
-        m1, s1 = self.calculate_activation_statistics(
+        compute_real_func = lambda: self.calculate_activation_statistics(
             from_data["inp_data"], model, batch_size, dims, device, num_workers, 
         )
+        if from_data.get("inp_paths"):
+            # inp_preprocessing describes how inp_data was made from inp_paths
+            inp_data = from_data["inp_data"]
+            preprocessing = {
+                "source": from_data.get("inp_preprocessing", ""),
+                "dims": dims,
+                "cars_resize": self.needs_cars_resize(inp_data),
+            }
+            m1, s1 = self.cached_statistics(from_data["inp_paths"], model, preprocessing, compute_real_func)
+        else:
+            m1, s1 = compute_real_func()
         m2, s2 = self.calculate_activation_statistics(
             from_data["fake_data"], model, batch_size, dims, device, num_workers,
         )
@@ -339,35 +402,56 @@ class FIDMetric:
 
         return fid_value
 
+    @staticmethod
+    def needs_cars_resize(files):
+        # files are PIL images or paths, only image headers are read
+        sizes = set()
+        for file in files[:2]:
+            if isinstance(file, Image.Image):
+                sizes.add(file.size)
+            else:
+                with Image.open(file) as image:
+                    sizes.add(image.size)
+        return len(sizes) > 1
+
     def calculate_activation_statistics(
         self, files, model, batch_size=50, dims=2048, device="cpu", num_workers=1, fid_func=None, is_real=False
     ):
-        act = self.get_activations(files, model, batch_size, dims, device, num_workers, fid_func=fid_func, is_real=is_real)
-        mu = np.mean(act, axis=0)
-        sigma = np.cov(act, rowvar=False)
-        return mu, sigma
+        if self.needs_cars_resize(files):
+            dataset = FIDDataset(files, transforms=transforms.Compose([
+                transforms.Resize((384, 512)),
+                transforms.ToTensor()]))
+        else:
+            dataset = FIDDataset(files, transforms=transforms.ToTensor())
 
-    def get_activations(
-        self, files, model, batch_size=50, dims=2048, device="cpu", num_workers=1, fid_func=None, is_real=False
-    ):
+        stats = self.dataset_statistics(dataset, model, batch_size, dims, device, num_workers)
+        return stats.mean_cov()
+
+    def get_features(self, batch, model):
+        pred = model(batch)[0]
+
+        # If model output is not scalar, apply global spatial average pooling.
+        # This happens if you choose a dimensionality not equal 2048.
+        if pred.size(2) != 1 or pred.size(3) != 1:
+            pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
+        return pred.squeeze(3).squeeze(2)
+
+    def dataset_statistics(self, dataset, model, batch_size=None, dims=None, device=None, num_workers=None):
+        """Streams the dataset through the model, only running sums of the activations are kept"""
+        batch_size = batch_size or self.batch_size
+        dims = dims or self.dims
+        device = torch.device(device or self.device)
+        num_workers = self.n_workers if num_workers is None else num_workers
         model.eval()
 
-        if batch_size > len(files):
+        if batch_size > len(dataset):
             print(
                 (
                     "Warning: batch size is bigger than the data size. "
                     "Setting batch size to data size"
                 )
             )
-            batch_size = len(files)
-
-        if np.all(files[0].size == files[1].size):
-            dataset = FIDDataset(files, transforms=transforms.ToTensor())
-        else:
-            # cars case
-            dataset = FIDDataset(files, transforms=transforms.Compose([
-                transforms.Resize((384, 512)),
-                transforms.ToTensor()]))
+            batch_size = len(dataset)
 
         dataloader = torch.utils.data.DataLoader(
             dataset,
@@ -375,28 +459,22 @@ class FIDMetric:
             shuffle=False,
             drop_last=False,
             num_workers=num_workers,
+            pin_memory=device.type == "cuda",
         )
-        pred_arr = np.empty((len(files), dims))
-        start_idx = 0
-        face_pool = torch.nn.AdaptiveAvgPool2d((224, 224))
-
-        for batch in tqdm(dataloader):
-            batch = batch.to(device)
-
-            with torch.no_grad():
-                pred = model(batch)[0]
-
-            # If model output is not scalar, apply global spatial average pooling.
-            # This happens if you choose a dimensionality not equal 2048.
-            if pred.size(2) != 1 or pred.size(3) != 1:
-                pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
 
-            pred = pred.squeeze(3).squeeze(2).cpu().numpy()
-            pred_arr[start_idx : start_idx + pred.shape[0]] = pred
-            start_idx = start_idx + pred.shape[0]
-        return pred_arr
+        stats = ActivationStatistics(dims, device=device)
+        with torch.no_grad():
+            for batch in tqdm(dataloader):
+                batch = batch.to(device, non_blocking=True)
+                stats.update(self.get_features(batch, model))
+        return stats
 
     def calculate_frechet_distance(self, mu1, sigma1, mu2, sigma2, eps=1e-6):
+        if self.frechet == "eigh":
+            # symmetric eigendecompositions instead of sqrtm, on gpu if the metric runs there
+            device = self.device if torch.device(self.device).type == "cuda" else None
+            return frechet_distance_eigh(mu1, sigma1, mu2, sigma2, device=device)
+
         mu1 = np.atleast_1d(mu1)
         mu2 = np.atleast_1d(mu2)
 
@@ -437,13 +515,18 @@ class FIDMetric:
 
 @metrics_registry.add_to_registry(name="msssim")
 class MSSSIMMetric:
-    def __init__(self):
-        self.loss_func = piq.multi_scale_ssim
+    def __init__(self, batch_size=4, n_workers=4, device="cuda"):
         self.image_size = (1024, 1024)
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.device = device
 
     def get_name(self):
         return "MSSSIM"
 
+    def loss_func(self, fake_batch, real_batch):
+        return piq.multi_scale_ssim(fake_batch, real_batch, data_range=1.0, reduction="none")
+
     def __call__(
         self,
         real_data_path,
@@ -452,63 +535,37 @@ class MSSSIMMetric:
         from_data=None,
         silent=False,
     ):
-
+        # PIL resize is bicubic by default
+        transform = transforms.Compose(
+            [
+                transforms.Resize(self.image_size, interpolation=transforms.InterpolationMode.BICUBIC),
+                transforms.ToTensor(),
+            ]
+        )
         if from_data:
-            scores_dict = {}
-            image_transform = transforms.ToTensor()
-            cnt = 0
-
-            for real_image, fake_image in tqdm(
-                zip(from_data["inp_data"], from_data["fake_data"])
-            ):
-                gt_image = real_image.convert("RGB").resize(self.image_size)
-                gt_image = image_transform(gt_image).cuda().unsqueeze(0)
-
-                pred_image = fake_image.convert("RGB").resize(self.image_size)
-                pred_image = image_transform(pred_image).cuda().unsqueeze(0)
-
-                score = self.loss_func(pred_image, gt_image, data_range=1.0)
-                scores_dict[os.path.basename(from_data["paths"][cnt])] = score.item()
-                cnt += 1
+            dataset = MetricsDataDataset(
+                from_data["paths"],
+                from_data["inp_data"],
+                from_data["fake_data"],
+                transform=transform,
+            )
+            names = None
         else:
-            real_filenames = sorted(os.listdir(real_data_path))
-            fake_filenames = sorted(os.listdir(fake_data_path))
-
-            scores_dict = {}
-            image_transform = transforms.ToTensor()
-
-            for real_fn, fake_fn in tqdm(zip(real_filenames, fake_filenames)):
-                gt_image = (
-                    Image.open(os.path.join(real_data_path, real_fn))
-                    .convert("RGB")
-                    .resize(self.image_size)
-                )
-                gt_image = image_transform(gt_image).cuda().unsqueeze(0)
-
-                pred_image = (
-                    Image.open(os.path.join(fake_data_path, fake_fn))
-                    .convert("RGB")
-                    .resize(self.image_size)
-                )
-                pred_image = image_transform(pred_image).cuda().unsqueeze(0)
-
-                score = self.loss_func(pred_image, gt_image, data_range=1.0)
-                scores_dict[os.path.basename(real_fn)] = score.item()
-        all_losses = list(scores_dict.values())
-        mean_score = np.mean(all_losses)
-        std_score = np.std(all_losses)
-
-        if not silent:
-            result_str = (
-                f"Average {self.get_name()} loss is {mean_score:.3f}+-{std_score:.3f}"
+            dataset = MetricsPathsDataset(
+                root_path=fake_data_path, gt_dir=real_data_path, transform=transform
             )
-            print(result_str)
-
-        if out_path:
-            with open(out_path, "w") as f:
-                json.dump(scores_dict, f)
+            # scores are keyed by the real image name
+            names = [os.path.basename(gt_path) for _, gt_path, _ in dataset.pairs]
 
-        return scores_dict, mean_score, std_score
+        scores_dict = compute_pair_scores(
+            dataset,
+            self.loss_func,
+            min(self.batch_size, len(dataset)),
+            self.n_workers,
+            self.device,
+            names=names,
+        )
+        return report_scores(self.get_name(), scores_dict, out_path=out_path, silent=silent)
 
 
 @metrics_registry.add_to_registry(name="id")
@@ -556,7 +613,7 @@ class IDMetric:
                 input_im = Image.open(res_path)
                 input_im, _ = mtcnn.align(input_im)
                 if input_im is None:
-                    print("{} skipping {}".format(pid, res_path))
+                    logger.warning("%s skipping %s", pid, res_path)
                     continue
 
                 input_id = facenet(id_transform(input_im).unsqueeze(0).cuda())[0]
@@ -564,7 +621,7 @@ class IDMetric:
                 result_im = Image.open(gt_path)
                 result_im, _ = mtcnn.align(result_im)
                 if result_im is None:
-                    print("{} skipping {}".format(pid, gt_path))
+                    logger.warning("%s skipping %s", pid, gt_path)
                     continue
 
                 result_id = facenet(id_transform(result_im).unsqueeze(0).cuda())[0]
@@ -603,7 +660,7 @@ class IDMetric:
 
             input_im, _ = mtcnn.align(input_im)
             if input_im is None:
-                print("{} skipping {}".format(pid, paths[i]))
+                logger.warning("%s skipping %s", pid, paths[i])
                 continue
 
             input_id = facenet(id_transform(input_im).unsqueeze(0).cuda())[0]
@@ -612,7 +669,7 @@ class IDMetric:
 
             result_im, _ = mtcnn.align(result_im)
             if result_im is None:
-                print("{} skipping {}".format(pid, paths[i]))
+                logger.warning("%s skipping %s", pid, paths[i])
                 continue
 
             result_id = facenet(id_transform(result_im).unsqueeze(0).cuda())[0]
@@ -654,17 +711,198 @@ class IDMetric:
         for d in results:
             scores_dict.update(d)
 
-        all_scores = list(scores_dict.values())
-        mean = np.mean(all_scores)
-        std = np.std(all_scores)
+        return report_scores(
+            self.get_name(), scores_dict, out_path=out_path, silent=silent, result_format=ID_RESULT_FORMAT
+        )
+        
+
+class MetricViews:
+    """Makes all metric inputs from one decoded image, so every file is decoded once"""
+    def __init__(self, views):
+        self.views = views
 
-        if not silent:
-            result_str = "New ID Average score is {:.3f}+-{:.3f}".format(mean, std)
-            print(result_str)
+    def __call__(self, image):
+        return {name: transform(image) for name, transform in self.views.items()}
+
+
+class AlignedFaceView:
+    """
+    MTCNN aligned and normalized face for the id metric, returns (face, found). MTCNN is made
+    on the first call, so every DataLoader worker aligns its own images with its own detector.
+    """
+    def __init__(self):
+        self.mtcnn = None
+        self.transform = transforms.Compose(
+            [
+                transforms.ToTensor(),
+                transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5]),
+            ]
+        )
 
-        if out_path:
-            with open(out_path, "w") as f:
-                json.dump(scores_dict, f)
+    def __getstate__(self):
+        # workers are spawned, the detector is not sent to them
+        return {**self.__dict__, "mtcnn": None}
+
+    def __call__(self, image):
+        if self.mtcnn is None:
+            self.mtcnn = MTCNN()
+        with torch.no_grad():
+            face, _ = self.mtcnn.align(image)
+        if face is None:
+            # a placeholder keeps the batch collatable, found tells which faces are real
+            return torch.zeros(3, 112, 112), False
+        return self.transform(face), True
+
+
+class FusedMetrics:
+    """
+    Computes several pair metrics in one pass over the data. Every image pair is decoded once
+    in the DataLoader workers and resized once per input size, then each batch is fanned out
+    to all metrics. Faces for the id metric are aligned in the workers too. Scores and outputs
+    are the same as of the separate metrics. As in FIDMetric, real FID statistics are over every
+    image of the real directory and may come from its cache.
+    """
+    supported = ("lpips", "l2", "msssim", "id", "fid")
+
+    def __init__(self, metric_names, batch_size=4, n_workers=4, device="cuda", fid_stats_cache_dir=""):
+        assert all(name in self.supported for name in metric_names), f"Only {self.supported} can be fused"
+        self.metric_names = list(metric_names)
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.device = torch.device(device)
+
+        self.metrics = {}
+        for name in self.metric_names:
+            kwargs = {} if name == "id" else {"device": device}
+            if name == "fid":
+                kwargs["stats_cache_dir"] = fid_stats_cache_dir
+            self.metrics[name] = metrics_registry[name](**kwargs)
+
+        views = {}
+        if "lpips" in self.metrics or "l2" in self.metrics:
+            views["small"] = transforms.Compose(
+                [
+                    transforms.Resize((256, 256)),
+                    transforms.ToTensor(),
+                    transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5]),
+                ]
+            )
+        if "msssim" in self.metrics:
+            views["msssim"] = transforms.Compose(
+                [
+                    transforms.Resize(
+                        self.metrics["msssim"].image_size,
+                        interpolation=transforms.InterpolationMode.BICUBIC,
+                    ),
+                    transforms.ToTensor(),
+                ]
+            )
+        if "fid" in self.metrics:
+            # uint8 keeps the host to device copy small
+            views["full"] = transforms.PILToTensor()
+        if "id" in self.metrics:
+            views["face"] = AlignedFaceView()
+        self.transform = MetricViews(views)
+
+        if "fid" in self.metrics:
+            self.inception = self.metrics["fid"].get_model()
+
+        if "id" in self.metrics:
+            self.facenet = IR_101(input_size=112)
+            self.facenet.load_state_dict(torch.load(self.metrics["id"].curricular_face_path))
+            self.facenet.to(self.device).eval()
+
+    def _id_scores(self, fake_view, real_view, names):
+        # views are (faces, found) batches made by AlignedFaceView in the DataLoader workers
+        fake_faces, fake_found = fake_view
+        real_faces, real_found = real_view
+        for name, fake_ok, real_ok in zip(names, fake_found.tolist(), real_found.tolist()):
+            if not fake_ok:
+                logger.warning("skipping fake %s", name)
+            elif not real_ok:
+                logger.warning("skipping real %s", name)
+
+        found = fake_found & real_found
+        if not found.any():
+            return {}
+        fake_ids = self.facenet(fake_faces[found].to(self.device, non_blocking=True))
+        real_ids = self.facenet(real_faces[found].to(self.device, non_blocking=True))
+        scores = (fake_ids * real_ids).sum(dim=1).cpu().tolist()
+        face_names = [name for name, ok in zip(names, found.tolist()) if ok]
+        return dict(zip(face_names, scores))
+
+    def __call__(self, real_data_path, fake_data_path, metrics_dir="", silent=False):
+        dataset = MetricsPathsDataset(
+            root_path=fake_data_path, gt_dir=real_data_path, transform=self.transform, return_path=True
+        )
+        dataloader = DataLoader(
+            dataset,
+            batch_size=min(self.batch_size, len(dataset)),
+            shuffle=False,
+            num_workers=self.n_workers,
+            drop_last=False,
+            pin_memory=self.device.type == "cuda",
+            # MTCNN of the id view runs on cuda, which needs spawned workers
+            multiprocessing_context="spawn" if "id" in self.metrics and self.n_workers > 0 else None,
+        )
 
-        return scores_dict, mean, std
-        
\ No newline at end of file
+        batch_scores = {name: [] for name in ("lpips", "l2", "msssim") if name in self.metrics}
+        id_scores = {}
+        if "fid" in self.metrics:
+            # real statistics are over the whole real directory, not only over the paired images
+            fid_real_stats = self.metrics["fid"].path_statistics(real_data_path, self.inception, cache=True)
+            fid_fake_stats = ActivationStatistics(self.metrics["fid"].dims, device=self.device)
+        names = []
+        with torch.no_grad():
+            for fake_views, real_views, batch_names in tqdm(dataloader):
+                names.extend(batch_names)
+
+                if "small" in fake_views:
+                    fake_batch = fake_views["small"].to(self.device, non_blocking=True)
+                    real_batch = real_views["small"].to(self.device, non_blocking=True)
+                    if "lpips" in self.metrics:
+                        batch_scores["lpips"].append(
+                            self.metrics["lpips"].loss_func(fake_batch, real_batch, reduction="none").flatten()
+                        )
+                    if "l2" in self.metrics:
+                        batch_scores["l2"].append(self.metrics["l2"].loss_func(fake_batch, real_batch))
+
+                if "msssim" in self.metrics:
+                    fake_batch = fake_views["msssim"].to(self.device, non_blocking=True)
+                    real_batch = real_views["msssim"].to(self.device, non_blocking=True)
+                    batch_scores["msssim"].append(self.metrics["msssim"].loss_func(fake_batch, real_batch))
+
+                if "fid" in self.metrics:
+                    images = fake_views["full"].to(self.device, non_blocking=True).float() / 255
+                    fid_fake_stats.update(self.metrics["fid"].get_features(images, self.inception))
+
+                if "id" in self.metrics:
+                    # id scores are keyed by the real image name, as in IDMetric
+                    id_names = [name.replace(".png", ".jpg") for name in batch_names]
+                    id_scores.update(self._id_scores(fake_views["face"], real_views["face"], id_names))
+
+        results = {}
+        for name, scores in batch_scores.items():
+            scores = torch.cat(scores).float().cpu().tolist()
+            # msssim and id are keyed by the real image name, as in MSSSIMMetric and IDMetric
+            score_names = [img_name.replace(".png", ".jpg") for img_name in names] if name == "msssim" else names
+            results[name] = dict(zip(score_names, scores))
+        if "id" in self.metrics:
+            results["id"] = id_scores
+
+        outputs = {}
+        for name in self.metric_names:
+            metric = self.metrics[name]
+            out_path = os.path.join(metrics_dir, f"{metric.get_name()}.json") if metrics_dir else None
+
+            if name == "fid":
+                m1, s1 = fid_real_stats
+                m2, s2 = fid_fake_stats.mean_cov()
+                fid_value = metric.calculate_frechet_distance(m1, s1, m2, s2)
+                outputs[name] = report_value(metric.get_name(), fid_value, out_path=out_path, silent=silent)
+            else:
+                result_format = ID_RESULT_FORMAT if name == "id" else LOSS_RESULT_FORMAT
+                outputs[name] = report_scores(
+                    metric.get_name(), results[name], out_path=out_path, silent=silent, result_format=result_format
+                )
+        return outputs
@@ -3,6 +3,7 @@ from facer.face_parsing import FaRLFaceParser
 from facer.face_detection import RetinaFaceDetector
 from facer.face_detection.retinaface import RetinaFace
 from configs.paths import DefaultPaths
+from utils.common_utils import MaskerCantFindFaceError
 import torch.backends.cudnn as cudnn
 import numpy as np
 
@@ -89,10 +90,30 @@ def my_fd_init(self, model_path=DefaultPaths.mobile_net_pth, trash=0.8):
 
 RetinaFaceDetector.__init__ = my_fd_init
 
+# detector thresholds tried one after another until a face is found
+DETECTOR_THRESHOLDS = [0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.01]
+
+
+def filter_faces(faces, thresholds=DETECTOR_THRESHOLDS):
+    """
+    Emulates running the detector with lower and lower thresholds until a face is found,
+    for each image separately, on detections made once with the lowest threshold.
+    """
+    keep = torch.zeros_like(faces['scores'], dtype=torch.bool)
+    for image_id in faces['image_ids'].unique():
+        image_faces = faces['image_ids'] == image_id
+        for trash in thresholds:
+            image_keep = image_faces & (faces['scores'] >= trash)
+            if image_keep.any():
+                keep |= image_keep
+                break
+    return {key: value[keep] for key, value in faces.items()}
+
 class TargetMask(nn.Module):
     def __init__(self, tfm=True):
         super().__init__()
-        self.face_detector = RetinaFaceDetector(trash=0.8).cuda().eval()
+        # detect with the lowest threshold once, higher thresholds are applied by filter_faces
+        self.face_detector = RetinaFaceDetector(trash=DETECTOR_THRESHOLDS[-1]).cuda().eval()
         self.face_parser = FaRLFaceParser().cuda().eval()
         self.to_farl = transforms.Compose(
             [
@@ -112,7 +133,7 @@ class TargetMask(nn.Module):
     def get_mask(self, y, threshold=0.5):
         #print(y.type(), y.shape, y.max(), y.min())
         y = y.long()
-        faces = self.face_detector(y)
+        faces = filter_faces(self.face_detector(y), thresholds=[0.8])
         #print(len(faces['image_ids']))
         faces = self.face_parser(y, faces)
         
@@ -133,18 +154,7 @@ class TargetMask(nn.Module):
         
     def forward2(self, x, y):
         batch = (255. * self.to_farl(y)).long()
-        try:
-            faces = self.face_detector(batch)
-            assert len(faces['image_ids']) != 0
-        except:
-            for trash in [0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1]:
-                try:
-                    new_masker = Masker(trash=trash)
-                    faces = new_masker.face_detector(batch)
-                    assert len(faces['image_ids']) != 0
-                    break
-                except:
-                    pass
+        faces = filter_faces(self.face_detector(batch), thresholds=DETECTOR_THRESHOLDS[:-1])
         assert len(faces['image_ids']) != 0
         faces = self.face_parser(batch, faces)
         farl_mask = self.sigm(faces['seg']['logits'][:, 0])
@@ -159,6 +169,19 @@ class Masker(nn.Module):
         self.face_detector = RetinaFaceDetector(trash=trash).cuda().eval()
         self.face_parser = FaRLFaceParser().cuda().eval()
 
+    def get_background_masks(self, images, thresholds=DETECTOR_THRESHOLDS):
+        """
+        Background probabilities (bs x H x W) of the first found face of every image in the batch.
+        The detector runs once, so the masker should be built with trash=min(thresholds).
+        """
+        faces = filter_faces(self.face_detector(images), thresholds)
+        found_ids = faces['image_ids'].unique()
+        if len(found_ids) != images.size(0):
+            raise MaskerCantFindFaceError("Masker's face detector can't find face in your image 😢")
+        faces = self.face_parser(images, faces)
+        uniq_idx = self.get_u_idxs(faces['image_ids'])
+        return F.sigmoid(faces['seg']['logits'][uniq_idx, 0])
+
     def get_u_idxs(self, all_indexes):
             res = []
             for i in range(all_indexes[-1] + 1):
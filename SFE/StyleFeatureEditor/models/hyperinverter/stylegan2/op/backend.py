@@ -0,0 +1,36 @@
+import os
+import importlib
+import warnings
+
+import torch
+from torch.utils.cpp_extension import load
+
+
+# "auto" uses the CUDA kernels when they can be loaded and falls back to native PyTorch,
+# "native" never touches nvcc (e.g. for CPU inference workers)
+OPS_BACKEND = os.getenv("STYLEGAN2_OPS_BACKEND", "auto")
+# persistent directory for the compiled extensions, so containers do not rebuild them on every start
+OPS_BUILD_DIR = os.getenv("STYLEGAN2_OPS_BUILD_DIR")
+
+
+def load_cuda_op(name, sources):
+    if OPS_BACKEND == "native" or not torch.cuda.is_available():
+        return None
+
+    try:  # prebuilt extension available on sys.path
+        return importlib.import_module(name)
+    except ImportError:
+        pass
+
+    build_directory = None
+    if OPS_BUILD_DIR is not None:
+        build_directory = os.path.join(OPS_BUILD_DIR, name)
+        os.makedirs(build_directory, exist_ok=True)
+
+    try:
+        return load(name, sources=sources, build_directory=build_directory)
+    except Exception as e:
+        if OPS_BACKEND == "cuda":
+            raise
+        warnings.warn(f"Can not load CUDA op {name}, use native PyTorch implementation instead: {e}")
+        return None
@@ -27,7 +27,9 @@ class FSEFull(nn.Module):
     def __init__(self,
                  device="cuda:0",
                  checkpoint_path=None,
-                 inverter_pth=None):
+                 inverter_pth=None,
+                 fp16=False,
+                 channels_last=False):
         super(FSEFull, self).__init__()
         self.opts = {
             "device": device,
@@ -47,6 +49,23 @@ class FSEFull(nn.Module):
 
         self.pool = torch.nn.AdaptiveAvgPool2d((256, 256))
         self.load_weights()
+        self.set_precision(fp16, channels_last)
+
+    def set_precision(self, fp16=False, channels_last=False):
+        """
+        Inference only. fp16 runs the encoders and the generator under autocast, latents,
+        style modulation and ToRGB layers stay in fp32. channels_last converts the encoders,
+        the generator keeps NCHW since its modulated convolutions are grouped over the batch.
+        """
+        self.fp16 = fp16
+        self.decoder.fp16 = fp16
+
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        for module in [self.inverter, self.e4e_encoder, self.encoder]:
+            module.to(memory_format=memory_format)
+
+    def autocast(self):
+        return torch.autocast("cuda", dtype=torch.float16, enabled=self.fp16)
 
 
     def load_disc(self):
@@ -108,7 +127,7 @@ class FSEFull(nn.Module):
     def forward(self, x, return_latents=False, n_iter=1e5):
         x = F.interpolate(x, size=(256, 256), mode="bilinear", align_corners=False)
 
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
             w_recon, predicted_feat = self.inverter.fs_backbone(x)
             w_recon = w_recon + self.latent_avg
                     
@@ -126,7 +145,8 @@ class FSEFull(nn.Module):
             fused_feat = self.inverter.fuser(torch.cat([predicted_feat, w_feat], dim=1))
             delta = torch.zeros_like(fused_feat)  # inversion case
 
-        edited_feat = self.encoder(torch.cat([fused_feat, delta], dim=1))
+        with self.autocast():
+            edited_feat = self.encoder(torch.cat([fused_feat, delta], dim=1))
         feats = [None] * 9 + [edited_feat] + [None] * (17 - 9)
 
         images, _ = self.decoder(
@@ -140,6 +160,9 @@ class FSEFull(nn.Module):
         )
 
         if return_latents:
+            # features are stored and edited later in fp32 NCHW
+            fused_feat = fused_feat.float().contiguous()
+            predicted_feat = predicted_feat.float().contiguous()
             if not self.encoder.training:
                 fused_feat = fused_feat.cpu()
                 predicted_feat = predicted_feat.cpu()
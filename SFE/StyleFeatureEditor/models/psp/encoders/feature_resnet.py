@@ -141,7 +141,7 @@ class IResNet(nn.Module):
 
     def forward(self, x, return_features=False):
         out = []
-        with torch.cuda.amp.autocast(self.fp16):
+        with torch.autocast("cuda", dtype=torch.float16, enabled=self.fp16):
             x = self.conv1(x)
             x = self.bn1(x)
             x = self.prelu(x)
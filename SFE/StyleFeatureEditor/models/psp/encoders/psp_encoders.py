@@ -86,9 +86,12 @@ class FSLikeBackbone(nn.Module):
         features.append(self.avg_pool(x))
 
         x = torch.cat(features, dim=1)
-        x = x.view(x.size(0), -1)
+        x = torch.flatten(x, 1)
 
-        return self.apply_head(x), content 
+        # latents are predicted in fp32 under autocast
+        with torch.autocast("cuda", enabled=False):
+            latents = self.apply_head(x.float())
+        return latents, content
 
 
 class ContentLayerDeepFast(nn.Module):
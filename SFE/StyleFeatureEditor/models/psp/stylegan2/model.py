@@ -231,24 +231,27 @@ class ModulatedConv2d(nn.Module):
 
     def forward(self, input, style, is_stylespace=False):
         batch, in_channel, height, width = input.shape
-        
-        weight = self.weight
 
-        if not is_stylespace:
-            style = self.modulation(style)
-        style = style.view(batch, 1, in_channel, 1, 1)
-        weight = self.scale * weight * style
+        # modulation and demodulation stay in fp32 under autocast, only the convolution runs in fp16
+        with torch.autocast("cuda", enabled=False):
+            weight = self.weight
+
+            style = style.float()
+            if not is_stylespace:
+                style = self.modulation(style)
+            style = style.view(batch, 1, in_channel, 1, 1)
+            weight = self.scale * weight * style
 
-        if self.demodulate:
-            demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
-            weight = weight * demod.view(batch, self.out_channel, 1, 1, 1)
+            if self.demodulate:
+                demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
+                weight = weight * demod.view(batch, self.out_channel, 1, 1, 1)
 
         weight = weight.view(
             batch * self.out_channel, in_channel, self.kernel_size, self.kernel_size
         )
 
         if self.upsample:
-            input = input.view(1, batch * in_channel, height, width)
+            input = input.reshape(1, batch * in_channel, height, width)
             weight = weight.view(
                 batch, self.out_channel, in_channel, self.kernel_size, self.kernel_size
             )
@@ -263,14 +266,14 @@ class ModulatedConv2d(nn.Module):
         elif self.downsample:
             input = self.blur(input)
             _, _, height, width = input.shape
-            input = input.view(1, batch * in_channel, height, width)
+            input = input.reshape(1, batch * in_channel, height, width)
             out = F.conv2d(input, weight, padding=0, stride=2, groups=batch)
             _, _, height, width = out.shape
             out = out.view(batch, self.out_channel, height, width)
 
         else:
             padding = self.padding
-            input = input.view(1, batch * in_channel, height, width)
+            input = input.reshape(1, batch * in_channel, height, width)
             out = F.conv2d(input, weight, padding=padding, groups=batch)
             _, _, height, width = out.shape
             out = out.view(batch, self.out_channel, height, width)
@@ -289,7 +292,7 @@ class NoiseInjection(nn.Module):
             batch, _, height, width = image.shape
             noise = image.new_empty(batch, 1, height, width).normal_()
 
-        return image + self.weight * noise
+        return image + (self.weight * noise).to(image.dtype)
 
 
 class ConstantInput(nn.Module):
@@ -353,13 +356,15 @@ class ToRGB(nn.Module):
         self.bias = nn.Parameter(torch.zeros(1, 3, 1, 1))
 
     def forward(self, input, style, skip=None, is_stylespace=False):
-        out = self.conv(input, style, is_stylespace)
-        out = out + self.bias
+        # rgb output is accumulated in fp32
+        with torch.autocast("cuda", enabled=False):
+            out = self.conv(input.float(), style, is_stylespace)
+            out = out + self.bias
 
-        if skip is not None:
-            skip = self.upsample(skip)
+            if skip is not None:
+                skip = self.upsample(skip)
 
-            out = out + skip
+                out = out + skip
 
         return out
 
@@ -379,6 +384,7 @@ class Generator(nn.Module):
         self.size = size
 
         self.style_dim = style_dim
+        self.fp16 = False  # synthesis under autocast, see forward
 
         layers = [PixelNorm()]
 
@@ -472,7 +478,12 @@ class Generator(nn.Module):
     def get_latent(self, input):
         return self.style(input)
 
-    def forward(
+    def forward(self, styles, *args, **kwargs):
+        # features are fp16 if self.fp16, images are always fp32
+        with torch.autocast("cuda", dtype=torch.float16, enabled=self.fp16):
+            return self.synthesize(styles, *args, **kwargs)
+
+    def synthesize(
         self,
         styles,
         return_latents=False,
@@ -3,9 +3,12 @@ import os
 import torch
 from torch import nn
 from torch.autograd import Function
-from torch.utils.cpp_extension import load
+from torch.nn import functional as F
+
+from .backend import load_cuda_op
+
 module_path = os.path.dirname(__file__)
-fused = load(
+fused = load_cuda_op(
     "fused",
     sources=[
         os.path.join(module_path, "fused_bias_act.cpp"),
@@ -80,4 +83,18 @@ class FusedLeakyReLU(nn.Module):
 
 
 def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2**0.5):
-    return FusedLeakyReLUFunction.apply(input, bias, negative_slope, scale)
+    bias = bias.to(input.dtype)  # fp16 activations under autocast
+    if fused is not None and input.is_cuda:
+        return FusedLeakyReLUFunction.apply(input, bias, negative_slope, scale)
+    return fused_leaky_relu_native(input, bias, negative_slope, scale)
+
+
+def fused_leaky_relu_native(input, bias, negative_slope=0.2, scale=2**0.5):
+    rest_dim = [1] * (input.ndim - bias.ndim - 1)
+    return (
+        F.leaky_relu(
+            input + bias.view(1, bias.shape[0], *rest_dim), negative_slope=negative_slope
+        )
+        * scale
+    )
+
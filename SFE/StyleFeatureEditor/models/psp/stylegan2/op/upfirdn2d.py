@@ -2,10 +2,12 @@ import os
 
 import torch
 from torch.autograd import Function
-from torch.utils.cpp_extension import load
+from torch.nn import functional as F
+
+from .backend import load_cuda_op
 
 module_path = os.path.dirname(__file__)
-upfirdn2d_op = load(
+upfirdn2d_op = load_cuda_op(
     "upfirdn2d",
     sources=[
         os.path.join(module_path, "upfirdn2d.cpp"),
@@ -140,9 +142,15 @@ class UpFirDn2d(Function):
 
 
 def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
-    out = UpFirDn2d.apply(
-        input, kernel, (up, up), (down, down), (pad[0], pad[1], pad[0], pad[1])
-    )
+    kernel = kernel.to(input.dtype)  # fp16 activations under autocast
+    if upfirdn2d_op is not None and input.is_cuda:
+        out = UpFirDn2d.apply(
+            input, kernel, (up, up), (down, down), (pad[0], pad[1], pad[0], pad[1])
+        )
+    else:
+        out = upfirdn2d_native(
+            input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1]
+        )
 
     return out
 
@@ -150,6 +158,9 @@ def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
 def upfirdn2d_native(
     input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
 ):
+    _, channel, in_h, in_w = input.shape
+    input = input.reshape(-1, in_h, in_w, 1)
+
     _, in_h, in_w, minor = input.shape
     kernel_h, kernel_w = kernel.shape
 
@@ -180,5 +191,9 @@ def upfirdn2d_native(
         in_w * up_x + pad_x0 + pad_x1 - kernel_w + 1,
     )
     out = out.permute(0, 2, 3, 1)
+    out = out[:, ::down_y, ::down_x, :]
+
+    out_h = (in_h * up_y + pad_y0 + pad_y1 - kernel_h) // down_y + 1
+    out_w = (in_w * up_x + pad_x0 + pad_x1 - kernel_w) // down_x + 1
 
-    return out[:, ::down_y, ::down_x, :]
+    return out.reshape(-1, channel, out_h, out_w)
@@ -70,7 +70,11 @@ class BaseRunner:
         return edited_latents
 
     def _setup_latent_editor(self):
-        self.latent_editor = LatentEditor(self.config.exp.domain)
+        self.latent_editor = LatentEditor(
+            self.config.exp.domain,
+            mappers_cache_size=omegaconf.OmegaConf.select(self.config, "inference.mappers_cache_size", default=4),
+            warmup_mappers=omegaconf.OmegaConf.select(self.config, "inference.warmup_mappers", default=[]),
+        )
 
     def _setup_device(self):
         config_device = self.config.model["device"].lower()
@@ -2,18 +2,21 @@ import os
 import json
 import wandb
 import time
+import threading
 
 import torch
 import numpy as np
 from abc import abstractmethod 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm
 from io import BytesIO
 import torch.nn.functional as F
 
 from PIL import Image
 from pathlib import Path
+from omegaconf import OmegaConf
 
 from utils.class_registry import ClassRegistry
 from datasets.datasets import ImageDataset
@@ -22,79 +25,253 @@ from utils.common_utils import tensor2im
 from runners.base_runner import BaseRunner
 from training.loggers import BaseTimer
 from utils.common_utils import get_keys
+from utils.inversion_store import InversionStore, file_checksum
 from metrics.metrics import metrics_registry
 
 
 inference_runner_registry = ClassRegistry()
 
 
-@inference_runner_registry.add_to_registry(name="base_inference_runner")
-class BaseInferenceRunner(BaseRunner):
-    def run(self):
-        self.run_inversion()
-        self.run_editing()
+def stack_edited_latents(edited_latents, is_stylespace):
+    # per image edits from get_edited_latent -> (batch x degrees) rows, image-major
+    if is_stylespace:
+        return tuple(
+            [torch.cat(layer_latents, dim=0) for layer_latents in zip(*[edits[part] for edits in edited_latents])]
+            for part in range(2)
+        )
+    return torch.cat([torch.cat(edits, dim=0) for edits in edited_latents], dim=0)
+
+
+def slice_edited_latents(edited_latents, start, end, is_stylespace):
+    if is_stylespace:
+        return tuple([latent[start:end] for latent in part] for part in edited_latents)
+    return [edited_latents[start:end]]
 
-    @torch.inference_mode()
-    def run_inversion(self):
-        output_inv_dir =  Path(self.config.exp.output_dir) / "inversion"
-        output_inv_dir.mkdir(parents=True, exist_ok=True)
 
+class ImageSaver:
+    """Encodes and saves images in background threads, at most max_pending images wait in memory"""
+    def __init__(self, n_workers=4, max_pending=64):
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
 
+    def save(self, tensor, path):
+        self.slots.acquire()
+        self.executor.submit(self._save, tensor.cpu(), path)
+
+    def _save(self, tensor, path):
+        try:
+            tensor2im(tensor).save(path)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+
+@inference_runner_registry.add_to_registry(name="base_inference_runner")
+class BaseInferenceRunner(BaseRunner):
+    def setup(self):
+        super().setup()
+        # simple configs may come without an inference section, so fall back to defaults
+        self.share_e4e_decode = OmegaConf.select(self.config, "inference.share_e4e_decode", default=True)
+        self.editing_batch_size = OmegaConf.select(self.config, "inference.editing_batch_size", default=8)
+        self.streaming = OmegaConf.select(self.config, "inference.streaming", default=True)
+        self.saving_workers = OmegaConf.select(self.config, "inference.saving_workers", default=4)
+        self.max_pending_saves = OmegaConf.select(self.config, "inference.max_pending_saves", default=64)
+        self.inversion_store_dir = OmegaConf.select(self.config, "inference.inversion_store", default="")
+        self.inversion_store_chunk = OmegaConf.select(self.config, "inference.inversion_store_chunk", default=256)
+
+    def run(self):
+        if self.inversion_store_dir:
+            self.run_with_store()
+        elif self.streaming:
+            self.run_streaming()
+        else:
+            self.run_inversion()
+            self.run_editing()
+
+    def _get_dataloader(self, skip_names=None):
         transform_dict = transforms_registry[self.config.data.transform]().get_transforms()
         dataset = ImageDataset(self.config.data.inference_dir, transform_dict["test"])
-        dataloader = DataLoader(
+        self.paths = dataset.paths
+        if skip_names is not None:
+            keep = [i for i, path in enumerate(dataset.paths) if os.path.basename(path) not in skip_names]
+            self.paths = [dataset.paths[i] for i in keep]
+            dataset = Subset(dataset, keep)
+
+        # pinned batches are copied to gpu asynchronously
+        return DataLoader(
             dataset,
             batch_size=self.config.model.batch_size,
             shuffle=False,
             num_workers=self.config.model.workers,
+            pin_memory=True
         )
 
+    def _get_saver(self):
+        return ImageSaver(n_workers=self.saving_workers, max_pending=self.max_pending_saves)
+
+    def _make_editing_dirs(self, editing_name, editing_degrees):
+        output_edit_dir =  Path(self.config.exp.output_dir) / editing_name
+        output_edit_paths = []
+
+        for editing_degree in editing_degrees:
+            editing_dir_degree_pth = output_edit_dir / f"edit_power_{editing_degree:.4f}"
+            editing_dir_degree_pth.mkdir(parents=True, exist_ok=True)
+            output_edit_paths.append(editing_dir_degree_pth)
+        return output_edit_paths
+
+    def _save_edited(self, saver, edited_imgs_batch, img_names, output_edit_paths):
+        for edited_imgs, img_name in zip(edited_imgs_batch, img_names):
+            for edited_img_tensor, save_dir in zip(edited_imgs, output_edit_paths):
+                saver.save(edited_img_tensor, save_dir / img_name)
+
+    @torch.inference_mode()
+    def run_streaming(self):
+        """Inverts and edits the dataset batch by batch, nothing is kept after the batch is saved"""
+        output_inv_dir =  Path(self.config.exp.output_dir) / "inversion"
+        output_inv_dir.mkdir(parents=True, exist_ok=True)
+
+        editing_data = OmegaConf.select(self.config, "inference.editings_data", default={})
+        output_edit_paths = {
+            editing_name: self._make_editing_dirs(editing_name, editing_degrees)
+            for editing_name, editing_degrees in editing_data.items()
+        }
+
+        dataloader = self._get_dataloader()
+        self.method.eval()
+        saver = self._get_saver()
+
+        print(f"Start inversion and editing for {list(editing_data.keys())}")
+        global_i = 0
+        try:
+            for input_batch in tqdm(dataloader):
+                input_cuda = input_batch.to(self.device, non_blocking=True).float()
+                img_names = [os.path.basename(path) for path in self.paths[global_i : global_i + len(input_batch)]]
+                global_i += len(input_batch)
+
+                images, result_batch = self._run_on_batch(input_cuda)
+                for tensor, img_name in zip(images.cpu(), img_names):
+                    saver.save(tensor, output_inv_dir / img_name)
+
+                for editing_name, editing_degrees in editing_data.items():
+                    edited_imgs_batch = self._run_editing_on_batch(
+                        result_batch, editing_name, editing_degrees
+                    )
+                    self._save_edited(saver, edited_imgs_batch.cpu(), img_names, output_edit_paths[editing_name])
+        finally:
+            saver.close()
+
+    @torch.inference_mode()
+    def run_with_store(self):
+        """
+        Inverts only images that are not in the inversion store yet, then streams
+        the stored results of the dataset images through all configured edits.
+        """
+        checksum = file_checksum(self.config.model.checkpoint_path)
+        # predicted_feat is not used for editing
+        store = InversionStore(
+            self.inversion_store_dir, checksum, chunk_size=self.inversion_store_chunk, skip_keys=("predicted_feat",)
+        )
+
+        output_inv_dir =  Path(self.config.exp.output_dir) / "inversion"
+        output_inv_dir.mkdir(parents=True, exist_ok=True)
+
+        dataloader = self._get_dataloader(skip_names=store)
+        self.method.eval()
+        saver = self._get_saver()
+
+        print(f"Start inversion of {len(self.paths)} images, {len(store)} are already in {store.root}")
+        global_i = 0
+        try:
+            for input_batch in tqdm(dataloader):
+                input_cuda = input_batch.to(self.device, non_blocking=True).float()
+                img_names = [os.path.basename(path) for path in self.paths[global_i : global_i + len(input_batch)]]
+                global_i += len(input_batch)
+
+                images, result_batch = self._run_on_batch(input_cuda)
+                for tensor, img_name in zip(images.cpu(), img_names):
+                    saver.save(tensor, output_inv_dir / img_name)
+                store.append(img_names, result_batch)
+            store.flush()
+
+            editing_data = OmegaConf.select(self.config, "inference.editings_data", default={})
+            output_edit_paths = {
+                editing_name: self._make_editing_dirs(editing_name, editing_degrees)
+                for editing_name, editing_degrees in editing_data.items()
+            }
+            dataset_names = set(os.path.basename(path) for path in ImageDataset(self.config.data.inference_dir).paths)
+
+            print(f"Start editing for {list(editing_data.keys())}")
+            # chunks are large for disk i/o, edits are made by batch_size images
+            stored_batches = store.iter_chunks(names=dataset_names, batch_size=self.config.model.batch_size)
+            for img_names, result_batch in tqdm(stored_batches):
+                result_batch["latents"] = result_batch["latents"].to(self.device)
+                if "w_e4e" in result_batch:
+                    result_batch["w_e4e"] = result_batch["w_e4e"].to(self.device)
+
+                for editing_name, editing_degrees in editing_data.items():
+                    edited_imgs_batch = self._run_editing_on_batch(
+                        result_batch, editing_name, editing_degrees
+                    )
+                    self._save_edited(saver, edited_imgs_batch.cpu(), img_names, output_edit_paths[editing_name])
+        finally:
+            saver.close()
+
+    @torch.inference_mode()
+    def run_inversion(self):
+        output_inv_dir =  Path(self.config.exp.output_dir) / "inversion"
+        output_inv_dir.mkdir(parents=True, exist_ok=True)
+
+        dataloader = self._get_dataloader()
+
         self.method_results = []
-        self.paths = dataset.paths
         self.method.eval()
+        saver = self._get_saver()
 
         print("Start inversion")
         global_i = 0
 
-        for input_batch in tqdm(dataloader):
-            input_cuda = input_batch.to(self.device).float()
+        try:
+            for input_batch in tqdm(dataloader):
+                input_cuda = input_batch.to(self.device, non_blocking=True).float()
 
-            images, result_batch = self._run_on_batch(input_cuda)
-            result_batch["img_names"] = []
-            
-            for tensor in images:
-                image = tensor2im(tensor)
-                img_name = os.path.basename(dataset.paths[global_i])
-                result_batch["img_names"].append(img_name)
-                image.save(output_inv_dir / img_name)
-                global_i += 1
+                images, result_batch = self._run_on_batch(input_cuda)
+                result_batch["img_names"] = []
 
-            self.method_results.append(result_batch)
+                for tensor in images.cpu():
+                    img_name = os.path.basename(self.paths[global_i])
+                    result_batch["img_names"].append(img_name)
+                    saver.save(tensor, output_inv_dir / img_name)
+                    global_i += 1
+
+                self.method_results.append(result_batch)
+        finally:
+            saver.close()
 
 
     @torch.inference_mode()
     def run_editing(self):
         editing_data = self.config.inference.editings_data
+        saver = self._get_saver()
 
-        for editing_name, editing_degrees in editing_data.items():
-            print(f"Sart editing for {editing_name} direction with degrees {editing_degrees}")
-            output_edit_dir =  Path(self.config.exp.output_dir) / editing_name
-            output_edit_paths = []
+        try:
+            for editing_name, editing_degrees in editing_data.items():
+                print(f"Sart editing for {editing_name} direction with degrees {editing_degrees}")
+                output_edit_paths = self._make_editing_dirs(editing_name, editing_degrees)
 
-            for editing_degree in editing_degrees:
-                editing_dir_degree_pth = output_edit_dir / f"edit_power_{editing_degree:.4f}"
-                editing_dir_degree_pth.mkdir(parents=True, exist_ok=True)
-                output_edit_paths.append(editing_dir_degree_pth)
-
-            for method_res_batch in tqdm(self.method_results):
-                edited_imgs_batch = self._run_editing_on_batch(
-                    method_res_batch, editing_name, editing_degrees
-                )
-
-                for edited_imgs, img_name in zip(edited_imgs_batch, method_res_batch["img_names"]):
-                    for edited_img_tensor, save_dir in zip(edited_imgs, output_edit_paths):
-                        edited_img = tensor2im(edited_img_tensor)
-                        edited_img.save(save_dir / img_name)
+                for method_res_batch in tqdm(self.method_results):
+                    edited_imgs_batch = self._run_editing_on_batch(
+                        method_res_batch, editing_name, editing_degrees
+                    )
+                    self._save_edited(saver, edited_imgs_batch.cpu(), method_res_batch["img_names"], output_edit_paths)
+        finally:
+            saver.close()
 
 
     @abstractmethod
@@ -112,8 +289,9 @@ class FSEInferenceRunner(BaseInferenceRunner):
         images, w_recon, fused_feat, predicted_feat = self.method(inputs, return_latents=True)
         
         x = F.interpolate(inputs, size=(256, 256), mode="bilinear", align_corners=False)
-        w_e4e = self.method.e4e_encoder(x)
-        w_e4e = w_e4e + self.method.latent_avg
+        with self.method.autocast():
+            w_e4e = self.method.e4e_encoder(x)
+        w_e4e = w_e4e.float() + self.method.latent_avg
 
         result_batch = {
             "latents": w_recon, 
@@ -126,49 +304,105 @@ class FSEInferenceRunner(BaseInferenceRunner):
         return images, result_batch
           
     def _run_editing_on_batch(self, method_res_batch, editing_name, editing_degrees, mask=None, return_e4e=False):
+        """
+        Returns edited images, edited_images x len(editing_degrees) x 3 x 1024 x 1024, images which can not
+        be edited are skipped and the result is empty if no image is left. With return_e4e, e4e inversions
+        and edits are also returned as (edited_images x len(editing_degrees)) rows, image-major, for every
+        edited image, not only for the last one.
+        """
         orig_latents = method_res_batch["latents"]
-        edited_images = []
+        n_degrees = len(editing_degrees)
         n_iter = 1e5
 
+        # latent edits are cheap, so they are still computed per image and then stacked
+        # into (batch x degrees) rows that go through the generator together
+        edited_latents = []
+        edited_w_e4e = []
+        img_idxs = []
         for i, latent in enumerate(orig_latents):
-            edited_latents = self.get_edited_latent(
+            edited_latent = self.get_edited_latent(
                 latent.unsqueeze(0), 
                 editing_name, 
                 editing_degrees, 
                 method_res_batch["inputs"][i].unsqueeze(0)
             )
             
-            w_e4e = method_res_batch["w_e4e"][i].unsqueeze(0)
-            edited_w_e4e = self.get_edited_latent(
-                w_e4e, 
+            edited_e4e = self.get_edited_latent(
+                method_res_batch["w_e4e"][i].unsqueeze(0), 
                 editing_name, 
                 editing_degrees, 
                 method_res_batch["inputs"][i].unsqueeze(0)
             )
 
-            if edited_latents is None or edited_w_e4e is None:
+            if edited_latent is None or edited_e4e is None:
                 print(f"WARNING, skip editing {editing_name}")
                 continue
 
-            is_stylespace = isinstance(edited_latents, tuple)
-            if not is_stylespace:
-                edited_latents = torch.cat(edited_latents, dim=0).unsqueeze(0)
-                edited_w_e4e = torch.cat(edited_w_e4e, dim=0).unsqueeze(0)
-
-            w_e4e = w_e4e.repeat(len(editing_degrees), 1, 1)  # bs = len(editing_degrees)
-            w_latent = latent.unsqueeze(0).repeat(len(editing_degrees), 1, 1)
+            edited_latents.append(edited_latent)
+            edited_w_e4e.append(edited_e4e)
+            img_idxs.append(i)
+
+        if len(img_idxs) == 0:
+            empty = torch.empty(0, n_degrees, device=self.device)
+            if return_e4e:
+                return empty, empty.flatten(0, 1), empty.flatten(0, 1)
+            return empty
+
+        is_stylespace = isinstance(edited_latents[0], tuple)
+        edited_latents = stack_edited_latents(edited_latents, is_stylespace)
+        edited_w_e4e = stack_edited_latents(edited_w_e4e, is_stylespace)
+
+        img_idxs = torch.tensor(img_idxs)
+        row_idxs = img_idxs.repeat_interleave(n_degrees)  # image index of every (image, degree) row
+        w_e4e = method_res_batch["w_e4e"][img_idxs.to(method_res_batch["w_e4e"].device)]
+        fused_feats = method_res_batch["fused_feat"]
+
+        if mask is not None:
+            delta_masks = F.interpolate(mask[:, :1], size=(64, 64), mode="bilinear", align_corners=False)
+
+        e4e_inv = []
+        e4e_edit = []
+        if self.share_e4e_decode:
+            # the unedited e4e latent is decoded once per image and its fs_x[9]
+            # is broadcasted against all edited degrees
+            e4e_feats = []
+            for start in range(0, len(img_idxs), self.editing_batch_size):
+                inv, fs_x = self.method.decoder(
+                    [w_e4e[start : start + self.editing_batch_size]],
+                    input_is_latent=True,
+                    randomize_noise=False,
+                    return_latents=False,
+                    return_features=True,
+                    early_stop=None if return_e4e else 64
+                )
+                if return_e4e:
+                    e4e_inv.append(inv.repeat_interleave(n_degrees, dim=0))
+                e4e_feats.append(fs_x[9])
+            e4e_feats = torch.cat(e4e_feats)
 
-            e4e_inv, fs_x = self.method.decoder(
-                [w_e4e],
-                input_is_latent=True,
-                randomize_noise=False,
-                return_latents=False,
-                return_features=True,
-                early_stop=None if return_e4e else 64
-            )
+        edited_images = []
+        for start in range(0, len(row_idxs), self.editing_batch_size):
+            end = start + self.editing_batch_size
+            # position of the row's image among the edited images
+            pos = torch.arange(start, min(end, len(row_idxs))) // n_degrees
+
+            if self.share_e4e_decode:
+                fs_x_feat = e4e_feats[pos.to(e4e_feats.device)]
+            else:
+                inv, fs_x = self.method.decoder(
+                    [w_e4e[pos.to(w_e4e.device)]],
+                    input_is_latent=True,
+                    randomize_noise=False,
+                    return_latents=False,
+                    return_features=True,
+                    early_stop=None if return_e4e else 64
+                )
+                fs_x_feat = fs_x[9]
+                if return_e4e:
+                    e4e_inv.append(inv)
 
-            e4e_edit, fs_y = self.method.decoder(
-                edited_w_e4e,
+            edit_inv, fs_y = self.method.decoder(
+                slice_edited_latents(edited_w_e4e, start, end, is_stylespace),
                 input_is_latent=True,
                 randomize_noise=False,
                 return_latents=False,
@@ -176,23 +410,24 @@ class FSEInferenceRunner(BaseInferenceRunner):
                 return_features=True,
                 early_stop=None if return_e4e else 64
             )
+            if return_e4e:
+                e4e_edit.append(edit_inv)
 
-            delta = fs_x[9] - fs_y[9]
+            delta = fs_x_feat - fs_y[9]
 
+            chunk_img_idxs = row_idxs[start:end]
             if mask is not None:
-                delta_mask = mask[i][0].unsqueeze(0).repeat(512, 1, 1).unsqueeze(0)
-                delta_mask = F.interpolate(delta_mask, size=(64, 64), mode="bilinear", align_corners=False)
-                delta = delta *  (1 - delta_mask)
-
-            fused_feat = method_res_batch["fused_feat"][i].to(self.device)
-            fused_feat = fused_feat.repeat(len(editing_degrees), 1, 1, 1)
+                delta_mask = delta_masks[chunk_img_idxs.to(delta_masks.device)]
+                delta = delta * (1 - delta_mask)
 
+            fused_feat = fused_feats[chunk_img_idxs.to(fused_feats.device)].to(self.device)
 
-            edited_feat = self.method.encoder(torch.cat([fused_feat, delta], dim=1))  # encoder == feature editor
+            with self.method.autocast():
+                edited_feat = self.method.encoder(torch.cat([fused_feat, delta], dim=1))  # encoder == feature editor
             edit_features = [None] * 9 + [edited_feat] + [None] * (17 - 9)
 
             image_edits, _ = self.method.decoder(
-                edited_latents,
+                slice_edited_latents(edited_latents, start, end, is_stylespace),
                 input_is_latent=True,
                 new_features=edit_features,
                 feature_scale=min(1.0, 0.0001 * n_iter),
@@ -201,10 +436,12 @@ class FSEInferenceRunner(BaseInferenceRunner):
             )
 
             edited_images.append(image_edits)
-        edited_images = torch.stack(edited_images)
+        edited_images = torch.cat(edited_images)
+        edited_images = edited_images.view(len(img_idxs), n_degrees, *edited_images.shape[1:])
 
         if return_e4e:
-            return edited_images, e4e_inv, e4e_edit
+            # e4e images are returned as (batch x degrees) rows, image-major
+            return edited_images, torch.cat(e4e_inv), torch.cat(e4e_edit)
 
         return edited_images  # : torch.tensor(batch_size x len(editing_degrees) x 1024 x 1024)
 
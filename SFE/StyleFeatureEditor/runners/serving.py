@@ -0,0 +1,235 @@
+import time
+import uuid
+import queue
+import threading
+
+import torch
+
+from collections import deque, namedtuple
+
+
+ProgressEvent = namedtuple("ProgressEvent", ["stage", "percent", "message", "elapsed"])
+
+
+class JobProgress:
+    """
+    Ring buffer of the job's progress events. deque appends and reads of the last item
+    are atomic, so the worker publishes events without locks and polling is O(1).
+    """
+    def __init__(self, max_events=64):
+        self.start_time = time.monotonic()
+        self.events = deque(maxlen=max_events)
+
+    def __call__(self, stage, percent, message=""):
+        self.events.append(ProgressEvent(stage, percent, message, time.monotonic() - self.start_time))
+
+    def latest(self):
+        try:
+            return self.events[-1]
+        except IndexError:
+            return None
+
+    def history(self):
+        return list(self.events)
+
+
+def select_batch(method_res_batch, idxs):
+    """Takes images with indexes idxs from the _run_on_batch result"""
+    selected = {}
+    for key, value in method_res_batch.items():
+        selected[key] = value[torch.tensor(idxs, device=value.device)]
+    return selected
+
+
+class EditingJob:
+    def __init__(
+        self,
+        image,
+        editing_name,
+        edited_power,
+        align=False,
+        use_mask=False,
+        mask_trashold=0.995,
+        return_unaligned=True
+    ):
+        self.id = uuid.uuid4().hex
+        self.image = image
+        self.editing_name = editing_name
+        self.edited_power = edited_power
+        self.align = align
+        self.use_mask = use_mask
+        self.mask_trashold = mask_trashold
+        self.return_unaligned = return_unaligned
+
+        self.status = "queued"  # queued -> processing -> done | failed
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self.progress = JobProgress()
+        self.progress("queued", 0)
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.status = "failed" if error is not None else "done"
+        self.finished_at = time.monotonic()
+        if error is not None:
+            self.progress("failed", 100, str(error))
+        else:
+            self.progress("done", 100)
+        self.done.set()
+
+
+class EditingService:
+    """
+    Serves SimpleRunner edits for several users. Requests wait in a bounded queue, the worker
+    takes up to max_batch_size of them (waiting at most max_wait seconds for the batch to fill),
+    inverts them with one _run_on_batch call and edits every (direction, power) group
+    with one _run_editing_on_batch call. Results are kept by job id for result_ttl seconds.
+    """
+    def __init__(self, runner, max_queue_size=32, max_batch_size=8, max_wait=0.1, result_ttl=600):
+        self.runner = runner
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.result_ttl = result_ttl
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+
+        self.worker = threading.Thread(target=self._serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, image, editing_name, edited_power, **job_kwargs):
+        """Returns job id, raises queue.Full if too many requests are pending"""
+        self._drop_expired()
+        job = EditingJob(image, editing_name, edited_power, **job_kwargs)
+        with self.jobs_lock:
+            self.jobs[job.id] = job
+
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.jobs_lock:
+                del self.jobs[job.id]
+            raise
+        return job.id
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def pop_job(self, job_id):
+        """Returns the job and forgets it if it is finished"""
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.done.is_set():
+                del self.jobs[job_id]
+            return job
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        with self.jobs_lock:
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job.finished_at is not None and now - job.finished_at > self.result_ttl
+            ]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+    def _next_batch(self):
+        jobs = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(jobs) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _serve(self):
+        while True:
+            jobs = self._next_batch()
+            try:
+                self._process(jobs)
+            except Exception as e:
+                for job in jobs:
+                    if not job.done.is_set():
+                        job.finish(error=e)
+
+    def _process(self, jobs):
+        # alignment and masking are done per image, failures affect only their own job
+        prepared_jobs = []
+        for job in jobs:
+            job.status = "processing"
+            job.progress("processing", 5)
+            try:
+                prepared = self.runner.prepare_input(
+                    job.image,
+                    align=job.align,
+                    use_mask=job.use_mask,
+                    mask_trashold=job.mask_trashold,
+                    progress=job.progress
+                )
+                prepared_jobs.append((job, prepared))
+            except Exception as e:
+                job.finish(error=e)
+
+        if len(prepared_jobs) == 0:
+            return
+
+        inference_runner = self.runner.inference_runner
+        for job, _ in prepared_jobs:
+            job.progress("inversion", 40, f"batch of {len(prepared_jobs)}")
+        images = torch.cat([prepared["image"] for _, prepared in prepared_jobs])
+        with torch.no_grad():
+            inv_images, inversion_results = inference_runner._run_on_batch(images.to(inference_runner.device))
+
+        groups = {}
+        for i, (job, _) in enumerate(prepared_jobs):
+            groups.setdefault((job.editing_name, job.edited_power), []).append(i)
+
+        for (editing_name, edited_power), idxs in groups.items():
+            group = [prepared_jobs[i] for i in idxs]
+            for job, _ in group:
+                job.progress("editing", 60, f"{editing_name}, batch of {len(group)}")
+            try:
+                masks = [prepared["mask"] for _, prepared in group]
+                mask = None
+                if any(m is not None for m in masks):
+                    # zero mask keeps the whole image editable
+                    mask = torch.cat([
+                        torch.zeros_like(prepared["image"]) if m is None else m
+                        for m, (_, prepared) in zip(masks, group)
+                    ]).to(inference_runner.device)
+
+                with torch.no_grad():
+                    edited_images = inference_runner._run_editing_on_batch(
+                        method_res_batch=select_batch(inversion_results, idxs),
+                        editing_name=editing_name,
+                        editing_degrees=[edited_power],
+                        mask=mask
+                    )
+                if len(edited_images) != len(group):
+                    # skipped images would shift the results of the rest
+                    raise ValueError(f"Editing {editing_name} can not be applied to some of the images")
+
+                for pos, (job, prepared) in enumerate(group):
+                    edit_result = {
+                        "inversion": inv_images[idxs[pos]].unsqueeze(0),
+                        "edited": edited_images[pos]
+                    }
+                    try:
+                        job.finish(result=self.runner.collect_result(
+                            prepared, edit_result, return_unaligned=job.return_unaligned, progress=job.progress
+                        ))
+                    except Exception as e:
+                        job.finish(error=e)
+            except Exception as e:
+                for job, _ in group:
+                    if not job.done.is_set():
+                        job.finish(error=e)
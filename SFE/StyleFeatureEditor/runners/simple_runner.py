@@ -2,7 +2,6 @@ import os
 import cv2
 import PIL
 import torch
-import subprocess
 import numpy as np
 import torch.nn.functional as F
 import torchvision.transforms as transforms
@@ -11,121 +10,288 @@ from PIL import Image
 from pathlib import Path
 
 from omegaconf import OmegaConf
-from utils.common_utils import tensor2im, tensor2im_no_tfm, MaskerCantFindFaceError
+from utils.common_utils import tensor2im, tensor2im_no_tfm, load_rgb_image
+from utils.blending import poisson_blend
 from datasets.transforms import transforms_registry
 from runners.inference_runners import FSEInferenceRunner
 
 
-def extract_mask(image_path, save_dir_path, trash=0.995):
-    from models.farl.farl import Masker
+def report(progress, stage, percent, message=""):
+    # progress is a callable(stage, percent, message), without it stages are just printed
+    if progress is None:
+        print(message or stage)
+    else:
+        progress(stage, percent, message)
 
-    save_dir_path = Path(save_dir_path)
-    image_path = Path(image_path)
 
-    orig_img = Image.open(image_path).convert("RGB")
-    transform = transforms.ToTensor()
-    orig_img_tensor = transform(orig_img)
+def get_masker():
+    from models.farl.farl import Masker, DETECTOR_THRESHOLDS
+
+    return Masker(trash=DETECTOR_THRESHOLDS[-1])
+
 
+def get_background_mask(image, trash=0.995, masker=None):
+    """Returns 1 x H x W bool tensor, True for the background"""
+    if masker is None:
+        masker = get_masker()
+
+    orig_img_tensor = transforms.ToTensor()(load_rgb_image(image))
     orig_img_tensor = (orig_img_tensor.unsqueeze(0) * 255).long().cuda()
 
     with torch.inference_mode():
-        # try to find trashhlod for detecting face
-        for detector_trash in [0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.01]:
-            masker = Masker(trash=detector_trash)
-            faces = masker.face_detector(orig_img_tensor)
-            if len(faces['image_ids']) != 0:
-                break
-
-        if len(faces['image_ids']) == 0:
-            raise MaskerCantFindFaceError("Masker's face detector can't find face in your image 😢")
-        faces = masker.face_parser(orig_img_tensor, faces)
-
-
-    background_mask = F.sigmoid(faces['seg']['logits'][:, 0])
-    background_mask = background_mask[0].unsqueeze(0)
-    background_mask = (background_mask >= trash).cpu()
-    mask_path = save_dir_path / (image_path.stem + "_mask.jpg")
+        # detector runs once, lower thresholds are tried until a face is found
+        background_mask = masker.get_background_masks(orig_img_tensor)
+
+    return (background_mask >= trash).cpu()
+
+
+def save_mask_images(image, background_mask, save_dir_path, stem):
+    save_dir_path = Path(save_dir_path)
+    orig_img_tensor = transforms.ToTensor()(load_rgb_image(image))
+
+    mask_path = save_dir_path / (stem + "_mask.jpg")
     to_save = (background_mask[0] * 255).long().numpy()
     mask = Image.fromarray(to_save.astype(np.uint8)).convert("1")
     mask.save(mask_path)
 
-    backfround_tens = orig_img_tensor[0].cpu() / 255 * background_mask.float().repeat(3, 1, 1)
+    backfround_tens = orig_img_tensor * background_mask.float().repeat(3, 1, 1)
     background = tensor2im_no_tfm(backfround_tens)
-    back_path = save_dir_path / (image_path.stem + "_back.jpg")
+    back_path = save_dir_path / (stem + "_back.jpg")
     background.save(back_path)
 
-    face_tens = orig_img_tensor[0].cpu() / 255 * (1 - background_mask.float()).repeat(3, 1, 1)
+    face_tens = orig_img_tensor * (1 - background_mask.float()).repeat(3, 1, 1)
     face = tensor2im_no_tfm(face_tens)
-    face_path = save_dir_path / (image_path.stem + "_face.jpg")
+    face_path = save_dir_path / (stem + "_face.jpg")
     face.save(face_path)
 
     return mask_path
 
 
-def run_alignment(image_path):
-  import dlib
-  from scripts.align_all_parallel import align_face
-
-  predictor = dlib.shape_predictor("pretrained_models/shape_predictor_68_face_landmarks.dat")
-  aligned_image, unalign_dict = align_face(filepath=image_path, predictor=predictor)
-  return aligned_image, unalign_dict
-
+def extract_mask(image_path, save_dir_path, trash=0.995, masker=None):
+    background_mask = get_background_mask(image_path, trash=trash, masker=masker)
+    return save_mask_images(image_path, background_mask, save_dir_path, Path(image_path).stem)
 
-def unalign(edited_image, unalign_dict, orig_img_pth, unaligned_path):
-    quad = unalign_dict["quad"]
-    source_quad = [(0, 0), (1024, 0),  (1024, 1024), (0, 1024)]
-    dest_quad = np.array([quad[3], quad[0], quad[1], quad[2]])
-    M = cv2.getPerspectiveTransform(dest_quad.astype(np.float32), np.array(source_quad).astype(np.float32))
-    unaligned = edited_image.transpose(PIL.Image.FLIP_LEFT_RIGHT).transform(unalign_dict["pretrans_size"], PIL.Image.PERSPECTIVE, M.reshape(-1), PIL.Image.BILINEAR)
 
-    mask = np.asarray(unaligned) > 0
-    mask = np.stack([mask[:,:,0] | mask[:,:,1] | mask[:,:,2]] * 3, axis=-1)
+def run_alignment(image, cache=None):
+  from scripts.align_all_parallel import align_face_single_warp, get_predictor
 
-    if "blur1" in unalign_dict:
-      unaligned -= unalign_dict["blur2"]
-      unaligned -= unalign_dict["blur1"]
-      pad = unalign_dict["pad"]
-      unaligned = PIL.Image.fromarray(np.uint8(np.clip(np.rint(unaligned), 0, 255)), 'RGB').crop([pad[1], pad[0],  unaligned.shape[1] - pad[3], unaligned.shape[0] - pad[2]])
-      mask = mask[pad[0]:mask.shape[0]-pad[1], pad[2]:mask.shape[1]-pad[3]]
-
-    img_orig = PIL.Image.open(orig_img_pth).convert("RGB")
-
-    if "crop" in unalign_dict:
-      crop = unalign_dict["crop"]
-      unaligned = np.pad(np.float32(unaligned), ((crop[1], img_orig.size[1] - crop[3]), (crop[0], img_orig.size[0] - crop[2]), (0, 0)))
-      mask = np.pad(np.float32(mask), ((crop[1], img_orig.size[1] - crop[3]), (crop[0], img_orig.size[0] - crop[2]), (0, 0)))
-      unaligned = PIL.Image.fromarray(np.uint8(np.clip(np.rint(unaligned), 0, 255)), 'RGB')
-
-    if "shrink" in unalign_dict:
-      unaligned = unaligned.resize(unalign_dict["shrink"])
-      mask = mask.resize(unalign_dict["shrink"])
+  # predictor is loaded once per process
+  predictor = get_predictor("pretrained_models/shape_predictor_68_face_landmarks.dat")
+  aligned_image, unalign_dict = align_face_single_warp(filepath=image, predictor=predictor, cache=cache)
+  return aligned_image, unalign_dict
 
-    unaligned = np.asarray(img_orig) * (1 - mask / mask.max()) + np.asarray(unaligned) * mask / mask.max()
-    PIL.Image.fromarray(unaligned.astype('uint8'), 'RGB').save("edited.png")
-    PIL.Image.fromarray(np.uint8(np.clip(np.rint((1 - mask) * 255), 0, 255)), 'RGB').save("mask.jpg")
 
-    subprocess.run(
-            ["fpie", "-s", orig_img_pth, "-m", "mask.jpg", "-t", "edited.png", "-o", unaligned_path, "-n",
-             "5000", "-b", "taichi-gpu", "-g", "src"],
-            check=True
-        )
+def unwarp_affine(edited_image, unalign_dict):
+    """Exact inverse of align_face_single_warp, returns the image and the mask of covered pixels"""
+    edited = np.asarray(edited_image, dtype=np.float32)
+    if "blur" in unalign_dict:
+        y0, y1, x0, x1 = unalign_dict["blur_box"]
+        edited = edited.copy()
+        edited[y0:y1, x0:x1] -= unalign_dict["blur"]
+    edited = PIL.Image.fromarray(np.uint8(np.clip(np.rint(edited), 0, 255)), 'RGB')
+
+    # PIL takes original -> aligned map in pixel corner coordinates
+    inverse = np.linalg.inv(np.vstack([unalign_dict["affine"], [0, 0, 1]]))[:2]
+    data = inverse.copy()
+    data[:, 2] += 0.5 - 0.5 * (inverse[:, 0] + inverse[:, 1])
+    data = tuple(data.flatten())
+
+    size = unalign_dict["orig_size"]
+    unaligned = edited.transform(size, PIL.Image.AFFINE, data, PIL.Image.BILINEAR)
+    coverage = PIL.Image.new("L", edited.size, 255).transform(size, PIL.Image.AFFINE, data, PIL.Image.BILINEAR)
+    # partially covered border pixels are mixed with the fill color, leave them to blending
+    return np.asarray(unaligned), np.asarray(coverage) == 255
+
+
+def unalign(edited_image, unalign_dict, orig_img, unaligned_path=None, blend_margin=0.5):
+    img_orig = load_rgb_image(orig_img)
+
+    if "affine" in unalign_dict:
+        unaligned, mask = unwarp_affine(edited_image, unalign_dict)
+    else:
+        quad = unalign_dict["quad"]
+        source_quad = [(0, 0), (1024, 0),  (1024, 1024), (0, 1024)]
+        dest_quad = np.array([quad[3], quad[0], quad[1], quad[2]])
+        M = cv2.getPerspectiveTransform(dest_quad.astype(np.float32), np.array(source_quad).astype(np.float32))
+        unaligned = edited_image.transpose(PIL.Image.FLIP_LEFT_RIGHT).transform(unalign_dict["pretrans_size"], PIL.Image.PERSPECTIVE, M.reshape(-1), PIL.Image.BILINEAR)
+
+        unaligned = np.asarray(unaligned, dtype=np.float32)
+        mask = unaligned.max(axis=-1) > 0
+
+        if "blur1" in unalign_dict:
+            unaligned = unaligned - unalign_dict["blur2"] - unalign_dict["blur1"]
+            # pad is (left, top, right, bottom)
+            pad = unalign_dict["pad"]
+            h, w = mask.shape
+            unaligned = unaligned[pad[1]:h - pad[3], pad[0]:w - pad[2]]
+            mask = mask[pad[1]:h - pad[3], pad[0]:w - pad[2]]
+
+        if "crop" in unalign_dict:
+            # crop is done after shrink, so pad up to the shrinked size
+            crop = unalign_dict["crop"]
+            size = unalign_dict.get("shrink", img_orig.size)
+            pad_width = ((crop[1], size[1] - crop[3]), (crop[0], size[0] - crop[2]))
+            unaligned = np.pad(unaligned, pad_width + ((0, 0),))
+            mask = np.pad(mask, pad_width)
+
+        unaligned = np.uint8(np.clip(np.rint(unaligned), 0, 255))
+        if "shrink" in unalign_dict:
+            unaligned = np.asarray(PIL.Image.fromarray(unaligned, 'RGB').resize(img_orig.size, PIL.Image.BILINEAR))
+            mask = np.asarray(PIL.Image.fromarray(mask).resize(img_orig.size, PIL.Image.NEAREST))
+
+    source = np.asarray(img_orig, dtype=np.float32)
+    if mask.any():
+        unaligned = np.where(mask[..., None], unaligned, source)
+
+        # blend the edited face into the original image: the surrounding keeps gradients of
+        # the original image and is adjusted to the face border inside a box around the face
+        rows, cols = np.nonzero(mask)
+        margin = int(blend_margin * max(rows.max() - rows.min(), cols.max() - cols.min()))
+        blend_mask = np.zeros_like(mask)
+        blend_mask[max(rows.min() - margin, 0):rows.max() + margin + 1, max(cols.min() - margin, 0):cols.max() + margin + 1] = True
+        blend_mask &= ~mask
+
+        unaligned = poisson_blend(source, unaligned, blend_mask)
+    else:
+        # the edited face is fully off the original image, nothing to blend
+        unaligned = source
+    unaligned = PIL.Image.fromarray(np.uint8(np.clip(np.rint(unaligned), 0, 255)), 'RGB')
+
+    if unaligned_path is not None:
+        unaligned.save(unaligned_path)
+    return unaligned
 
 
 class SimpleRunner:
     def __init__(
         self, 
         editor_ckpt_pth: str, 
-        simple_config_pth: str = "configs/simple_inference.yaml"
+        simple_config_pth: str = "configs/simple_inference.yaml",
+        fp16: bool = False
     ):
 
         config = OmegaConf.load(simple_config_pth)
         config.model.checkpoint_path = editor_ckpt_pth
-        config.methods_args.fse_full = {}
+        config.methods_args.fse_full = {"fp16": fp16, "channels_last": fp16}
 
         self.inference_runner = FSEInferenceRunner(config)
         self.inference_runner.setup()
         self.inference_runner.method.eval()
         self.inference_runner.method.decoder = self.inference_runner.method.decoder.float()
+        self._masker = None
+        self._alignment_cache = None
+
+    @property
+    def alignment_cache(self):
+        # the same photo is often edited with several directions, align it once
+        if self._alignment_cache is None:
+            from scripts.align_all_parallel import AlignmentCache
+            self._alignment_cache = AlignmentCache(max_size=16)
+        return self._alignment_cache
+
+    @property
+    def masker(self):
+        # face detector and parser are loaded once, on first masked edit
+        if self._masker is None:
+            self._masker = get_masker()
+        return self._masker
+
+    def edit_tensor(self, image, editing_name, edited_power, mask=None, return_e4e=False):
+        """
+        Edits a batch of aligned images without touching the disk.
+        image -- bs x 3 x 1024 x 1024 tensor in [-1, 1], mask -- bs x 3 x 1024 x 1024 tensor, 1 for the background.
+        Returns dict with "inversion" and "edited" tensors, and "e4e_inversion", "e4e_edit" if return_e4e.
+        """
+        device = self.inference_runner.device
+        if mask is not None:
+            mask = mask.to(device)
+
+        with torch.no_grad():
+            inv_images, inversion_results = self.inference_runner._run_on_batch(image.to(device))
+            edited_image = self.inference_runner._run_editing_on_batch(
+                method_res_batch=inversion_results,
+                editing_name=editing_name,
+                editing_degrees=[edited_power],
+                mask=mask,
+                return_e4e=return_e4e
+            )
+
+        result = {"inversion": inv_images}
+        if return_e4e:
+            edited_image, result["e4e_inversion"], result["e4e_edit"] = edited_image
+        result["edited"] = edited_image[:, 0]
+        return result
+
+    def prepare_input(self, image, align=False, use_mask=False, mask_trashold=0.995, mask=None, progress=None):
+        """
+        Aligns and masks the image. Returns dict with "orig" PIL image, 1 x 3 x 1024 x 1024 "image" tensor,
+        "mask" tensor or None, and "aligned", "unalign_dict", "background_mask" if they were computed.
+        progress -- optional callable(stage, percent, message) that receives stage events instead of prints.
+        """
+        orig_img = load_rgb_image(image)
+        aligned_image = orig_img
+        prepared = {"orig": orig_img}
+
+        if align:
+            report(progress, "alignment", 10, "Aligning face")
+            aligned_image, unalign_dict = run_alignment(orig_img, cache=self.alignment_cache)
+            aligned_image = aligned_image.convert("RGB")
+            prepared["aligned"] = aligned_image
+            prepared["unalign_dict"] = unalign_dict
+
+        if use_mask and mask is None:
+            report(progress, "masking", 20, "Prepearing mask")
+            background_mask = get_background_mask(aligned_image, trash=mask_trashold, masker=self.masker)
+            prepared["background_mask"] = background_mask
+            mask = background_mask.float().repeat(3, 1, 1).unsqueeze(0)
+        elif use_mask:
+            mask = transforms.ToTensor()(load_rgb_image(mask)).unsqueeze(0)
+        else:
+            mask = None
+
+        transform_dict = transforms_registry["face_1024"]().get_transforms()
+        prepared["image"] = transform_dict["test"](aligned_image).unsqueeze(0)
+        prepared["mask"] = mask
+        return prepared
+
+    def collect_result(self, prepared, edit_result, return_unaligned=True, progress=None):
+        """Converts edit_tensor outputs of one image to PIL images and puts the edited face back if it was aligned"""
+        result = {}
+        if "aligned" in prepared:
+            result["aligned"] = prepared["aligned"]
+        if "background_mask" in prepared:
+            result["mask"] = prepared["background_mask"]
+
+        for key, images in edit_result.items():
+            result[key] = tensor2im(images[0].cpu())
+
+        if "unalign_dict" in prepared and return_unaligned:
+            report(progress, "unalignment", 90, "Blending edited face into the original image")
+            result["unaligned"] = unalign(result["edited"], prepared["unalign_dict"], prepared["orig"])
+        return result
+
+    def edit_array(
+        self,
+        image,
+        editing_name: str,
+        edited_power: float,
+        align: bool = False,
+        use_mask: bool = False,
+        mask_trashold=0.995,
+        mask=None,
+        return_e4e=False,
+        return_unaligned=True
+    ):
+        """
+        In-memory version of edit(): image (and custom mask) is a PIL image or an H x W x 3 uint8 array.
+        Returns dict with PIL images "edited" and "inversion", plus "aligned" and "unaligned" if align,
+        "e4e_inversion" and "e4e_edit" if return_e4e, and 1 x H x W bool "mask" if it was computed.
+        """
+        prepared = self.prepare_input(image, align=align, use_mask=use_mask, mask_trashold=mask_trashold, mask=mask)
+        edit_result = self.edit_tensor(
+            prepared["image"], editing_name, edited_power, mask=prepared["mask"], return_e4e=return_e4e
+        )
+        return self.collect_result(prepared, edit_result, return_unaligned=return_unaligned)
 
     def edit(
         self,
@@ -138,70 +304,59 @@ class SimpleRunner:
         mask_trashold=0.995,
         mask_path: str = None,
         save_e4e=False,
-        save_inversion=False
+        save_inversion=False,
+        save_debug=True
     ):
 
         save_pth = Path(save_pth)
         save_pth_dir = save_pth.parents[0]
         save_pth_dir.mkdir(parents=True, exist_ok=True)
-        aligned_image_pth = orig_img_pth
-
-        if align:
-            aligned_image, unalign_dict = run_alignment(orig_img_pth)
-            save_align_pth = save_pth.parents[0] / (save_pth.stem + "_aligned.jpg")
-            print(f"Save aligned image to {save_align_pth}")
-            aligned_image.convert('RGB').save(save_align_pth)
-            aligned_image_pth = save_align_pth
-
-        if use_mask and mask_path is None:
-            print("Prepearing mask")
-            mask_path = extract_mask(aligned_image_pth, save_pth.parents[0], trash=mask_trashold)
-            print("Done")
 
+        mask = None
         if use_mask and mask_path is not None:
             print(f"Use mask from {mask_path}")
-            mask = Image.open(mask_path).convert("RGB")
-            transform = transforms.ToTensor()
-            mask = transform(mask).unsqueeze(0).to(self.inference_runner.device)
-        else:
-            mask = None
-
-        orig_img = Image.open(aligned_image_pth).convert("RGB")
-        transform_dict = transforms_registry["face_1024"]().get_transforms()
-        orig_img = transform_dict["test"](orig_img).unsqueeze(0)
-
-        device = self.inference_runner.device
-        inv_images, inversion_results = self.inference_runner._run_on_batch(orig_img.to(device))
-        edited_image = self.inference_runner._run_editing_on_batch(
-            method_res_batch=inversion_results, 
-            editing_name=editing_name, 
-            editing_degrees=[edited_power],
+            mask = Image.open(mask_path)
+
+        orig_img = load_rgb_image(orig_img_pth)
+        result = self.edit_array(
+            orig_img,
+            editing_name=editing_name,
+            edited_power=edited_power,
+            align=align,
+            use_mask=use_mask,
+            mask_trashold=mask_trashold,
             mask=mask,
             return_e4e=save_e4e
         )
 
+        # aligned image and masker outputs are written only for debugging
+        mask_stem = Path(orig_img_pth).stem
+        if align and save_debug:
+            save_align_pth = save_pth_dir / (save_pth.stem + "_aligned.jpg")
+            print(f"Save aligned image to {save_align_pth}")
+            result["aligned"].save(save_align_pth)
+            mask_stem = save_align_pth.stem
+
+        if "mask" in result and save_debug:
+            save_mask_images(result.get("aligned", orig_img), result["mask"], save_pth_dir, mask_stem)
+
         if save_inversion:
-            save_inv_pth = save_pth.parents[0] / (save_pth.stem + "_inversion.jpg")
-            inv_image = tensor2im(inv_images[0].cpu())
-            inv_image.save(save_inv_pth)
+            save_inv_pth = save_pth_dir / (save_pth.stem + "_inversion.jpg")
+            result["inversion"].save(save_inv_pth)
 
         if save_e4e:
-            edited_image, e4e_inv, e4e_edit = edited_image
-
-            save_e4e_inv_pth = save_pth.parents[0] / (save_pth.stem + "_e4e_inversion.jpg")
-            e4e_inv_image = tensor2im(e4e_inv[0].cpu())
-            e4e_inv_image.save(save_e4e_inv_pth)
+            save_e4e_inv_pth = save_pth_dir / (save_pth.stem + "_e4e_inversion.jpg")
+            result["e4e_inversion"].save(save_e4e_inv_pth)
 
-            save_e4e_edit_pth = save_pth.parents[0] / (save_pth.stem + "_e4e_edit.jpg")
-            e4e_edit_image = tensor2im(e4e_edit[0].cpu())
-            e4e_edit_image.save(save_e4e_edit_pth)
+            save_e4e_edit_pth = save_pth_dir / (save_pth.stem + "_e4e_edit.jpg")
+            result["e4e_edit"].save(save_e4e_edit_pth)
 
-        edited_image = tensor2im(edited_image[0][0].cpu())
+        edited_image = result["edited"]
         edited_image.save(save_pth)
 
         if align:
-            unaligned_path = save_pth.parents[0] / (save_pth.stem + "_unaligned.jpg")
-            unalign(edited_image, unalign_dict, orig_img_pth, unaligned_path)
+            unaligned_path = save_pth_dir / (save_pth.stem + "_unaligned.jpg")
+            result["unaligned"].save(unaligned_path)
 
         return edited_image
 
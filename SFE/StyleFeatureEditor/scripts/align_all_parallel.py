@@ -14,34 +14,146 @@ requirements:
     # http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2
 """
 from argparse import ArgumentParser
-from utils.common_utils import AlignerCantFindFaceError
+from utils.common_utils import AlignerCantFindFaceError, load_rgb_image
 import time
 import numpy as np
 import PIL
 import PIL.Image
 import os
+import hashlib
+import logging
+import tempfile
+import threading
 import scipy
 import scipy.ndimage
 import dlib
 import multiprocessing as mp
 import math
+from collections import OrderedDict
 
 SHAPE_PREDICTOR_PATH = "pretrained_models/shape_predictor_68_face_landmarks.dat"
 
+logger = logging.getLogger(__name__)
 
-def get_landmark(filepath, predictor):
+# dlib models are loaded once per process
+_detector = None
+_predictors = {}
+
+
+def get_detector():
+    global _detector
+    if _detector is None:
+        _detector = dlib.get_frontal_face_detector()
+    return _detector
+
+
+def get_predictor(predictor_path=SHAPE_PREDICTOR_PATH):
+    if predictor_path not in _predictors:
+        _predictors[predictor_path] = dlib.shape_predictor(predictor_path)
+    return _predictors[predictor_path]
+
+
+class AlignmentCache:
+    """
+    Landmarks and alignment results keyed by sha1 of the image content. Alignment results
+    are kept in memory (LRU of max_size), landmarks are also stored in cache_dir if it is given.
+    Safe to share between threads.
+    """
+    def __init__(self, cache_dir=None, max_size=16):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.landmarks = OrderedDict()
+        self.alignments = OrderedDict()
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(image):
+        if isinstance(image, (str, os.PathLike)):
+            with open(image, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        if isinstance(image, PIL.Image.Image):
+            image = np.asarray(image)
+        image = np.ascontiguousarray(image)
+        return hashlib.sha1(str(image.shape).encode() + image.tobytes()).hexdigest()
+
+    def _remember(self, storage, key, value):
+        with self.lock:
+            storage[key] = value
+            storage.move_to_end(key)
+            while len(storage) > self.max_size:
+                storage.popitem(last=False)
+
+    def _recall(self, storage, key):
+        with self.lock:
+            if key not in storage:
+                return None
+            storage.move_to_end(key)
+            return storage[key]
+
+    def get_landmarks(self, key):
+        lm = self._recall(self.landmarks, key)
+        if lm is not None:
+            return lm
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + ".npy")
+            if os.path.isfile(path):
+                lm = np.load(path)
+                self._remember(self.landmarks, key, lm)
+                return lm
+        return None
+
+    def put_landmarks(self, key, lm):
+        self._remember(self.landmarks, key, lm)
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + ".npy")
+            # unique temp file for every writer, os.replace is atomic, so no writer leaves a broken file
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, lm)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def get_alignment(self, key):
+        return self._recall(self.alignments, key)
+
+    def put_alignment(self, key, img, unalign_dict):
+        self._remember(self.alignments, key, (img, unalign_dict))
+
+
+def get_landmark(filepath, predictor, detector=None, detect_scale=1.0):
     """get landmark with dlib
+    :param filepath: str, PIL Image or np.array
+    :param detect_scale: float, faces are detected on the image resized by this factor,
+        landmarks are still predicted on the full image
     :return: np.array shape=(68, 2)
     """
-    detector = dlib.get_frontal_face_detector()
-
-    img = dlib.load_rgb_image(filepath)
-    dets = detector(img, 1)
+    if detector is None:
+        detector = get_detector()
+
+    img = load_rgb_image(filepath)
+    if detect_scale < 1.0:
+        small_size = (max(int(img.size[0] * detect_scale), 1), max(int(img.size[1] * detect_scale), 1))
+        small_img = np.asarray(img.resize(small_size, PIL.Image.BILINEAR))
+        dets = [
+            dlib.rectangle(
+                int(det.left() / detect_scale), int(det.top() / detect_scale),
+                int(det.right() / detect_scale), int(det.bottom() / detect_scale)
+            )
+            for det in detector(small_img, 1)
+        ]
+    else:
+        dets = detector(np.asarray(img), 1)
+    img = np.asarray(img)
 
     if len(dets) < 1:
         raise AlignerCantFindFaceError("Face parser can not find face in your image :c Try to upload another one.")
 
-    print(f"Found {len(dets)} faces, getting the largest")
+    logger.info("Found %d faces, getting the largest", len(dets))
     dets = sorted(dets, key=lambda det: det.width() * det.height(), reverse=True)
     shape = predictor(img, dets[0])
 
@@ -53,14 +165,11 @@ def get_landmark(filepath, predictor):
     return lm
 
 
-def align_face(filepath, predictor):
+def get_quad(lm):
     """
-    :param filepath: str
-    :return: PIL Image
+    :param lm: np.array shape=(68, 2)
+    :return: oriented crop rectangle (upper-left, lower-left, lower-right, upper-right) and its size
     """
-    unalign_dict = {}
-    lm = get_landmark(filepath, predictor)
-
     lm_chin = lm[0: 17]  # left-right
     lm_eyebrow_left = lm[17: 22]  # left-right
     lm_eyebrow_right = lm[22: 27]  # left-right
@@ -89,9 +198,32 @@ def align_face(filepath, predictor):
     c = eye_avg + eye_to_mouth * 0.1
     quad = np.stack([c - x - y, c - x + y, c + x + y, c + x - y])
     qsize = np.hypot(*x) * 2
+    return quad, qsize
+
+
+def align_face(filepath, predictor, detector=None, detect_scale=1.0, cache=None):
+    """
+    :param filepath: str, PIL Image or np.array
+    :param cache: AlignmentCache, reuses landmarks and results for the same image content
+    :return: PIL Image
+    """
+    if cache is not None:
+        key = "{}_{:g}".format(cache.get_key(filepath), detect_scale)
+        cached = cache.get_alignment(key)
+        if cached is not None:
+            return cached
+
+    unalign_dict = {}
+    # decode the image once, it is used both for landmarks and for the crop
+    img = load_rgb_image(filepath)
+    lm = cache.get_landmarks(key) if cache is not None else None
+    if lm is None:
+        lm = get_landmark(img, predictor, detector=detector, detect_scale=detect_scale)
+        if cache is not None:
+            cache.put_landmarks(key, lm)
+
+    quad, qsize = get_quad(lm)
 
-    # read image
-    img = PIL.Image.open(filepath)
     unalign_dict["orig_size"] = img.size
 
     output_size = 1024
@@ -151,40 +283,182 @@ def align_face(filepath, predictor):
     if output_size < transform_size:
         img = img.resize((output_size, output_size), PIL.Image.ANTIALIAS)
 
+    if cache is not None:
+        cache.put_alignment(key, img, unalign_dict)
+
     # Save aligned image.
     return img, unalign_dict
 
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-
-def extract_on_paths(file_paths):
-    predictor = dlib.shape_predictor(SHAPE_PREDICTOR_PATH)
-    pid = mp.current_process().name
-    print('\t{} is starting to extract on #{} images'.format(pid, len(file_paths)))
-    tot_count = len(file_paths)
-    count = 0
-    for file_path, res_path in file_paths:
-        count += 1
-        if count % 100 == 0:
-            print('{} done with {}/{}'.format(pid, count, tot_count))
-        try:
-            res = align_face(file_path, predictor)
-            res = res.convert('RGB')
-            os.makedirs(os.path.dirname(res_path), exist_ok=True)
-            res.save(res_path)
-        except Exception:
-            continue
-    print('\tDone!')
+def warp_face(img, quad, qsize, output_size=1024):
+    """
+    Warps the face crop quad of img to output_size x output_size with a single transform.
+    Shrink, crop and pad are chosen as in align_face, but only the crop is shrinked and
+    reflect-padded, as uint8. The edge-padding blur is computed only in the box of aligned
+    pixels that fall outside of the original image. Unlike align_face, the median for the
+    second blur is taken over the aligned image, not over the whole padded image, so the
+    padded border can be slightly different in color. unalign_dict["affine"] (2 x 3) maps
+    aligned pixel centers to original pixel centers, so unalign can invert it exactly.
+    The same function is in SFE scripts/align_all_parallel.py and StyleRes
+    datasets/process_image.py, keep the two in sync.
+    :param img: PIL Image
+    :param quad: np.array shape=(4, 2), oriented crop rectangle from get_quad
+    :param qsize: float, size of the quad
+    :return: PIL Image, unalign_dict
+    """
+    unalign_dict = {"orig_size": img.size}
+    enable_padding = True
+
+    # Shrink, crop and pad are chosen as in align_face, in shrinked coordinates.
+    shrink = int(np.floor(qsize / output_size * 0.5))
+    size = np.array(img.size, dtype=np.float64)
+    rsize = np.rint(size / shrink) if shrink > 1 else size
+    scale = size / rsize  # original pixels per shrinked pixel
+    quad = (quad + 0.5) / scale - 0.5
+    qsize = qsize / shrink if shrink > 1 else qsize
+
+    border = max(int(np.rint(qsize * 0.1)), 3)
+    crop = (int(np.floor(min(quad[:, 0]))), int(np.floor(min(quad[:, 1]))), int(np.ceil(max(quad[:, 0]))),
+            int(np.ceil(max(quad[:, 1]))))
+    crop = (max(crop[0] - border, 0), max(crop[1] - border, 0), min(crop[2] + border, int(rsize[0])),
+            min(crop[3] + border, int(rsize[1])))
+    crop_size = (crop[2] - crop[0], crop[3] - crop[1])
+    quad -= crop[0:2]
+
+    pad = (int(np.floor(min(quad[:, 0]))), int(np.floor(min(quad[:, 1]))), int(np.ceil(max(quad[:, 0]))),
+           int(np.ceil(max(quad[:, 1]))))
+    pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - crop_size[0] + border, 0),
+           max(pad[3] - crop_size[1] + border, 0))
+    use_padding = enable_padding and max(pad) > border - 4
+    pad = np.maximum(pad, int(np.rint(qsize * 0.3))) if use_padding else np.zeros(4, dtype=int)
+
+    # Only the crop is read (and shrinked) from the original image.
+    if shrink > 1:
+        box = (crop[0] * scale[0], crop[1] * scale[1], crop[2] * scale[0], crop[3] * scale[1])
+        face = img.resize(crop_size, PIL.Image.LANCZOS, box=box)
+    else:
+        face = img.crop(crop)
+    if use_padding:
+        face = np.pad(np.asarray(face), ((pad[1], pad[3]), (pad[0], pad[2]), (0, 0)), 'reflect')
+        face = PIL.Image.fromarray(face, 'RGB')
+    quad += pad[:2]
+
+    # Transform.
+    img = face.transform((output_size, output_size), PIL.Image.QUAD, (quad + 0.5).flatten(), PIL.Image.BILINEAR)
+
+    # aligned pixel center (u, v) -> padded face pixel center
+    ex = (quad[3] - quad[0]) / output_size
+    ey = (quad[1] - quad[0]) / output_size
+    origin = quad[0] + 0.5 * (ex + ey)
+    # padded face -> original image
+    affine = np.concatenate([
+        scale[:, None] * np.stack([ex, ey], axis=1),
+        ((origin - pad[:2] + crop[:2] + 0.5) * scale - 0.5)[:, None]
+    ], axis=1)
+    unalign_dict["affine"] = affine
+
+    if use_padding:
+        w, h = face.size
+        grid = np.arange(output_size, dtype=np.float32)
+        x = origin[0] + grid[None, :] * ex[0] + grid[:, None] * ey[0]
+        y = origin[1] + grid[None, :] * ex[1] + grid[:, None] * ey[1]
+        mask = np.maximum(1.0 - np.minimum(x / pad[0], (w - 1 - x) / pad[2]),
+                          1.0 - np.minimum(y / pad[1], (h - 1 - y) / pad[3]))
+        blur_weight = np.clip(mask * 3.0 + 1.0, 0.0, 1.0)
+
+        rows, cols = np.nonzero(blur_weight)
+        if len(rows) > 0:
+            # blur only the out-of-image part, with the same sigma measured in aligned pixels
+            blur = qsize * 0.02 / np.hypot(*ex)
+            margin = int(np.ceil(3 * blur))
+            y0, y1 = max(rows.min() - margin, 0), min(rows.max() + margin + 1, output_size)
+            x0, x1 = max(cols.min() - margin, 0), min(cols.max() + margin + 1, output_size)
+
+            img = np.float32(img)
+            region = img[y0:y1, x0:x1]
+            blur1 = (scipy.ndimage.gaussian_filter(region, [blur, blur, 0]) - region) * blur_weight[y0:y1, x0:x1, None]
+            region += blur1
+
+            blur2 = (np.median(img, axis=(0, 1)) - region) * np.clip(mask[y0:y1, x0:x1, None], 0.0, 1.0)
+            region += blur2
+
+            unalign_dict["blur_box"] = (y0, y1, x0, x1)
+            unalign_dict["blur"] = blur1 + blur2
+            img = PIL.Image.fromarray(np.uint8(np.clip(np.rint(img), 0, 255)), 'RGB')
+
+    return img, unalign_dict
+
+
+def align_face_single_warp(filepath, predictor, detector=None, detect_scale=1.0, cache=None):
+    """
+    Same crop as align_face, made with a single warp by warp_face
+    :param filepath: str, PIL Image or np.array
+    :param cache: AlignmentCache, reuses landmarks and results for the same image content
+    :return: PIL Image, unalign_dict
+    """
+    if cache is not None:
+        key = "{}_{:g}".format(cache.get_key(filepath), detect_scale)
+        cached = cache.get_alignment(key + "_warp")
+        if cached is not None:
+            return cached
+
+    img = load_rgb_image(filepath)
+    lm = cache.get_landmarks(key) if cache is not None else None
+    if lm is None:
+        lm = get_landmark(img, predictor, detector=detector, detect_scale=detect_scale)
+        if cache is not None:
+            cache.put_landmarks(key, lm)
+
+    quad, qsize = get_quad(lm)
+    img, unalign_dict = warp_face(img, quad, qsize)
+
+    if cache is not None:
+        cache.put_alignment(key + "_warp", img, unalign_dict)
+
+    return img, unalign_dict
+
+
+_worker_args = {}
+
+
+def init_worker(predictor_path, detect_scale, cache_dir, single_warp=False):
+    # called once in every pool process, dlib models then live as long as the process
+    _worker_args["align_fn"] = align_face_single_warp if single_warp else align_face
+    _worker_args["predictor"] = get_predictor(predictor_path)
+    _worker_args["detector"] = get_detector()
+    _worker_args["detect_scale"] = detect_scale
+    _worker_args["cache"] = AlignmentCache(cache_dir=cache_dir, max_size=0) if cache_dir is not None else None
+
+
+def extract_on_path(paths):
+    file_path, res_path = paths
+    try:
+        res, _ = _worker_args["align_fn"](
+            file_path,
+            _worker_args["predictor"],
+            detector=_worker_args["detector"],
+            detect_scale=_worker_args["detect_scale"],
+            cache=_worker_args["cache"]
+        )
+        res = res.convert('RGB')
+        os.makedirs(os.path.dirname(res_path), exist_ok=True)
+        res.save(res_path)
+    except Exception:
+        return file_path, False
+    return file_path, True
 
 
 def parse_args():
     parser = ArgumentParser(add_help=False)
     parser.add_argument('--num_threads', type=int, default=1)
     parser.add_argument('--root_path', type=str, default='')
+    parser.add_argument('--predictor_path', type=str, default=SHAPE_PREDICTOR_PATH)
+    parser.add_argument('--detect_scale', type=float, default=1.0,
+                        help='detect faces on the image downscaled by this factor, landmarks use the full image')
+    parser.add_argument('--cache_dir', type=str, default=None, help='where to keep landmarks of processed images')
+    parser.add_argument('--chunksize', type=int, default=16)
+    parser.add_argument('--single_warp', action='store_true',
+                        help='use faster align_face_single_warp instead of the reference FFHQ alignment')
     args = parser.parse_args()
     return args
 
@@ -205,16 +479,24 @@ def run(args):
                 continue
             file_paths.append((file_path, res_path))
 
-    file_chunks = list(chunks(file_paths, int(math.ceil(len(file_paths) / args.num_threads))))
-    print(len(file_chunks))
-    pool = mp.Pool(args.num_threads)
     print('Running on {} paths\nHere we goooo'.format(len(file_paths)))
     tic = time.time()
-    pool.map(extract_on_paths, file_chunks)
+    n_failed = 0
+    with mp.Pool(
+        args.num_threads,
+        initializer=init_worker,
+        initargs=(args.predictor_path, args.detect_scale, args.cache_dir, args.single_warp)
+    ) as pool:
+        # images are handed out as workers get free, so slow images do not stall a whole chunk
+        for count, (file_path, ok) in enumerate(pool.imap_unordered(extract_on_path, file_paths, chunksize=args.chunksize), 1):
+            n_failed += not ok
+            if count % 100 == 0:
+                print('done with {}/{}, failed {}'.format(count, len(file_paths), n_failed))
     toc = time.time()
-    print('Mischief managed in {}s'.format(toc - tic))
+    print('Mischief managed in {}s, failed on {} images'.format(toc - tic, n_failed))
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     args = parse_args()
     run(args)
@@ -0,0 +1,74 @@
+import sys
+import time
+import torch
+import numpy as np
+
+sys.path =  ['.'] + sys.path
+
+from argparse import ArgumentParser
+from metrics.metrics import FIDMetric
+
+
+def load_stats(path):
+    # FIDStatsCache and pytorch_fid .npz files both store mu and sigma
+    with np.load(path) as f:
+        return f["mu"][:], f["sigma"][:]
+
+
+def random_stats(n_samples, dims, seed):
+    # non negative correlated features, like pooled Inception activations
+    rng = np.random.default_rng(seed)
+    mixing = rng.standard_normal((dims, dims)) / np.sqrt(dims)
+    features = np.maximum(rng.standard_normal((n_samples, dims)) @ mixing, 0)
+    return features.mean(axis=0), np.cov(features, rowvar=False)
+
+
+def benchmark(fid_metric, stats, repeats):
+    fid_metric.calculate_frechet_distance(*stats)  # warm up, e.g. cuda context
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        value = fid_metric.calculate_frechet_distance(*stats)
+        times.append(time.perf_counter() - start)
+    return value, np.mean(times), np.std(times)
+
+
+def run(opts):
+    if opts.stats:
+        (m1, s1), (m2, s2) = [load_stats(path) for path in opts.stats]
+    else:
+        print(f"Random statistics of {opts.n_samples} samples, {opts.dims} dims")
+        m1, s1 = random_stats(opts.n_samples, opts.dims, seed=0)
+        m2, s2 = random_stats(opts.n_samples, opts.dims, seed=1)
+    stats = (m1, s1, m2, s2)
+
+    implementations = {
+        "sqrtm": FIDMetric(frechet="sqrtm", device="cpu"),
+        "eigh numpy": FIDMetric(frechet="eigh", device="cpu"),
+    }
+    if torch.cuda.is_available():
+        implementations["eigh torch cuda"] = FIDMetric(frechet="eigh", device="cuda")
+
+    reference = None
+    for name, fid_metric in implementations.items():
+        value, mean_time, std_time = benchmark(fid_metric, stats, opts.repeats)
+        if reference is None:
+            reference = value
+        diff = abs(value - reference)
+        print(
+            f"{name:>16}: fid {value:.6f}, {mean_time:.3f}+-{std_time:.3f} s, "
+            f"abs diff {diff:.2e}, rel diff {diff / max(abs(reference), 1e-12):.2e}"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--stats", nargs=2, default=None, help="Two .npz files with mu and sigma, random statistics if not set"
+    )
+    parser.add_argument("--n_samples", default=10000, type=int, help="Samples of random statistics")
+    parser.add_argument("--dims", default=2048, type=int, help="Dimensionality of random statistics")
+    parser.add_argument("--repeats", default=3, type=int, help="Timed runs of every implementation")
+
+    opts = parser.parse_args()
+    run(opts)
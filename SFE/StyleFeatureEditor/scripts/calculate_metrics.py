@@ -6,7 +6,7 @@ sys.path =  ['.'] + sys.path
 
 from argparse import ArgumentParser
 from pathlib import Path
-from metrics.metrics import metrics_registry
+from metrics.metrics import metrics_registry, FusedMetrics
 from utils.common_utils import setup_seed
 
 
@@ -14,11 +14,26 @@ setup_seed(777)
 
 
 def run(test_opts):
+    # supported metrics share one pass over the images, the rest are calculated separately
+    fused_names = [name for name in test_opts.metrics if name in FusedMetrics.supported]
+    if fused_names and not test_opts.separate:
+        print("Calculating", ", ".join(fused_names))
+        FusedMetrics(
+            fused_names,
+            batch_size=test_opts.batch_size,
+            n_workers=test_opts.workers,
+            device=test_opts.device,
+            fid_stats_cache_dir=test_opts.fid_stats_cache_dir,
+        )(test_opts.orig_path, test_opts.reconstr_path, metrics_dir=test_opts.metrics_dir)
+    else:
+        fused_names = []
+
     metrics = []
     for metric_name in test_opts.metrics:
-        metrics.append(
-            metrics_registry[metric_name]()
-        )
+        if metric_name not in fused_names:
+            metrics.append(
+                metrics_registry[metric_name]()
+            )
 
     out_path = None
     for metric in metrics:
@@ -59,6 +74,20 @@ if __name__ == "__main__":
         type=str,
         help="Directory to save .json metrics info",
     )
+    parser.add_argument(
+        "--device", default="cuda", type=str, help="Device for the metric networks"
+    )
+    parser.add_argument(
+        "--fid_stats_cache_dir",
+        default="",
+        type=str,
+        help="Directory to cache FID statistics of the real images, empty string disables the cache",
+    )
+    parser.add_argument(
+        "--separate",
+        action="store_true",
+        help="Calculate every metric with its own pass over the images",
+    )
 
     test_opts = parser.parse_args()
     run(test_opts)
@@ -0,0 +1,93 @@
+import sys
+import torch
+import torch.nn.functional as F
+
+sys.path =  ['.'] + sys.path
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from omegaconf import OmegaConf
+from arguments import inference_arguments
+from criteria.lpips.lpips import LPIPS
+from runners.inference_runners import inference_runner_registry
+from utils.common_utils import setup_seed
+
+
+def psnr(x, y):
+    # images are in [-1, 1]
+    mse = ((x - y) ** 2).mean(dim=(1, 2, 3)) / 4
+    return 10 * torch.log10(1 / mse.clamp(min=1e-10))
+
+
+def run_precision(runner, inputs, editing_data, fp16):
+    runner.method.set_precision(fp16=fp16, channels_last=fp16)
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    images, result_batch = runner._run_on_batch(inputs)
+    outputs = {"inversion": images}
+    for editing_name, editing_degrees in editing_data.items():
+        edited = runner._run_editing_on_batch(result_batch, editing_name, editing_degrees)
+        outputs[editing_name] = edited.flatten(0, 1)
+
+    peak_memory = torch.cuda.max_memory_allocated() / 2 ** 30 if torch.cuda.is_available() else 0
+    return outputs, peak_memory
+
+
+@torch.inference_mode()
+def run_check(config, opts):
+    """Compares fp16 inference of FSEFull with fp32 on the first n_batches of the inference dataset"""
+    runner = inference_runner_registry[config.inference.inference_runner](config)
+    runner.setup()
+    runner.method.eval()
+    lpips = LPIPS(net_type="alex").eval()
+
+    editing_data = OmegaConf.select(config, "inference.editings_data", default={})
+    scores = defaultdict(list)
+    peak_memory = defaultdict(float)
+    for i, input_batch in enumerate(runner._get_dataloader()):
+        if i == opts.n_batches:
+            break
+        inputs = input_batch.to(runner.device).float()
+
+        ref_outputs, peak_memory[False] = run_precision(runner, inputs, editing_data, fp16=False)
+        half_outputs, peak_memory[True] = run_precision(runner, inputs, editing_data, fp16=True)
+
+        for name, ref in ref_outputs.items():
+            half = half_outputs[name]
+            scores[name, "psnr"].extend(psnr(ref, half).tolist())
+            scores[name, "max_abs"].append((ref - half).abs().max().item())
+            scores[name, "lpips"].append(lpips(
+                F.interpolate(ref, size=(256, 256), mode="bilinear", align_corners=False),
+                F.interpolate(half, size=(256, 256), mode="bilinear", align_corners=False)
+            ).item())
+
+    print(f"Peak memory, GB: fp32 {peak_memory[False]:.2f}, fp16 {peak_memory[True]:.2f}")
+    failed = []
+    for name in ref_outputs:
+        min_psnr = min(scores[name, "psnr"])
+        max_lpips = max(scores[name, "lpips"])
+        max_abs = max(scores[name, "max_abs"])
+        print(f"{name}: min psnr {min_psnr:.2f}, max lpips {max_lpips:.4f}, max abs diff {max_abs:.4f}")
+        if min_psnr < opts.min_psnr or max_lpips > opts.max_lpips:
+            failed.append(name)
+
+    if failed:
+        print("fp16 output differs from fp32 for", failed)
+        sys.exit(1)
+    print("fp16 output matches fp32")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--n_batches", type=int, default=4, help="Number of batches to compare")
+    parser.add_argument("--min_psnr", type=float, default=35.0, help="Lowest allowed psnr between fp16 and fp32 images")
+    parser.add_argument("--max_lpips", type=float, default=0.01, help="Highest allowed lpips between fp16 and fp32 images")
+    opts, rest = parser.parse_known_args()
+
+    # the rest of the arguments is the usual inference config
+    sys.argv = sys.argv[:1] + rest
+    config = inference_arguments.load_config()
+    setup_seed(config.exp.seed)
+
+    run_check(config, opts)
@@ -1,5 +1,6 @@
 import sys
 import torch
+import torchvision.transforms as transforms
 
 sys.path =  ['.'] + sys.path
 
@@ -14,9 +15,18 @@ from utils.common_utils import tensor2im, setup_seed
 setup_seed(777)
 
 
+class ToFIDInput:
+    """Normalized image tensor -> 0..1 tensor quantized as a saved image, in the DataLoader workers"""
+    def __call__(self, tensor):
+        return transforms.functional.to_tensor(tensor2im(tensor).convert("RGB"))
+
+
 def inferece_fid_editing(opts):
-    fid_metric = metrics_registry["fid"]()
-    transform = transforms_registry[opts.transforms]().get_transforms()["test"]
+    fid_metric = metrics_registry["fid"](stats_cache_dir=opts.stats_cache_dir)
+    transform = transforms.Compose([
+        transforms_registry[opts.transforms]().get_transforms()["test"],
+        ToFIDInput()
+    ])
 
     attr_name = opts.attr_name
 
@@ -39,23 +49,13 @@ def inferece_fid_editing(opts):
     print(f"Percent of Images of attribute {opts.attr_name} is "
                   f"{len(attr_dataset) / (len(attr_dataset) + len(not_attr_dataset))}")
 
-    attr_images = []
-    for attr_image in attr_dataset:
-        img = tensor2im(attr_image).convert("RGB")
-        attr_images.append(img)
-
-    edited_images = []
-    for not_attr_image in not_attr_dataset:
-        img = tensor2im(not_attr_image).convert("RGB")
-        edited_images.append(img)
-
-    from_data_arg = {
-        "inp_data": attr_images,
-        "fake_data": edited_images,
-        "paths": [],
-    }
-
-    _, fid_value, _ = fid_metric("", "", out_path="", from_data=from_data_arg)
+    # images are streamed from disk, statistics of the real images are cached by their file list
+    fid_value = fid_metric.calculate_fid_given_datasets(
+        attr_dataset,
+        not_attr_dataset,
+        real_files=attr_dataset.paths,
+        real_preprocessing=opts.transforms,
+    )
     print(f"FID for {opts.attr_name} is {fid_value:.4f}")
 
 
@@ -92,5 +92,12 @@ if __name__ == "__main__":
         help="Which transforms from datasets.transforms.transforms_registry should be used",
     )
 
+    parser.add_argument(
+        "--stats_cache_dir",
+        default="",
+        type=str,
+        help="Directory to cache FID statistics of the real images, empty string disables the cache",
+    )
+
     opts = parser.parse_args()
     inferece_fid_editing(opts)
@@ -0,0 +1,115 @@
+import warnings
+import numpy as np
+
+
+def _neighbours_sum(x):
+    """Sum over 4-neighbours of every pixel, neighbours outside of the array are skipped"""
+    out = np.zeros_like(x)
+    out[1:] += x[:-1]
+    out[:-1] += x[1:]
+    out[:, 1:] += x[:, :-1]
+    out[:, :-1] += x[:, 1:]
+    return out
+
+
+def _solve_laplace(boundary, region, x0, tol, max_iter):
+    """
+    Jacobi preconditioned conjugate gradients for the discrete Laplace equation:
+    x is harmonic inside region, equals boundary outside of it and has zero normal
+    derivative on the array borders. All channels are solved at once.
+    boundary, x0 -- h x w x c, region -- h x w bool
+    Returns x and whether the relative residual reached tol in max_iter iterations.
+    """
+    eps = 1e-12
+    region = region[..., None]
+    counts = _neighbours_sum(np.ones(region.shape, dtype=boundary.dtype))
+
+    def apply(x):
+        return np.where(region, counts * x - _neighbours_sum(x), 0)
+
+    known = np.where(region, 0, boundary)
+    b = np.where(region, _neighbours_sum(known), 0)
+    b_norm = np.sqrt((b * b).sum(axis=(0, 1)))
+
+    x = np.where(region, x0, 0)
+    r = b - apply(x)
+    z = r / counts
+    p = z.copy()
+    rz = (r * z).sum(axis=(0, 1))
+    converged = False
+    for _ in range(max_iter + 1):
+        converged = np.all(np.sqrt((r * r).sum(axis=(0, 1))) <= tol * b_norm + eps)
+        if converged:
+            break
+        Ap = apply(p)
+        alpha = rz / ((p * Ap).sum(axis=(0, 1)) + eps)
+        x += alpha * p
+        r -= alpha * Ap
+        z = r / counts
+        rz_new = (r * z).sum(axis=(0, 1))
+        p = z + rz_new / (rz + eps) * p
+        rz = rz_new
+
+    return np.where(region, x, boundary), converged
+
+
+def _solve_multilevel(boundary, region, tol, max_iter, min_size):
+    """
+    Solves the problem on a twice coarser grid first and uses upsampled result as initial guess.
+    Returns x and whether the finest level converged.
+    """
+    h, w = region.shape
+    if min(h, w) >= 2 * min_size and region.any():
+        hc, wc = (h + 1) // 2, (w + 1) // 2
+        pad = ((0, 2 * hc - h), (0, 2 * wc - w))
+
+        region_blocks = np.pad(region, pad, mode="edge").reshape(hc, 2, wc, 2)
+        boundary_blocks = np.pad(boundary, pad + ((0, 0),), mode="edge").reshape(hc, 2, wc, 2, -1)
+
+        # coarse pixel is unknown only if all its fine pixels are, otherwise it keeps the mean of the known ones
+        coarse_region = region_blocks.all(axis=(1, 3))
+        weight = (~region_blocks)[..., None].astype(boundary.dtype)
+        coarse_boundary = (boundary_blocks * weight).sum(axis=(1, 3)) / np.maximum(weight.sum(axis=(1, 3)), 1)
+
+        coarse, _ = _solve_multilevel(coarse_boundary, coarse_region, tol, max_iter, min_size)
+        x0 = coarse.repeat(2, axis=0).repeat(2, axis=1)[:h, :w]
+    else:
+        x0 = np.zeros_like(boundary)
+    return _solve_laplace(boundary, region, x0, tol, max_iter)
+
+
+def poisson_blend(source, target, mask, tol=1e-3, max_iter=None, min_size=16):
+    """
+    Gradient domain (Poisson) blending. Inside the mask the result keeps gradients of source
+    and matches target on the mask border, outside of the mask it is equal to target.
+    Only the bounding box of the mask is solved, with coarse-to-fine conjugate gradients.
+    By default every level gets as many iterations as twice the larger side of the box,
+    a warning is issued if the solution did not reach tol.
+
+    :param source: H x W x C array
+    :param target: H x W x C array
+    :param mask: H x W bool array, pixels to blend
+    :return: H x W x C float32 array
+    """
+    source = np.asarray(source, dtype=np.float32)
+    target = np.asarray(target, dtype=np.float32)
+    mask = np.asarray(mask, dtype=bool)
+
+    result = target.copy()
+    if not mask.any():
+        return result
+
+    # one pixel frame of known values around the mask
+    rows, cols = np.nonzero(mask)
+    top, left = max(rows.min() - 1, 0), max(cols.min() - 1, 0)
+    bottom, right = min(rows.max() + 2, mask.shape[0]), min(cols.max() + 2, mask.shape[1])
+    box = (slice(top, bottom), slice(left, right))
+    if max_iter is None:
+        max_iter = max(200, 2 * max(bottom - top, right - left))
+
+    # result is source plus a harmonic correction that matches target outside of the mask
+    correction, converged = _solve_multilevel(target[box] - source[box], mask[box], tol, max_iter, min_size)
+    if not converged:
+        warnings.warn(f"Poisson blending did not converge to tol {tol} in {max_iter} iterations")
+    result[box] = np.where(mask[box][..., None], source[box] + correction, target[box])
+    return result
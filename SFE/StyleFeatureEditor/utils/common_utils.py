@@ -1,3 +1,4 @@
+import os
 import torch
 import random
 from torch.nn import functional as F
@@ -26,6 +27,15 @@ def tensor2im_no_tfm(var):
     return Image.fromarray(var.astype("uint8"))
 
 
+def load_rgb_image(image):
+    """Accepts a path, a PIL image or an H x W x 3 uint8 array"""
+    if isinstance(image, (str, os.PathLike)):
+        image = Image.open(image)
+    elif not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+    return image.convert("RGB")
+
+
 def printer(obj, tabs=0):
     for (key, value) in obj.items():
         try:
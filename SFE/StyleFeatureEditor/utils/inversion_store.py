@@ -0,0 +1,114 @@
+import os
+import json
+import torch
+import hashlib
+
+from collections import defaultdict
+
+
+def file_checksum(path, block_size=1 << 20):
+    """sha1 of the file content, or of the path itself if there is no such file"""
+    sha1 = hashlib.sha1()
+    if not os.path.isfile(path):
+        sha1.update(str(path).encode())
+        return sha1.hexdigest()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class InversionStore:
+    """
+    Inversion results kept on disk as chunks of tensors with a json index by image name.
+    Every checkpoint gets its own subdirectory, so results of different models are never mixed.
+    Results are flushed every chunk_size images and the index is rewritten after each chunk,
+    so an interrupted run loses only the last incomplete chunk.
+    """
+    def __init__(self, root, checkpoint_checksum, chunk_size=256, skip_keys=()):
+        self.root = os.path.join(root, checkpoint_checksum[:16])
+        self.index_path = os.path.join(self.root, "index.json")
+        self.chunk_size = chunk_size
+        self.skip_keys = set(skip_keys)
+        os.makedirs(self.root, exist_ok=True)
+
+        self.index = {"checksum": checkpoint_checksum, "chunks": []}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            if index["checksum"] == checkpoint_checksum:
+                self.index = index
+
+        self.names = {}
+        for chunk_id, chunk in enumerate(self.index["chunks"]):
+            for pos, name in enumerate(chunk["names"]):
+                self.names[name] = (chunk_id, pos)
+
+        self._buffer_names = []
+        self._buffer = defaultdict(list)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, img_names, result_batch):
+        for key, value in result_batch.items():
+            if torch.is_tensor(value) and key not in self.skip_keys:
+                self._buffer[key].append(value.detach().cpu())
+        self._buffer_names.extend(img_names)
+
+        if len(self._buffer_names) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer_names) == 0:
+            return
+
+        chunk_id = len(self.index["chunks"])
+        chunk_file = "chunk_{:06d}.pt".format(chunk_id)
+        chunk_path = os.path.join(self.root, chunk_file)
+        tensors = {key: torch.cat(values) for key, values in self._buffer.items()}
+        torch.save(tensors, chunk_path + ".tmp")
+        os.replace(chunk_path + ".tmp", chunk_path)
+
+        self.index["chunks"].append({"file": chunk_file, "names": self._buffer_names})
+        for pos, name in enumerate(self._buffer_names):
+            self.names[name] = (chunk_id, pos)
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+        self._buffer_names = []
+        self._buffer = defaultdict(list)
+
+    def load_chunk(self, chunk_id):
+        chunk_path = os.path.join(self.root, self.index["chunks"][chunk_id]["file"])
+        try:
+            # tensors are read from disk only when they are indexed
+            return torch.load(chunk_path, map_location="cpu", mmap=True)
+        except TypeError:  # torch < 2.1 has no mmap
+            return torch.load(chunk_path, map_location="cpu")
+
+    def iter_chunks(self, names=None, batch_size=None):
+        """
+        Yields (img_names, result_batch) for stored images, only for images from names if given.
+        Every chunk is read once, result batches have at most batch_size images if it is set.
+        """
+        for chunk_id, chunk in enumerate(self.index["chunks"]):
+            keep = [pos for pos, name in enumerate(chunk["names"]) if names is None or name in names]
+            if len(keep) == 0:
+                continue
+
+            tensors = self.load_chunk(chunk_id)
+            step = batch_size or len(keep)
+            for start in range(0, len(keep), step):
+                batch_idx = keep[start : start + step]
+                if len(batch_idx) < len(chunk["names"]):
+                    # indexing copies only the selected rows of the mapped tensors
+                    batch_tensors = {key: value[torch.tensor(batch_idx)] for key, value in tensors.items()}
+                else:
+                    batch_tensors = tensors
+                yield [chunk["names"][pos] for pos in batch_idx], batch_tensors
@@ -11,7 +11,7 @@ args = parser.parse_args()
 utils = AppUtils()
 methods = utils.get_methods()
 styleres = initialize_styleres('checkpoints/styleres_ffhq.pth', args.device)
-image_processor = ImageProcessor('checkpoints/shape_predictor_68_face_landmarks.dat')
+image_processor = ImageProcessor('checkpoints/shape_predictor_68_face_landmarks.dat', single_warp=True)
 
 def process_image(image, method,  edit, factor, is_align_checked):
     cfg = utils.args_to_cfg(method, edit, factor)
@@ -84,7 +84,7 @@ def main():
     # Initialize model and processor
     print("Loading model...")
     styleres = initialize_styleres('checkpoints/styleres_ffhq.pth', args.device)
-    image_processor = ImageProcessor('checkpoints/shape_predictor_68_face_landmarks.dat')
+    image_processor = ImageProcessor('checkpoints/shape_predictor_68_face_landmarks.dat', single_warp=True)
     
     # Load and process image
     print("Loading input image...")
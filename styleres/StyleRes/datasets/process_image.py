@@ -11,9 +11,110 @@ import PIL.Image
 import scipy
 import scipy.ndimage
 
+
+def warp_face(img, quad, qsize, output_size=1024):
+    """
+    Warps the face crop quad of img to output_size x output_size with a single transform.
+    Shrink, crop and pad are chosen as in align_face, but only the crop is shrinked and
+    reflect-padded, as uint8. The edge-padding blur is computed only in the box of aligned
+    pixels that fall outside of the original image. Unlike align_face, the median for the
+    second blur is taken over the aligned image, not over the whole padded image, so the
+    padded border can be slightly different in color. unalign_dict["affine"] (2 x 3) maps
+    aligned pixel centers to original pixel centers, so unalign can invert it exactly.
+    The same function is in SFE scripts/align_all_parallel.py and StyleRes
+    datasets/process_image.py, keep the two in sync.
+    :param img: PIL Image
+    :param quad: np.array shape=(4, 2), oriented crop rectangle from get_quad
+    :param qsize: float, size of the quad
+    :return: PIL Image, unalign_dict
+    """
+    unalign_dict = {"orig_size": img.size}
+    enable_padding = True
+
+    # Shrink, crop and pad are chosen as in align_face, in shrinked coordinates.
+    shrink = int(np.floor(qsize / output_size * 0.5))
+    size = np.array(img.size, dtype=np.float64)
+    rsize = np.rint(size / shrink) if shrink > 1 else size
+    scale = size / rsize  # original pixels per shrinked pixel
+    quad = (quad + 0.5) / scale - 0.5
+    qsize = qsize / shrink if shrink > 1 else qsize
+
+    border = max(int(np.rint(qsize * 0.1)), 3)
+    crop = (int(np.floor(min(quad[:, 0]))), int(np.floor(min(quad[:, 1]))), int(np.ceil(max(quad[:, 0]))),
+            int(np.ceil(max(quad[:, 1]))))
+    crop = (max(crop[0] - border, 0), max(crop[1] - border, 0), min(crop[2] + border, int(rsize[0])),
+            min(crop[3] + border, int(rsize[1])))
+    crop_size = (crop[2] - crop[0], crop[3] - crop[1])
+    quad -= crop[0:2]
+
+    pad = (int(np.floor(min(quad[:, 0]))), int(np.floor(min(quad[:, 1]))), int(np.ceil(max(quad[:, 0]))),
+           int(np.ceil(max(quad[:, 1]))))
+    pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - crop_size[0] + border, 0),
+           max(pad[3] - crop_size[1] + border, 0))
+    use_padding = enable_padding and max(pad) > border - 4
+    pad = np.maximum(pad, int(np.rint(qsize * 0.3))) if use_padding else np.zeros(4, dtype=int)
+
+    # Only the crop is read (and shrinked) from the original image.
+    if shrink > 1:
+        box = (crop[0] * scale[0], crop[1] * scale[1], crop[2] * scale[0], crop[3] * scale[1])
+        face = img.resize(crop_size, PIL.Image.LANCZOS, box=box)
+    else:
+        face = img.crop(crop)
+    if use_padding:
+        face = np.pad(np.asarray(face), ((pad[1], pad[3]), (pad[0], pad[2]), (0, 0)), 'reflect')
+        face = PIL.Image.fromarray(face, 'RGB')
+    quad += pad[:2]
+
+    # Transform.
+    img = face.transform((output_size, output_size), PIL.Image.QUAD, (quad + 0.5).flatten(), PIL.Image.BILINEAR)
+
+    # aligned pixel center (u, v) -> padded face pixel center
+    ex = (quad[3] - quad[0]) / output_size
+    ey = (quad[1] - quad[0]) / output_size
+    origin = quad[0] + 0.5 * (ex + ey)
+    # padded face -> original image
+    affine = np.concatenate([
+        scale[:, None] * np.stack([ex, ey], axis=1),
+        ((origin - pad[:2] + crop[:2] + 0.5) * scale - 0.5)[:, None]
+    ], axis=1)
+    unalign_dict["affine"] = affine
+
+    if use_padding:
+        w, h = face.size
+        grid = np.arange(output_size, dtype=np.float32)
+        x = origin[0] + grid[None, :] * ex[0] + grid[:, None] * ey[0]
+        y = origin[1] + grid[None, :] * ex[1] + grid[:, None] * ey[1]
+        mask = np.maximum(1.0 - np.minimum(x / pad[0], (w - 1 - x) / pad[2]),
+                          1.0 - np.minimum(y / pad[1], (h - 1 - y) / pad[3]))
+        blur_weight = np.clip(mask * 3.0 + 1.0, 0.0, 1.0)
+
+        rows, cols = np.nonzero(blur_weight)
+        if len(rows) > 0:
+            # blur only the out-of-image part, with the same sigma measured in aligned pixels
+            blur = qsize * 0.02 / np.hypot(*ex)
+            margin = int(np.ceil(3 * blur))
+            y0, y1 = max(rows.min() - margin, 0), min(rows.max() + margin + 1, output_size)
+            x0, x1 = max(cols.min() - margin, 0), min(cols.max() + margin + 1, output_size)
+
+            img = np.float32(img)
+            region = img[y0:y1, x0:x1]
+            blur1 = (scipy.ndimage.gaussian_filter(region, [blur, blur, 0]) - region) * blur_weight[y0:y1, x0:x1, None]
+            region += blur1
+
+            blur2 = (np.median(img, axis=(0, 1)) - region) * np.clip(mask[y0:y1, x0:x1, None], 0.0, 1.0)
+            region += blur2
+
+            unalign_dict["blur_box"] = (y0, y1, x0, x1)
+            unalign_dict["blur"] = blur1 + blur2
+            img = PIL.Image.fromarray(np.uint8(np.clip(np.rint(img), 0, 255)), 'RGB')
+
+    return img, unalign_dict
+
+
 class ImageProcessor():
-    def __init__(self, predictor_path=None) -> None:
+    def __init__(self, predictor_path=None, single_warp=False) -> None:
         self.predictor = None
+        self.single_warp = single_warp
         if predictor_path:
             self.predictor =  dlib.shape_predictor(predictor_path)
     
@@ -76,16 +177,12 @@ class ImageProcessor():
         lm = np.array(a)
         return lm
 
-    def align_face(self, img):
+    @staticmethod
+    def get_quad(lm):
         """
-        :param image: PIL image
-        :return: PIL Image
+        :param lm: np.array shape=(68, 2)
+        :return: oriented crop rectangle (upper-left, lower-left, lower-right, upper-right) and its size
         """
-        if self.predictor is None:
-            return img
-
-        lm = self.get_landmark(img)
-
         lm_chin = lm[0: 17]  # left-right
         lm_eyebrow_left = lm[17: 22]  # left-right
         lm_eyebrow_right = lm[22: 27]  # left-right
@@ -114,6 +211,21 @@ class ImageProcessor():
         c = eye_avg + eye_to_mouth * 0.1
         quad = np.stack([c - x - y, c - x + y, c + x + y, c + x - y])
         qsize = np.hypot(*x) * 2
+        return quad, qsize
+
+    def align_face(self, img):
+        """
+        :param image: PIL image
+        :return: PIL Image
+        """
+        if self.predictor is None:
+            return img
+        if self.single_warp:
+            return self.align_face_single_warp(img)
+
+        lm = self.get_landmark(img)
+
+        quad, qsize = self.get_quad(lm)
 
         # read image
         # img = PIL.Image.open(filepath)
@@ -164,4 +276,22 @@ class ImageProcessor():
             img = img.resize((output_size, output_size), PIL.Image.ANTIALIAS)
 
         # Save aligned image.
-        return img
\ No newline at end of file
+        return img
+
+    def align_face_single_warp(self, img, return_unalign=False):
+        """
+        Same crop as align_face, made with a single warp by warp_face
+        :param image: PIL image
+        :return: PIL Image, and unalign dict with 2 x 3 "affine" map from aligned pixel centers
+            to original pixel centers if return_unalign
+        """
+        if self.predictor is None:
+            return (img, None) if return_unalign else img
+
+        lm = self.get_landmark(img)
+        quad, qsize = self.get_quad(lm)
+        img, unalign_dict = warp_face(img, quad, qsize)
+
+        if return_unalign:
+            return img, unalign_dict
+        return img
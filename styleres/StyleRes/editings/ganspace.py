@@ -17,33 +17,45 @@ class GanSpace():
     def edit(self, latent, cfg):
         with torch.no_grad():
             self.load_ganspace_pca()
-            gan_space_config = self.gan_space_configs[cfg.edit]
+            # Copy, the shared config must not be modified by concurrent requests
+            gan_space_config = list(self.gan_space_configs[cfg.edit])
             gan_space_config[-1] = cfg.strength
             return self.edit_ganspace(latent, gan_space_config)
 
+    def edit_strengths(self, latent, edit, strengths):
+        # Applies one edit with several strengths at once, returns (B, len(strengths), L, 512)
+        with torch.no_grad():
+            self.load_ganspace_pca()
+            pca_idx, start, end, _ = self.gan_space_configs[edit]
+            strengths = torch.as_tensor(strengths, dtype=latent.dtype, device=latent.device)
+            delta = self.get_delta(latent, pca_idx, strengths)
+            edit_latents = latent.unsqueeze(1).repeat(1, len(strengths), 1, 1)
+            edit_latents[:, :, start:end] += delta.unsqueeze(2)
+            return edit_latents
+
     def load_ganspace_pca(self):
         try:   # Check if loaded
             getattr(self, f"pca")
         except:
             pca = torch.load(os.path.join(Settings.ganspace_directions, 'ffhq_pca.pt'))
+            # Keep the components resident on device instead of moving them on every edit
+            pca = {k: v.to(Settings.device) if torch.is_tensor(v) else v for k, v in pca.items()}
             setattr(self, f"pca", pca)
         
 
     def edit_ganspace(self, latents, config):
-        edit_latents = []
         pca_idx, start, end, strength = config
-        for latent in latents:
-            delta = self.get_delta( latent, pca_idx, strength)
-            delta_padded = torch.zeros(latent.shape).to(Settings.device)
-            delta_padded[start:end] += delta.repeat(end - start, 1)
-            edit_latents.append(latent + delta_padded)
-        return torch.stack(edit_latents)
+        strengths = torch.tensor([strength], dtype=latents.dtype, device=latents.device)
+        delta = self.get_delta(latents, pca_idx, strengths)[:, 0]
+        edit_latents = latents.clone()
+        edit_latents[:, start:end] += delta.unsqueeze(1)
+        return edit_latents
 
-    def get_delta(self, latent, idx, strength):
-        # pca: ganspace checkpoint. latent: (16, 512) w+
-        w_centered = latent - self.pca['mean'].to(Settings.device)
-        lat_comp = self.pca['comp'].to(Settings.device)
-        lat_std = self.pca['std'].to(Settings.device)
-        w_coord = torch.sum(w_centered[0].reshape(-1)*lat_comp[idx].reshape(-1)) / lat_std[idx]
-        delta = (strength - w_coord)*lat_comp[idx]*lat_std[idx]
+    def get_delta(self, latents, idx, strengths):
+        # pca: ganspace checkpoint. latents: (B, 16, 512) w+, strengths: (S,). Returns (B, S, 512)
+        lat_comp = self.pca['comp'][idx].reshape(-1)
+        lat_std = self.pca['std'][idx]
+        w_centered = latents[:, 0] - self.pca['mean'].reshape(1, -1)
+        w_coord = torch.matmul(w_centered, lat_comp) / lat_std
+        delta = (strengths.view(1, -1) - w_coord.view(-1, 1)).unsqueeze(-1) * lat_comp * lat_std
         return delta
\ No newline at end of file
@@ -10,6 +10,14 @@ class InterFaceGAN():
         with torch.no_grad():
             return latent + cfg.strength * self.get_direction(cfg.edit)
 
+    def edit_strengths(self, latent, edit, strengths):
+        # Applies one edit with several strengths at once, returns (B, len(strengths), ...)
+        with torch.no_grad():
+            direction = self.get_direction(edit)
+            strengths = torch.as_tensor(strengths, dtype=latent.dtype, device=latent.device)
+            strengths = strengths.view(1, -1, *([1] * (latent.dim() - 1)))
+            return latent.unsqueeze(1) + strengths * direction
+
     def get_direction(self, editname):
         try:
             direction = getattr(self, f"{editname}_direction")
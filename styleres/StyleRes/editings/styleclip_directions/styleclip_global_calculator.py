@@ -5,6 +5,7 @@ except:
     print("CLIP model is not available. Global directions method can't be used")
 import copy
 from options import Settings
+from editings.styleclip_directions.text_features_cache import TextFeaturesCache
 
 """
 Modified from HyperStyle repository
@@ -37,6 +38,7 @@ class StyleCLIPGlobalDirection:
         self.s_std = s_std
         self.text_prompts_templates = text_prompts_templates
         self.clip_model, _ = clip.load("ViT-B/32", device=Settings.device)
+        self.text_features_cache = TextFeaturesCache(Settings.styleclip_text_features_cache, text_prompts_templates, self.clip_model)
 
     def get_delta_s(self, neutral_text, target_text, beta):
         delta_i = self.get_delta_i([target_text, neutral_text]).float()
@@ -51,25 +53,24 @@ class StyleCLIPGlobalDirection:
         return direction
 
     def get_delta_i(self, text_prompts):
-        try:   # Check if loaded
-            delta_i = getattr(self, f"{text_prompts[0]}_{text_prompts[1]}")
-        except:
-            text_features = self._get_averaged_text_features(text_prompts)
-            delta_t = text_features[0] - text_features[1]
-            delta_i = delta_t / torch.norm(delta_t)
-            setattr(self, f"{text_prompts[0]}_{text_prompts[1]}", delta_i)
+        text_features = self._get_averaged_text_features(text_prompts)
+        delta_t = text_features[0] - text_features[1]
+        delta_i = delta_t / torch.norm(delta_t)
         return delta_i
 
     def _get_averaged_text_features(self, text_prompts):
         with torch.no_grad():
             text_features_list = []
             for text_prompt in text_prompts:
-                formatted_text_prompts = [template.format(text_prompt) for template in self.text_prompts_templates]  # format with class
-                formatted_text_prompts = clip.tokenize(formatted_text_prompts).to(Settings.device)  # tokenize
-                text_embeddings = self.clip_model.encode_text(formatted_text_prompts)  # embed with text encoder
-                text_embeddings /= text_embeddings.norm(dim=-1, keepdim=True)
-                text_embedding = text_embeddings.mean(dim=0)
-                text_embedding /= text_embedding.norm()
+                text_embedding = self.text_features_cache.get(text_prompt, device=Settings.device)
+                if text_embedding is None:
+                    formatted_text_prompts = [template.format(text_prompt) for template in self.text_prompts_templates]  # format with class
+                    formatted_text_prompts = clip.tokenize(formatted_text_prompts).to(Settings.device)  # tokenize
+                    text_embeddings = self.clip_model.encode_text(formatted_text_prompts)  # embed with text encoder
+                    text_embeddings /= text_embeddings.norm(dim=-1, keepdim=True)
+                    text_embedding = text_embeddings.mean(dim=0)
+                    text_embedding /= text_embedding.norm()
+                    self.text_features_cache.put(text_prompt, text_embedding)
                 text_features_list.append(text_embedding)
             text_features = torch.stack(text_features_list, dim=1).to(Settings.device)
         return text_features.t()
\ No newline at end of file
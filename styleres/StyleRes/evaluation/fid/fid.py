@@ -7,7 +7,6 @@ http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to
 Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
 """
 
-import os
 import argparse
 
 import torch
@@ -15,7 +14,8 @@ import torch.nn as nn
 import numpy as np
 from torchvision import models
 from scipy import linalg
-from evaluation.fid.data_loader import get_eval_loader
+from evaluation.fid.data_loader import get_eval_loader, listdir
+from evaluation.fid.fid_stats import FIDStatsCache, ActivationStatistics, frechet_distance_eigh
 #import sklearn.svm
 
 try:
@@ -52,38 +52,50 @@ class InceptionV3(nn.Module):
         return x.view(x.size(0), -1)
 
 
-def frechet_distance(mu, cov, mu2, cov2):
+def frechet_distance(mu, cov, mu2, cov2, method='sqrtm', device=None):
+    """method -- 'sqrtm' (scipy) or 'eigh', which gives the same value within tolerance and is much faster"""
+    if method == 'eigh':
+        return frechet_distance_eigh(mu, cov, mu2, cov2, device=device)
     cc, _ = linalg.sqrtm(np.dot(cov, cov2), disp=False)
     dist = np.sum((mu -mu2)**2) + np.trace(cov + cov2 - 2*cc)
     return np.real(dist)
 
 
 @torch.no_grad()
-def calculate_fid_given_paths(paths, img_size=256, batch_size=50, enable_tqdm=False):
+def calculate_fid_given_paths(paths, img_size=256, batch_size=50, enable_tqdm=False, stats_cache_dir=None,
+                              frechet='sqrtm'):
+    """paths -- [real, fake], statistics of the real images are cached in stats_cache_dir if it is set"""
     print('Calculating FID given paths %s and %s...' % (paths[0], paths[1]))
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     inception = InceptionV3().eval().to(device)
+
+    stats_cache = FIDStatsCache(stats_cache_dir) if stats_cache_dir else None
+    preprocessing = {'img_size': img_size, 'imagenet_normalize': True}
+    if stats_cache is not None:
+        real_files = listdir(paths[0])
+        real_stats = stats_cache.load(real_files, inception, preprocessing)
+        if real_stats is not None:
+            paths = paths[1:]
+
     loaders = [get_eval_loader(path, img_size, batch_size) for path in paths]
 
     mu, cov = [], []
-    all_activations = {}
-    i = 0
+    if stats_cache is not None and real_stats is not None:
+        mu.append(real_stats[0])
+        cov.append(real_stats[1])
+
     for loader in loaders:
-        actvs = []
-        if enable_tqdm:
-            for x in tqdm(loader, total=len(loader)):
-                actv = inception(x.to(device))
-                actvs.append(actv)
-        else:
-            for x in loader:
-                actv = inception(x.to(device))
-                actvs.append(actv)
-        actvs = torch.cat(actvs, dim=0).cpu().detach().numpy()
-        all_activations[i] = actvs
-        mu.append(np.mean(actvs, axis=0))
-        cov.append(np.cov(actvs, rowvar=False))
-        i += 1
-    fid_value = frechet_distance(mu[0], cov[0], mu[1], cov[1])
+        stats = ActivationStatistics(device=device)
+        for x in (tqdm(loader, total=len(loader)) if enable_tqdm else loader):
+            stats.update(inception(x.to(device, non_blocking=True)))
+        loader_mu, loader_cov = stats.mean_cov()
+        mu.append(loader_mu)
+        cov.append(loader_cov)
+        if stats_cache is not None and len(mu) == 1:
+            stats_cache.save(real_files, inception, preprocessing, mu[0], cov[0])
+    # eigh runs on gpu if it is available
+    fid_value = frechet_distance(mu[0], cov[0], mu[1], cov[1], method=frechet,
+                                 device=device if device.type == 'cuda' else None)
 
     
     return fid_value
@@ -93,8 +105,12 @@ if __name__ == '__main__':
     parser.add_argument('--paths', type=str, nargs=2, help='First path to real images, second path to fakes')
     parser.add_argument('--img_size', type=int, default=256, help='image resolution')
     parser.add_argument('--batch_size', type=int, default=64, help='batch size to use')
+    parser.add_argument('--stats_cache_dir', type=str, default=None, help='directory to cache statistics of real images')
+    parser.add_argument('--frechet', type=str, default='sqrtm', choices=['sqrtm', 'eigh'],
+                        help='trace sqrt implementation of the frechet distance')
     args = parser.parse_args()
-    fid_value = calculate_fid_given_paths(args.paths, args.img_size, args.batch_size)
+    fid_value = calculate_fid_given_paths(args.paths, args.img_size, args.batch_size,
+                                          stats_cache_dir=args.stats_cache_dir, frechet=args.frechet)
     print('FID: ', fid_value)
 
     
@@ -23,15 +23,10 @@ def create_window(window_size, channel=1):
 def ssim(img1, img2, window_size=11, window=None, size_average=True, full=False, val_range=None):
     # Value range can be different from 255. Other common ranges are 1 (sigmoid) and 2 (tanh).
     if val_range is None:
-        if torch.max(img1) > 128:
-            max_val = 255
-        else:
-            max_val = 1
-
-        if torch.min(img1) < -0.5:
-            min_val = -1
-        else:
-            min_val = 0
+        # range is detected per image, so batched scores match single image ones
+        dims = list(range(1, img1.dim()))
+        max_val = 1 + 254 * (img1.amax(dim=dims, keepdim=True) > 128).to(img1.dtype)
+        min_val = -(img1.amin(dim=dims, keepdim=True) < -0.5).to(img1.dtype)
         L = max_val - min_val
     else:
         L = val_range
@@ -102,11 +97,13 @@ def msssim(img1, img2, window_size=11, size_average=True, val_range=None, normal
         ssims = (ssims + 1) / 2
         mcs = (mcs + 1) / 2
 
+    # levels x batch if not size_average
+    weights = weights.view(-1, *[1] * (ssims.dim() - 1))
     pow1 = mcs ** weights
     pow2 = ssims ** weights
 
     # From Matlab implementation https://ece.uwaterloo.ca/~z70wang/research/iwssim/
-    output = torch.prod(pow1[:-1]) * pow2[-1]
+    output = torch.prod(pow1[:-1], dim=0) * pow2[-1]
     return output
 
 
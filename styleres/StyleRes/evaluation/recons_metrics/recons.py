@@ -21,6 +21,7 @@ def parse_args():
     parser.add_argument('--workers', type=int, default=4)
     parser.add_argument('--batch_size', type=int, default=4)
     parser.add_argument('--is_cars', action='store_true')
+    parser.add_argument('--device', type=str, default='cuda')
     args = parser.parse_args()
     return args
 
@@ -38,32 +39,37 @@ def run(args):
                            gt_dir=args.gt_path,
                            transform=transform)
 
+    device = torch.device(args.device)
     dataloader = DataLoader(dataset,
                             batch_size=args.batch_size,
                             shuffle=False,
                             num_workers=int(args.workers),
-                            drop_last=False)
+                            drop_last=False,
+                            pin_memory=device.type == 'cuda')
 
+    # every loss returns per image scores of the batch
     if args.mode == 'lpips':
-        loss_func = LPIPS(net_type='alex')
+        lpips = LPIPS(net_type='alex', device=device)
+        loss_func = lambda x, y: lpips(x, y, reduction='none')
     elif args.mode == 'l2':
-        loss_func = torch.nn.MSELoss()
+        loss_func = lambda x, y: ((x - y) ** 2).mean(dim=(1, 2, 3))
     elif args.mode == 'msssim':
-        loss_func = MSSSIM()
+        loss_func = MSSSIM(size_average=False)
     else:
         raise Exception('Not a valid mode!')
-    loss_func.cuda()
 
-    global_i = 0
+    batch_scores = []
+    with torch.no_grad():
+        for result_batch, gt_batch in tqdm(dataloader):
+            result_batch = result_batch.to(device, non_blocking=True)
+            gt_batch = gt_batch.to(device, non_blocking=True)
+            batch_scores.append(loss_func(result_batch, gt_batch).float())
+    # single device to host copy
+    batch_scores = torch.cat(batch_scores).cpu().tolist()
+
     scores_dict = {}
-    all_scores = []
-    for result_batch, gt_batch in tqdm(dataloader):
-        for i in range(args.batch_size):
-            loss = float(loss_func(result_batch[i:i + 1].cuda(), gt_batch[i:i + 1].cuda()))
-            all_scores.append(loss)
-            im_path = dataset.pairs[global_i][0]
-            scores_dict[os.path.basename(im_path)] = loss
-            global_i += 1
+    for (im_path, _, _), loss in zip(dataset.pairs, batch_scores):
+        scores_dict[os.path.basename(im_path)] = loss
 
     all_scores = list(scores_dict.values())
     mean = np.nanmean(all_scores)
@@ -58,8 +58,10 @@ def run():
         if n_images >= args.n_images:
             break
         n_images = n_images + data['image'].shape[0]
-        for edit_config in edit_configs:
-            images = model.edit_images( data['image'], edit_config)
+        # Encode once, then apply all the edit configs to the same latents and features
+        encoded = model.encode_images(data['image'])
+        edited_images = model.edit_encoded(encoded, edit_configs, max_batch_size=args.edit_batch_size)
+        for edit_config, images in zip(edit_configs, edited_images):
             images = ImageProcessor.postprocess_image(images.detach().cpu().numpy())
             for j in range( images.shape[0]):
                 save_name = data['name'][j]
@@ -21,7 +21,6 @@ from .torch_utils.ops import upfirdn2d
 from .torch_utils.ops import bias_act
 from .torch_utils.ops import fma
 
-latent_space = "w+"
 #----------------------------------------------------------------------------
 
 def normalize_2nd_moment(x, dim=1, eps=1e-8):
@@ -308,8 +307,8 @@ class SynthesisLayer(torch.nn.Module):
             self.noise_strength = torch.nn.Parameter(torch.zeros([]))
         self.bias = torch.nn.Parameter(torch.zeros([out_channels]))
 
-    def forward(self, x, w, noise_mode='random',fused_modconv=True, gain=1, return_styles=False):
-        global latent_space
+    def forward(self, x, w, noise_mode='random',fused_modconv=True, gain=1, return_styles=False, latent_space='w+'):
+        # latent_space: 'w+' if w is a W+ latent, 's' if w already is the stylespace vector of this layer
         if latent_space == "w+":
             styles = self.affine(w)
             if return_styles:
@@ -356,7 +355,7 @@ class ToRGBLayer(torch.nn.Module):
         self.bias = torch.nn.Parameter(torch.zeros([out_channels]))
         self.weight_gain = 1 / np.sqrt(in_channels * (kernel_size ** 2))
 
-    def forward(self, x, w, fused_modconv=True, return_styles=False):
+    def forward(self, x, w, fused_modconv=True, return_styles=False, latent_space='w+'):
         if latent_space == "w+":
             styles = self.affine(w) * self.weight_gain
             if return_styles:
@@ -536,10 +535,9 @@ class SynthesisBlock(torch.nn.Module):
         self.embed_res = embed_res
 
     def forward(self, x, img, ws, highres_outs=None, return_f = False, return_styles=False,
-            force_fp32=False, fused_modconv=None, update_emas=False, **layer_kwargs):
+            force_fp32=False, fused_modconv=None, update_emas=False, latent_space='w+', **layer_kwargs):
 
         _ = update_emas # unused
-        global latent_space
         if latent_space == "w+":
             misc.assert_shape(ws, [None, self.num_conv + self.num_torgb, self.w_dim])
             w_iter = iter(ws.unbind(dim=1))
@@ -567,15 +565,15 @@ class SynthesisBlock(torch.nn.Module):
         style_outs = []
         # Main layers.
         if self.in_channels == 0:
-            x = self.conv1(x, next(w_iter), fused_modconv=fused_modconv, return_styles=return_styles,  **layer_kwargs)
+            x = self.conv1(x, next(w_iter), fused_modconv=fused_modconv, return_styles=return_styles, latent_space=latent_space, **layer_kwargs)
             if return_styles:   style_outs.append(x)
         elif self.architecture == 'resnet':
             y = self.skip(x, gain=np.sqrt(0.5))
-            x = self.conv0(x, next(w_iter), fused_modconv=fused_modconv, **layer_kwargs)
-            x = self.conv1(x, next(w_iter), fused_modconv=fused_modconv, gain=np.sqrt(0.5), **layer_kwargs)
+            x = self.conv0(x, next(w_iter), fused_modconv=fused_modconv, latent_space=latent_space, **layer_kwargs)
+            x = self.conv1(x, next(w_iter), fused_modconv=fused_modconv, gain=np.sqrt(0.5), latent_space=latent_space, **layer_kwargs)
             x = y.add_(x)
         else:
-            x = self.conv0(x, next(w_iter), fused_modconv=fused_modconv, return_styles=return_styles, **layer_kwargs)
+            x = self.conv0(x, next(w_iter), fused_modconv=fused_modconv, return_styles=return_styles, latent_space=latent_space, **layer_kwargs)
             if return_styles:   style_outs.append(x)
             if x.shape[-1] == self.embed_res and return_f:
                     return x, None
@@ -589,7 +587,7 @@ class SynthesisBlock(torch.nn.Module):
                 deltaF, gate = self.modify_feature_gates(x, aligned_feats)
                 x = (x * (1-gate) ) + ( (x + deltaF) * gate )
 
-            x = self.conv1(x, next(w_iter), fused_modconv=fused_modconv, return_styles=return_styles, **layer_kwargs)
+            x = self.conv1(x, next(w_iter), fused_modconv=fused_modconv, return_styles=return_styles, latent_space=latent_space, **layer_kwargs)
             if return_styles:   style_outs.append(x)
 
         # ToRGB.
@@ -597,7 +595,7 @@ class SynthesisBlock(torch.nn.Module):
             misc.assert_shape(img, [None, self.img_channels, self.resolution // 2, self.resolution // 2])
             img = upfirdn2d.upsample2d(img, self.resample_filter)
         if self.is_last or self.architecture == 'skip':
-            y = self.torgb(x, next(w_iter), fused_modconv=fused_modconv, return_styles=return_styles)
+            y = self.torgb(x, next(w_iter), fused_modconv=fused_modconv, return_styles=return_styles, latent_space=latent_space)
             if return_styles:   
                 style_outs.append(y)
                 return style_outs, None
@@ -648,9 +646,11 @@ class SynthesisNetwork(torch.nn.Module):
                 self.num_ws += block.num_torgb
             setattr(self, f'b{res}', block)
 
-    def forward(self, ws, highres_outs=None, return_f = False, return_styles=False, **block_kwargs):
+    def forward(self, ws, highres_outs=None, return_f = False, return_styles=False, latent_space=None, **block_kwargs):
+        # Lists of stylespace vectors select the stylespace path, W+ tensors the W+ one
+        if latent_space is None:
+            latent_space = 's' if type(ws) is list else 'w+'
         block_ws = []
-        global latent_space
         with torch.autograd.profiler.record_function('split_ws'):
             if latent_space == 'w+':
                 misc.assert_shape(ws, [None, self.num_ws, self.w_dim])
@@ -671,7 +671,7 @@ class SynthesisNetwork(torch.nn.Module):
         conv_idx = 0
         for res, cur_ws in zip(self.block_resolutions, block_ws):
             block = getattr(self, f'b{res}')
-            x, img = block(x, img, cur_ws, highres_outs, return_f, return_styles, **block_kwargs)
+            x, img = block(x, img, cur_ws, highres_outs, return_f, return_styles, latent_space=latent_space, **block_kwargs)
             if return_f and img is None:
                 return x
             if return_styles:
@@ -714,17 +714,14 @@ class Generator(torch.nn.Module):
     def forward(self, lat, c, truncation_psi=1, truncation_cutoff=None, update_emas=False, mode='synthesis', return_f = False, 
            return_styles=False, **synthesis_kwargs):
 
-        global latent_space
-        if type(lat) is list:
-            latent_space = 's'
-        else:
-            latent_space = 'w+'
+        # Latent space is passed down explicitly, so one Generator can serve concurrent requests
+        latent_space = 's' if type(lat) is list else 'w+'
 
         if mode == 'mapping':
             ws = self.mapping(lat, c, truncation_psi=truncation_psi, truncation_cutoff=truncation_cutoff, update_emas=update_emas)
             return ws
         if mode == 'synthesis':
-            img = self.synthesis(lat, highres_outs = c, return_f=return_f, update_emas=False, return_styles=return_styles, **synthesis_kwargs)
+            img = self.synthesis(lat, highres_outs = c, return_f=return_f, update_emas=False, return_styles=return_styles, latent_space=latent_space, **synthesis_kwargs)
             return img
 
 #----------------------------------------------------------------------------
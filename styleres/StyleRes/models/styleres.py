@@ -35,22 +35,56 @@ class StyleRes(nn.Module):
         Returns: Edited images
     """
     def edit_images(self, image, cfg):
+        encoded = self.encode_images(image)
+        return self.edit_encoded(encoded, [cfg])[0]
+
+    """
+        Inputs: Input images
+        Returns: Latents and skips (with F_feats). They depend only on the image, 
+                 so any number of edits can be applied to them with edit_encoded
+    """
+    def encode_images(self, image):
         image = image.to(self.device)
         with torch.no_grad():
             latents, skips = self.encoder(image)
-            input_is_stylespace = True if cfg.method == 'styleclip' and cfg.type == 'global' else False
-            if input_is_stylespace:
-                latents = self.generator(latents, None, return_styles=True)
-
-        # GradCtrl requires gradients, others do not
-        latents_edited = self.editor.edit(latents, cfg) 
-
-        with torch.no_grad():
             # Get F space features F_feats, for the original image
             skips['F_feats'] = self.generator(latents, skips, return_f = True, **self.G_kwargs_val)
-            # Transform F_feats to incoming edited image
-            images = self.generator(latents_edited, skips, **self.G_kwargs_val)
-            
-        return images
+        return latents, skips
 
+    """
+        Inputs: Output of encode_images and a list of edit configs
+        Returns: List of edited images, one batch per config
+    """
+    def edit_encoded(self, encoded, cfgs, max_batch_size=None):
+        latents, skips = encoded
+        batch_size = latents.shape[0]
 
+        styles = None
+        latents_edited = []
+        for cfg in cfgs:
+            input_is_stylespace = True if cfg.method == 'styleclip' and cfg.type == 'global' else False
+            if input_is_stylespace and styles is None:
+                with torch.no_grad():
+                    styles = self.generator(latents, None, return_styles=True)
+            # GradCtrl requires gradients, others do not
+            latents_edited.append(self.editor.edit(styles if input_is_stylespace else latents, cfg))
+
+        # Configs that edit the same latent space share generator calls
+        images = [None] * len(cfgs)
+        for is_stylespace in [False, True]:
+            cfg_idxs = [i for i, lat in enumerate(latents_edited) if isinstance(lat, list) == is_stylespace]
+            n_cfgs = len(cfg_idxs) if max_batch_size is None else max(max_batch_size // batch_size, 1)
+            for start in range(0, len(cfg_idxs), n_cfgs):
+                group = cfg_idxs[start:start + n_cfgs]
+                with torch.no_grad():
+                    if is_stylespace:
+                        group_latents = [torch.cat(layer_styles) for layer_styles in zip(*[latents_edited[i] for i in group])]
+                    else:
+                        group_latents = torch.cat([latents_edited[i] for i in group])
+                    group_skips = {k: v.repeat(len(group), *([1] * (v.dim() - 1))) for k, v in skips.items()}
+                    # Transform F_feats to incoming edited images
+                    group_images = self.generator(group_latents, group_skips, **self.G_kwargs_val)
+                for i, cfg_images in zip(group, group_images.split(batch_size)):
+                    images[i] = cfg_images
+
+        return images
@@ -11,5 +11,6 @@ styleclip_mapper_directions = 'editings/styleclip_directions/styleclip_direction
 styleclip_global_directions = 'editings/styleclip_directions/styleclip_directions/global_directions'
 s_statistics = 'editings/styleclip_directions/styleclip_directions/global_directions/ffhq/S_mean_std'
 text_prompt_templates = 'editings/styleclip_directions/styleclip_directions/global_directions/templates.txt'
+styleclip_text_features_cache = 'editings/styleclip_directions/styleclip_directions/global_directions/text_features'
 delta_i_c = 'editings/styleclip_directions/styleclip_directions/global_directions/ffhq/fs3.npy'
 gradctrl_modeldir = 'editings/gradctrl_manipulator/model_ffhq'
\ No newline at end of file